@@ -0,0 +1,76 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# Per frame type cost, in microseconds, of parsing a received frame with
+# API_Message.extract() and of building and exporting a frame to send.
+# Example:
+#
+#    python bench/bench_frames.py --number 20000
+
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from bench_util import ZB_SOURCE, api_frame, load_zigbee
+
+RX_FRAMES = [
+    (0x80, ZB_SOURCE + b"\x28\x00" + b"p" * 40),
+    (0x81, b"\x12\x34\x28\x00" + b"p" * 40),
+    (0x82, ZB_SOURCE + b"\x28\x00" + b"io"),
+    (0x83, b"\x12\x34\x28\x00" + b"io"),
+    (0x88, b"\x05SH\x00\x00\x13\xa2\x00"),
+    (0x89, b"\x05\x01"),
+    (0x8B, b"\x05\x12\x34\x00\x00\x01"),
+    (0x91, ZB_SOURCE + b"\x12\x34\xe8\xe8\x00\x11\xc1\x05\x01" + b"p" * 40),
+    (0x97, b"\x05" + ZB_SOURCE + b"\x12\x34SL\x00\x40\x01\x02\x03"),
+    (0xA4, b"\x05\x00"),
+]
+"(API ID, frame data) of the received frames measured"
+
+DESTINATION = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE8, 0xC105, 0x11, 0x20)
+
+TX_FRAMES = [
+    ("ZB_Data", lambda zigbee: zigbee.ZB_Data(("", 0xE8, 0, 0), DESTINATION, b"payload")),
+    ("ZB_Data short address", lambda zigbee: zigbee.ZB_Data(("", 0xE8, 0, 0), ("[1234]!", 0xE8, 0xC105, 0x11), b"payload")),
+    ("Local_AT_Data", lambda zigbee: zigbee.Local_AT_Data(b"NI", b"abc")),
+    ("Remote_AT_Data", lambda zigbee: zigbee.Remote_AT_Data(DESTINATION[0], b"D0", b"\x04")),
+    ("Register_Device_Data", lambda zigbee: zigbee.Register_Device_Data(DESTINATION[0], b"k" * 16)),
+    ("IEEE_802_15_4_64_Data", lambda zigbee: zigbee.IEEE_802_15_4_64_Data(None, DESTINATION, b"payload")),
+    ("IEEE_802_15_4_16_Data", lambda zigbee: zigbee.IEEE_802_15_4_16_Data(None, ("[1234]!", 0, 0, 0), b"payload")),
+]
+"(name, function returning the API_Data) of the frames sent that are measured"
+
+def microseconds(function, number):
+    "Returns the fastest of five runs of function, in microseconds per call"
+    return min(timeit.repeat(function, number = number, repeat = 5)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description = "API frame parse and export cost")
+    parser.add_argument("--zigbee", help = "zigbee.py to measure, the one in this repository by default")
+    parser.add_argument("--number", type = int, default = 20000, help = "calls per run")
+    args = parser.parse_args()
+    zigbee = load_zigbee(args.zigbee)
+    for api_id, data in RX_FRAMES:
+        frame = api_frame(api_id, data)
+        message = zigbee.API_Message()
+        message.extract(frame)
+        cost = microseconds(lambda: zigbee.API_Message().extract(frame), args.number)
+        print("rx 0x%02X %-30s %6.2f us" % (api_id, message.api_data.__class__.__name__, cost))
+    for name, api_data in TX_FRAMES:
+        def export():
+            message = zigbee.API_Message()
+            message.api_data = api_data(zigbee)
+            return message.export()
+        print("tx      %-30s %6.2f us" % (name, microseconds(export, args.number)))
+
+if __name__ == "__main__":
+    main()
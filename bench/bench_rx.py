@@ -0,0 +1,67 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# Receive throughput: frames per second read from the serial port, framed
+# and parsed into API_Messages by XBee.read_messages(), with the serial data
+# arriving in chunks of up to --chunk bytes.  The parsed messages are counted
+# instead of processed, unless --process is given.  The next chunk is read
+# once the frames in the previous ones have been parsed, so larger chunks mean
+# larger backlogs in the receive buffer.  Example:
+#
+#    python bench/bench_rx.py --frames 20000 --payload 60
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from bench_util import Chunked_Serial, load_zigbee, zb_rx_frame
+
+def run(zigbee, frames, payload, max_chunk, process = False):
+    "Returns the frames per second read_messages() parsed"
+    serial = Chunked_Serial(zb_rx_frame(b"x" * payload) * frames, max_chunk)
+    xbee = zigbee.XBee(serial)
+    processed = [0]
+    process_message = xbee.process_message
+    def count(*args):
+        processed[0] += 1
+        if process:
+            return process_message(*args)
+    xbee.process_message = count
+    start = time.time()
+    while serial.next_chunk():
+        # read_messages() may parse one frame per call
+        while True:
+            before = processed[0]
+            xbee.read_messages(force_com = True)
+            if processed[0] == before:
+                break
+    elapsed = time.time() - start
+    if processed[0] != frames:
+        raise Exception("run: processed %d frames out of %d" % (processed[0], frames))
+    return frames / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description = "XBee.read_messages() throughput")
+    parser.add_argument("--zigbee", help = "zigbee.py to measure, the one in this repository by default")
+    parser.add_argument("--frames", type = int, default = 20000)
+    parser.add_argument("--payload", type = int, default = 60, help = "payload bytes per 0x91 frame")
+    parser.add_argument("--chunk", type = int, nargs = "+", default = [512, 65536, 1048576],
+                        help = "largest serial reads to try, in bytes")
+    parser.add_argument("--process", action = "store_true", help = "also process the messages (XBee.process_message)")
+    args = parser.parse_args()
+    zigbee = load_zigbee(args.zigbee)
+    for max_chunk in args.chunk:
+        print("reads <= %8d bytes  %8.0f frames/s" %
+              (max_chunk, run(zigbee, args.frames, args.payload, max_chunk, args.process)))
+
+if __name__ == "__main__":
+    main()
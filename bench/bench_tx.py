@@ -0,0 +1,67 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# Transmit throughput: frames per second sent by XBee.send_zb() one
+# destination at a time, and by XBee.send_zb_many() (where there is one) all
+# destinations at once, to a ZigBee XBee.  Only the time spent in the send
+# calls is counted.  The Tx Status of each round of destinations are read
+# between rounds, as frame IDs are only reused once their Tx Status arrive.
+# Example:
+#
+#    python bench/bench_tx.py --destinations 200 --payload 40
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from bench_util import Tx_Status_Serial, load_zigbee
+
+def run(zigbee, send, destinations, duration):
+    "Returns the frames per second send(xbee, destinations) sent, and the number of serial writes per frame"
+    serial = Tx_Status_Serial()
+    xbee = zigbee.XBee(serial)
+    xbee.hw_version = 0x1944
+    xbee.sw_version = 0x21A7
+    frames = 0
+    elapsed = 0.0
+    while elapsed < duration:
+        start = time.time()
+        send(xbee, destinations)
+        elapsed += time.time() - start
+        frames += len(destinations)
+        # read_messages() may process one frame per call
+        for i in range(len(destinations) + 1):
+            xbee.read_messages(force_com = True)
+    return frames / elapsed, float(serial.writes) / frames
+
+def main():
+    parser = argparse.ArgumentParser(description = "XBee.send_zb() and send_zb_many() throughput")
+    parser.add_argument("--zigbee", help = "zigbee.py to measure, the one in this repository by default")
+    parser.add_argument("--destinations", type = int, default = 200)
+    parser.add_argument("--payload", type = int, default = 40, help = "payload bytes per frame")
+    parser.add_argument("--duration", type = float, default = 2, help = "seconds to spend sending for each method")
+    args = parser.parse_args()
+    zigbee = load_zigbee(args.zigbee)
+    payload = b"x" * args.payload
+    destinations = [(zigbee.MAC_to_address_string(0x0013A20040000000 + index), 0xE8, 0xC105, 0x11)
+                    for index in range(args.destinations)]
+    def send_zb(xbee, destinations):
+        for destination in destinations:
+            xbee.send_zb(0xE8, destination, payload)
+    methods = [("send_zb", send_zb)]
+    if hasattr(zigbee.XBee, "send_zb_many"):
+        methods.append(("send_zb_many", lambda xbee, destinations: xbee.send_zb_many(0xE8, destinations, payload)))
+    for name, send in methods:
+        print("%-12s %8.0f frames/s  %.3f writes per frame" % ((name,) + run(zigbee, send, destinations, args.duration)))
+
+if __name__ == "__main__":
+    main()
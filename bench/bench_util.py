@@ -0,0 +1,158 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# Helpers shared by the benchmarks in this directory.  Each benchmark takes
+# --zigbee PATH to measure another copy of zigbee.py, e.g. an older revision
+# saved with:
+#
+#    git show <revision>:zigbee.py > /tmp/zigbee_old.py
+#
+# Revisions from before Python 3 was supported only run under Python 2.
+
+import os
+import random
+import struct
+import sys
+import tempfile
+
+ZB_SOURCE = b"\x00\x13\xa2\x00\x40\x0a\x0b\x0c"
+"64-bit address the benchmark frames come from"
+
+def load_zigbee(path = None):
+    """Import zigbee.py, from path if given, otherwise the one in the parent
+    directory.  Importing zigbee reads and writes settings.json in the
+    current directory, so it is imported from a scratch directory."""
+    cwd = os.getcwd()
+    if path is not None:
+        path = os.path.abspath(path)
+    # zigbee imports simulator_settings from the repository
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+    os.chdir(tempfile.mkdtemp())
+    try:
+        if path is None:
+            import zigbee
+            return zigbee
+        try:
+            import importlib.util
+        except ImportError:
+            import imp
+            return imp.load_source("zigbee_bench", path)
+        spec = importlib.util.spec_from_file_location("zigbee_bench", path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["zigbee_bench"] = module
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        os.chdir(cwd)
+
+def api_frame(api_id, data):
+    "Returns an XBee API frame for the frame type api_id with data"
+    body = bytearray([api_id]) + bytearray(data)
+    return bytes(bytearray([0x7E]) + bytearray(struct.pack(">H", len(body))) + body +
+                 bytearray([0xFF - (sum(body) & 0xFF)]))
+
+def zb_rx_frame(payload):
+    "Returns a ZigBee Explicit Rx Indicator (0x91) frame carrying payload"
+    return api_frame(0x91, ZB_SOURCE + b"\x12\x34\xe8\xe8\x00\x11\xc1\x05\x01" + payload)
+
+
+class Null_Serial(object):
+    "A serial port that discards what is written to it, counting the writes"
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes_written = 0
+
+    def isOpen(self):
+        return True
+
+    def close(self):
+        pass
+
+    def inWaiting(self):
+        return 0
+
+    def read(self, size = 1):
+        return b""
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes_written += len(data)
+        return len(data)
+
+
+class Chunked_Serial(Null_Serial):
+    """A serial port that returns data in chunks of 1 to max_chunk bytes, one
+    chunk each time next_chunk() is called"""
+
+    def __init__(self, data, max_chunk, seed = 1):
+        Null_Serial.__init__(self)
+        self.chunks = []
+        random.seed(seed)
+        index = 0
+        while index < len(data):
+            size = random.randint(1, max_chunk)
+            self.chunks.append(data[index:index + size])
+            index += size
+        self.chunks.reverse()
+        self.waiting = b""
+
+    def next_chunk(self):
+        "Make the next chunk available to read, returns False once there are none left"
+        if not self.chunks:
+            return False
+        self.waiting = self.chunks.pop()
+        return True
+
+    def inWaiting(self):
+        return len(self.waiting)
+
+    def read(self, size = 1):
+        data, self.waiting = self.waiting[:size], self.waiting[size:]
+        return data
+
+
+class Tx_Status_Serial(Null_Serial):
+    """A serial port that answers every ZigBee transmission written to it with
+    a successful Tx Status.  The answers are only worked out once the data is
+    read, so that writing stays as cheap as for Null_Serial."""
+
+    def __init__(self):
+        Null_Serial.__init__(self)
+        self.written = []
+        self.waiting = b""
+
+    def write(self, data):
+        self.written.append(data)
+        return Null_Serial.write(self, data)
+
+    def _answer(self):
+        answers = []
+        for data in self.written:
+            data = bytearray(data)
+            index = 0
+            while index + 4 < len(data):
+                length = struct.unpack(">H", bytes(data[index + 1:index + 3]))[0]
+                api_id, frame_id = data[index + 3], data[index + 4]
+                if api_id in (0x10, 0x11) and frame_id:
+                    answers.append(api_frame(0x8B, bytearray([frame_id]) + b"\x12\x34\x00\x00\x00"))
+                index += length + 4
+        self.written = []
+        self.waiting += b"".join(answers)
+
+    def inWaiting(self):
+        if self.written:
+            self._answer()
+        return len(self.waiting)
+
+    def read(self, size = 1):
+        data, self.waiting = self.waiting[:size], self.waiting[size:]
+        return data
@@ -22,6 +22,7 @@ setup(
         'simulator_settings',
         'xbee',
         'zigbee',
+        'zigbee_asyncio',
     ],
     # don't include webob, just mark as dependency
     install_requires=[
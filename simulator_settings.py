@@ -15,10 +15,13 @@ import uuid
 import json
 import os
 
+_ENCODE_TEXT = str is bytes
+"json returns unicode strings on Python 2, which are converted to utf-8 str"
+
 def _decode_list(data):
     rv = []
     for item in data:
-        if isinstance(item, unicode):
+        if _ENCODE_TEXT and isinstance(item, unicode):
             item = item.encode('utf-8')
         elif isinstance(item, list):
             item = _decode_list(item)
@@ -29,10 +32,10 @@ def _decode_list(data):
 
 def _decode_dict(data):
     rv = {}
-    for key, value in data.iteritems():
-        if isinstance(key, unicode):
+    for key, value in data.items():
+        if _ENCODE_TEXT and isinstance(key, unicode):
             key = key.encode('utf-8')
-        if isinstance(value, unicode):
+        if _ENCODE_TEXT and isinstance(value, unicode):
             value = value.encode('utf-8')
         elif isinstance(value, list):
             value = _decode_list(value)
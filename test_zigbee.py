@@ -0,0 +1,1275 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# Tests for zigbee.py that talk to a fake XBee instead of a serial port.  Run
+# from this directory with:
+#
+#    python -m unittest test_zigbee
+#
+# Importing zigbee reads and writes settings.json (and reads nodes.json) in
+# the current directory, so the tests run from a scratch directory.
+
+import os
+import select
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+_test_dir = tempfile.mkdtemp()
+_cwd = os.getcwd()
+os.chdir(_test_dir)
+try:
+    import zigbee
+finally:
+    os.chdir(_cwd)
+
+
+def api_frame(api_id, data):
+    "Returns an XBee API frame for the frame type api_id with data"
+    body = bytearray([api_id]) + bytearray(data)
+    return bytes(bytearray([0x7E]) + bytearray(struct.pack(">H", len(body))) + body +
+                 bytearray([0xFF - (sum(body) & 0xFF)]))
+
+
+class Fake_Serial(object):
+    """Stands in for the serial port of an XBee in API mode.  Answers local and
+    remote AT commands from params and ZigBee transmissions with a Tx Status,
+    unless reply is False.  Every frame written is kept in tx_frames as
+    (api_id, data) and handle(api_id, data) may be replaced to answer frames
+    differently."""
+
+    def __init__(self):
+        self.timeout = 0
+        self.rx = b""
+        "Bytes waiting to be read by the XBee"
+        self.condition = threading.Condition()
+        self.open = True
+        self.params = {b"HV": b"\x19\x44", b"VR": b"\x21\xa7", b"SH": b"\x00\x13\xa2\x00",
+                       b"SL": b"\x40\x01\x02\x03", b"MY": b"\x00\x00", b"NI": b"node",
+                       b"NP": b"\x00\x54"}
+        self.tx_frames = []
+        self.reply = True
+        self.tx_status = 0
+
+    def isOpen(self):
+        return self.open
+
+    def close(self):
+        with self.condition:
+            self.open = False
+            self.condition.notify_all()
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    def inject(self, api_id, data):
+        "Make a frame available to read"
+        with self.condition:
+            self.rx += api_frame(api_id, data)
+            self.condition.notify_all()
+
+    def read(self, size = 1):
+        with self.condition:
+            if not self.rx and self.open and self.timeout != 0:
+                self.condition.wait(self.timeout)
+            data, self.rx = self.rx[:size], self.rx[size:]
+            return data
+
+    def write(self, data):
+        written = len(data)
+        data = bytearray(data)
+        while data:
+            length = struct.unpack(">H", bytes(data[1:3]))[0]
+            body = data[3:3 + length]
+            data = data[4 + length:]
+            self.tx_frames.append((body[0], bytes(body[1:])))
+            self.handle(body[0], bytes(body[1:]))
+        return written
+
+    def handle(self, api_id, data):
+        "Answer a frame written to the XBee"
+        if not self.reply:
+            return
+        frame_id = bytearray(data)[0]
+        if api_id in (0x08, 0x09):
+            command, value = data[1:3].upper(), data[3:]
+            if value:
+                self.params[command] = value
+                value = b""
+            else:
+                value = self.params.get(command, b"")
+            if frame_id:
+                self.inject(0x88, data[0:1] + command + b"\x00" + value)
+        elif api_id == 0x17:
+            command, value = data[12:14].upper(), data[14:]
+            value = b"" if value else self.params.get(command, b"")
+            if frame_id:
+                self.inject(0x97, data[0:9] + b"\x12\x34" + command + b"\x00" + value)
+        elif api_id == 0x11:
+            if frame_id:
+                self.inject(0x8B, data[0:1] + b"\x12\x34\x00" + bytearray([self.tx_status]) + b"\x00")
+
+
+class XBee_Test_Case(unittest.TestCase):
+    "Gives each test its own XBee, connected to a Fake_Serial"
+
+    def setUp(self):
+        self.com_port_opened = zigbee.com_port_opened
+        zigbee.com_port_opened = True
+        self.serial = Fake_Serial()
+        self.xbee = zigbee.XBee(self.serial)
+        self.xbee.set_version()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.xbee.close_serial()
+        if self.xbee.reader_thread is not None:
+            self.xbee.reader_thread.join(1)
+        zigbee.com_port_opened = self.com_port_opened
+
+    def bind(self, endpoint):
+        sock = zigbee.XBeeSocket(socket.AF_XBEE, socket.SOCK_DGRAM, socket.XBS_PROT_TRANSPORT, xbee = self.xbee)
+        sock.bind(("", endpoint, 0, 0))
+        self.sockets.append(sock)
+        return sock
+
+    def wait_for(self, condition, timeout = 2):
+        "Wait for condition() to be true, returns it"
+        end_time = time.time() + timeout
+        while not condition() and time.time() < end_time:
+            time.sleep(0.02)
+        return condition()
+
+
+class Reader_Test(XBee_Test_Case):
+
+    def test_reader(self):
+        self.serial.timeout = 0.1
+        self.xbee.start_reader()
+        self.assertTrue(self.xbee.reader_running())
+        self.assertEqual(self.xbee.ddo_get_param(None, "NI", use_cache = False), b"node")
+
+    def test_reopen(self):
+        self.serial.timeout = 0.1
+        self.xbee.start_reader()
+        old_reader = self.xbee.reader_thread
+        self.xbee.close_serial()
+        self.assertFalse(self.xbee.reader_running())
+        # reopen while the old reader may still be in its last read
+        self.serial = Fake_Serial()
+        self.serial.timeout = 0.1
+        self.xbee.serial = self.serial
+        zigbee.com_port_opened = True
+        self.xbee.start_reader()
+        self.assertTrue(self.xbee.reader_thread is not old_reader)
+        self.assertTrue(self.xbee.reader_running())
+        old_reader.join(1)
+        self.assertFalse(old_reader.is_alive())
+        self.assertTrue(self.xbee.reader_running())
+        self.assertEqual(self.xbee.ddo_get_param(None, "NI", use_cache = False), b"node")
+
+
+class Fragment_Test(XBee_Test_Case):
+    destination = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE9, 0xC105, 0x11)
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.tx_status_timeout = zigbee.TX_STATUS_TIMEOUT
+        zigbee.TX_STATUS_TIMEOUT = 0.3
+        self.serial.timeout = 0.1
+        self.serial.handle = self.echo
+        self.lost = set()
+        "Indexes of fragments whose first transmission is lost"
+        self.xbee.start_reader()
+        self.sender = self.bind(0xE8)
+        self.receiver = self.bind(0xE9)
+        for sock in (self.sender, self.receiver):
+            sock.setsockopt(socket.XBS_SOL_EP, socket.XBS_SO_EP_FRAGMENTATION, 1)
+        self.receiver.settimeout(3)
+
+    def tearDown(self):
+        zigbee.TX_STATUS_TIMEOUT = self.tx_status_timeout
+        XBee_Test_Case.tearDown(self)
+
+    def echo(self, api_id, data):
+        "The remote node sends transmissions back to the endpoint they were sent to"
+        if api_id != 0x11:
+            return Fake_Serial.handle(self.serial, api_id, data)
+        index = bytearray(data)[21]
+        if index in self.lost:
+            # neither the fragment nor its Tx Status make it
+            self.lost.remove(index)
+            return
+        self.serial.inject(0x91, data[1:9] + b"\x12\x34" + data[11:17] + b"\x01" + data[19:])
+        self.serial.inject(0x8B, data[0:1] + b"\x12\x34\x00\x00\x00")
+
+    def test_reassembly(self):
+        message = bytes(bytearray([i & 0xFF for i in range(1000)]))
+        self.assertEqual(self.sender.sendto(message, self.destination), len(message))
+        payload, address = self.receiver.recvfrom(2000)
+        self.assertEqual(payload, message)
+        self.assertEqual(address[:4], ("[00:13:a2:00:40:0a:0b:0c]!", 0xE8, 0xC105, 0x11))
+
+    def test_lost_tx_status(self):
+        # a background send is retried without any other traffic
+        self.sender.setblocking(False)
+        self.lost.add(1)
+        message = bytes(bytearray([i & 0xFF for i in range(300)]))
+        self.assertEqual(self.sender.sendto(message, self.destination), len(message))
+        self.assertEqual(self.receiver.recvfrom(2000)[0], message)
+        self.assertFalse(self.lost)
+
+
+class DDO_Future_Test(XBee_Test_Case):
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+
+    def test_callbacks(self):
+        called = []
+        future = self.xbee.ddo_get_param_async(None, "NI", callback = called.append, use_cache = False)
+        self.assertEqual(future.result(), b"node")
+        self.assertEqual(called, [future])
+        self.assertTrue(future.exception() is None)
+        # a callback added once the future is done runs right away
+        future.add_done_callback(called.append)
+        self.assertEqual(called, [future, future])
+
+    def test_wait_timeout(self):
+        self.serial.reply = False
+        called = []
+        future = self.xbee.ddo_get_param_async(None, "NI", timeout = 0.5, use_cache = False)
+        future.add_done_callback(called.append)
+        self.assertFalse(future.wait(0.1))
+        self.assertFalse(future.done())
+        self.assertRaises(Exception, future.result, 0.05)
+        self.assertEqual(called, [])
+        # the request itself times out
+        self.assertTrue(future.wait())
+        self.assertEqual(called, [future])
+        self.assertTrue(future.exception() is not None)
+        self.assertRaises(Exception, future.result)
+
+
+class DDO_Set_Params_Test(XBee_Test_Case):
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+        del self.serial.tx_frames[:]
+
+    def test_apply(self):
+        self.assertTrue(self.xbee.ddo_set_params(None, [("NI", "set"), ("NP", 0x20)]))
+        self.assertEqual([(api_id, data[1:3]) for api_id, data in self.serial.tx_frames],
+                         [(0x09, b"NI"), (0x09, b"NP"), (0x08, b"AC")])
+        self.assertEqual(self.serial.params[b"NI"], b"set")
+
+    def test_no_apply(self):
+        self.assertTrue(self.xbee.ddo_set_params(None, {"NI": "set"}, apply = False))
+        self.assertEqual([(api_id, data[1:3]) for api_id, data in self.serial.tx_frames], [(0x09, b"NI")])
+
+    def test_error(self):
+        self.serial.reply = False
+        self.assertRaises(Exception, self.xbee.ddo_set_params, None, [("NI", "set")], 0.2)
+        # every value was sent before waiting for the responses
+        self.assertEqual([data[1:3] for api_id, data in self.serial.tx_frames], [b"NI", b"AC"])
+
+
+class DDO_Batch_Test(XBee_Test_Case):
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+
+    def test_rate(self):
+        batch = zigbee.DDO_Batch(self.xbee, rate = 20)
+        for index in range(6):
+            batch.add("[00:13:a2:00:50:00:00:%02x]!" % index, "NI")
+        self.assertEqual(next(iter(batch.results())).result, b"node")
+        # the rest are sent without iterating over the results
+        self.assertTrue(self.wait_for(lambda: not batch.waiting))
+        self.assertEqual(len(batch.completed), 5)
+
+    def address(self, index):
+        return "[00:13:a2:00:50:00:00:%02x]!" % index
+
+    def sent(self):
+        "Returns the addresses sent a remote AT command, in order"
+        return [zigbee.MAC_to_address_string(struct.unpack(">Q", data[1:9])[0])
+                for api_id, data in self.serial.tx_frames if api_id == 0x17]
+
+    def start(self, batch):
+        zigbee._global_lock.acquire(True)
+        try:
+            batch._pump()
+        finally:
+            zigbee._global_lock.release()
+
+    def test_limits(self):
+        self.serial.reply = False
+        batch = zigbee.DDO_Batch(self.xbee, limit = 3, node_limit = 2, rate = 0)
+        for index in (0, 1):
+            for id in ("NI", "VR", "HV"):
+                batch.add(self.address(index), id)
+        self.start(batch)
+        # the nodes take turns, up to two requests each and three in all
+        self.assertEqual(self.sent(), [self.address(0), self.address(1), self.address(0)])
+        self.assertEqual(batch.running, {self.address(0): 2, self.address(1): 1})
+        batch.limit = 10
+        self.start(batch)
+        self.assertEqual(self.sent()[3:], [self.address(1)])
+        self.assertEqual(batch.in_flight, 4)
+
+    def test_retry_tx_failure(self):
+        failed = set()
+        def handle(api_id, data):
+            if api_id == 0x17 and data[1:9] not in failed:
+                failed.add(data[1:9])
+                self.serial.inject(0x97, data[0:9] + b"\x12\x34" + data[12:14] + b"\x04")
+                return
+            Fake_Serial.handle(self.serial, api_id, data)
+        self.serial.handle = handle
+        batch = self.xbee.ddo_batch([(self.address(index), "NI") for index in range(3)], rate = 0)
+        jobs = list(batch)
+        self.assertEqual(len(jobs), 3)
+        for job in jobs:
+            self.assertEqual((job.status, job.result, job.attempts), (zigbee.DDO_Job.OK, b"node", 2))
+
+    def test_retry_timeout(self):
+        lost = []
+        def handle(api_id, data):
+            if api_id == 0x17 and not lost:
+                lost.append(data)
+                return
+            Fake_Serial.handle(self.serial, api_id, data)
+        self.serial.handle = handle
+        batch = self.xbee.ddo_batch([(self.address(0), "NI")], rate = 0, timeout = 0.2)
+        job, = list(batch)
+        self.assertEqual((job.status, job.result, job.attempts), (zigbee.DDO_Job.OK, b"node", 2))
+        # without retries the timeout is the job's status
+        self.serial.reply = False
+        batch = self.xbee.ddo_batch([(self.address(1), "NI")], rate = 0, retries = 0, timeout = 0.2)
+        job, = list(batch)
+        self.assertEqual((job.status, job.attempts), (zigbee.DDO_Job.TIMEOUT, 1))
+
+
+class Reassembler_Test(unittest.TestCase):
+    address = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE8, 0xC105, 0x11)
+
+    def fragment(self, message_id, index, count, payload):
+        return zigbee.FRAGMENT_HEADER.pack(message_id, index, count) + payload
+
+    def test_duplicate_fragment(self):
+        reassembler = zigbee.Fragment_Reassembler()
+        self.assertTrue(reassembler.add(self.fragment(5, 0, 2, b"ab"), self.address) is None)
+        self.assertEqual(reassembler.add(self.fragment(5, 1, 2, b"cd"), self.address), (b"abcd", self.address))
+        # the last fragment again, after its Tx Status was lost
+        self.assertTrue(reassembler.add(self.fragment(5, 1, 2, b"cd"), self.address) is None)
+        self.assertFalse(reassembler.partial)
+        self.assertEqual((reassembler.drops, reassembler.duplicates), (0, 1))
+
+    def test_duplicate_single_fragment(self):
+        reassembler = zigbee.Fragment_Reassembler()
+        self.assertEqual(reassembler.add(self.fragment(6, 0, 1, b"ab"), self.address), (b"ab", self.address))
+        self.assertTrue(reassembler.add(self.fragment(6, 0, 1, b"ab"), self.address) is None)
+        self.assertEqual(reassembler.add(self.fragment(7, 0, 1, b"ab"), self.address), (b"ab", self.address))
+        other = ("[00:13:a2:00:40:0a:0b:0d]!",) + self.address[1:]
+        self.assertEqual(reassembler.add(self.fragment(6, 0, 1, b"ab"), other), (b"ab", other))
+
+    def test_completed_limit(self):
+        reassembler = zigbee.Fragment_Reassembler(completed_limit = 4)
+        for message_id in range(10):
+            reassembler.add(self.fragment(message_id, 0, 1, b"ab"), self.address)
+        self.assertEqual(len(reassembler.completed), 4)
+        self.assertEqual(reassembler.add(self.fragment(0, 0, 1, b"ab"), self.address), (b"ab", self.address))
+
+
+class Node_Table_Test(unittest.TestCase):
+    router = "[00:13:a2:00:40:0a:0b:0c]!"
+
+    def test_index(self):
+        table = zigbee.Node_Table()
+        node = table.add(zigbee.Node("router", self.router, "[1234]!"))
+        self.assertTrue(table.get(self.router) is node)
+        self.assertTrue(table.get_short("[1234]!") is node)
+        table.set_short(node, "[5678]!")
+        self.assertTrue(table.get_short("[1234]!") is None)
+        self.assertTrue(table.get_short("[5678]!") is node)
+        table.remove(node)
+        self.assertEqual(len(table), 0)
+        self.assertTrue(table.get_short("[5678]!") is None)
+
+    def test_merge_keeps_known_fields(self):
+        table = zigbee.Node_Table()
+        node = table.add(zigbee.Node("router", self.router, "[1234]!", "[0000]!", 0xC105, 0x101E, b"kitchen"))
+        # a sighting that knows less about the node
+        for label in (b"", None):
+            merged = table.add(zigbee.Node("unknown", self.router, "[FFFE]!", None, None, None, label))
+            self.assertTrue(merged is node)
+            self.assertEqual(node.label, b"kitchen")
+            self.assertEqual(node.type, "router")
+            self.assertEqual(node.addr_short, "[1234]!")
+            self.assertEqual(node.addr_parent, "[0000]!")
+            self.assertEqual((node.profile_id, node.manufacturer_id), (0xC105, 0x101E))
+        # a node discovery response without a parent
+        table.add(zigbee.Node("router", self.router, "[1234]!", 0xFFFE, 0xC105, 0x101E, b"kitchen"))
+        self.assertEqual(node.addr_parent, "[0000]!")
+        table.add(zigbee.Node("router", self.router, "[4321]!", None, 0, 0, b"hall"))
+        self.assertEqual(node.label, b"hall")
+        self.assertTrue(table.get_short("[4321]!") is node)
+        # zero is a real profile, manufacturer and parent address
+        self.assertEqual((node.profile_id, node.manufacturer_id), (0, 0))
+        table.add(zigbee.Node("end", self.router, "[4321]!", 0x0101))
+        self.assertEqual(node.addr_parent, 0x0101)
+        table.add(zigbee.Node("end", self.router, "[4321]!", 0))
+        self.assertEqual(node.addr_parent, 0)
+
+    def test_children(self):
+        table = zigbee.Node_Table()
+        first = table.add(zigbee.Node("end", "[00:13:a2:00:50:00:00:01]!", "[0101]!", "[1234]!"))
+        second = table.add(zigbee.Node("end", "[00:13:a2:00:50:00:00:02]!", "[0102]!", 0x1234))
+        table.add(zigbee.Node("end", "[00:13:a2:00:50:00:00:03]!", "[0103]!", 0xFFFE))
+        self.assertEqual(set(table.children("[1234]!")), set([first, second]))
+        table.set_parent(first, "[5678]!")
+        self.assertEqual(table.children("[1234]!"), [second])
+        self.assertEqual(table.children("[5678]!"), [first])
+        table.remove(second)
+        self.assertEqual(table.children("[1234]!"), [])
+        self.assertEqual(table.children("[FFFE]!"), [])
+
+
+class Topology_Graph_Test(unittest.TestCase):
+    router = 0x0013A20040000001
+    other = 0x0013A20040000002
+    child = 0x0013A20050000001
+
+    def record(self, addr_extended, relationship):
+        return zigbee.NeighborTableDescriptorRecord(addr_extended = zigbee.MAC_to_address_string(addr_extended),
+                                                    addr_short = "[0101]!", relationship = relationship)
+
+    def test_parent(self):
+        topology = zigbee.Topology()
+        router = zigbee.MAC_to_address_string(self.router)
+        other = zigbee.MAC_to_address_string(self.other)
+        child = zigbee.MAC_to_address_string(self.child)
+        topology.update(router, [self.record(self.child, zigbee.Neighbor_Link.CHILD)])
+        self.assertEqual(topology.parent(child), router)
+        topology.update(other, [self.record(self.child, zigbee.Neighbor_Link.SIBLING)])
+        self.assertEqual(topology.parent(child), router)
+        # the child moved
+        topology.update(router, [])
+        self.assertTrue(topology.parent(child) is None)
+        topology.update(other, [self.record(self.child, zigbee.Neighbor_Link.CHILD)])
+        self.assertEqual(topology.parent(child), other)
+        topology.remove(other)
+        self.assertTrue(topology.parent(child) is None)
+        self.assertEqual(topology.parents, {})
+
+
+class Discovery_Test(XBee_Test_Case):
+    "ZigBee node discoveries, with routers that don't answer LQI requests"
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.lqi_discovery_time = zigbee.LQI_DISCOVERY_TIME
+        zigbee.LQI_DISCOVERY_TIME = 0.2
+        self.serial.timeout = 0.1
+        self.xbee.node_table_file = os.path.join(_test_dir, "nodes_%s.json" % self._testMethodName)
+        self.xbee.start_reader()
+
+    def tearDown(self):
+        zigbee.LQI_DISCOVERY_TIME = self.lqi_discovery_time
+        XBee_Test_Case.tearDown(self)
+        for filename in (self.xbee.node_table_file, self.xbee.node_table_file + ".tmp"):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def save_routers(self, count, last_seen):
+        table = zigbee.Node_Table()
+        for index in range(count):
+            node = zigbee.Node("router", "[00:13:a2:00:50:00:00:%02x]!" % index, "[%04X]!" % (0x100 + index))
+            node.last_seen = last_seen
+            table.add(node)
+        table.save(self.xbee.node_table_file)
+
+    def test_warm_start(self):
+        self.save_routers(20, time.time() - 60)
+        self.assertEqual(self.xbee.load_node_table(), 20)
+        saved = open(self.xbee.node_table_file).read()
+        nodes = self.xbee.discover_nodes().wait()
+        self.assertEqual(len(nodes), 1)
+        # the neighbor tables haven't been read, the loaded nodes are kept
+        self.assertEqual(len(self.xbee.node_table), 21)
+        self.assertTrue(self.xbee.lqi_queries)
+        # and the file isn't written until they have been
+        self.assertEqual(open(self.xbee.node_table_file).read(), saved)
+        self.xbee.close_serial()
+        self.assertEqual(open(self.xbee.node_table_file).read(), saved)
+
+    def test_save_interrupted(self):
+        self.save_routers(2, time.time())
+        saved = open(self.xbee.node_table_file).read()
+        table = zigbee.Node_Table()
+        table.add(zigbee.Node("router", "[00:13:a2:00:50:00:00:10]!", "[0110]!"))
+        dump = zigbee.json.dump
+        def crash(data, fp, **kwargs):
+            fp.write("{")
+            raise IOError("power lost")
+        zigbee.json.dump = crash
+        try:
+            self.assertRaises(IOError, table.save, self.xbee.node_table_file)
+        finally:
+            zigbee.json.dump = dump
+        self.assertEqual(open(self.xbee.node_table_file).read(), saved)
+        table.save(self.xbee.node_table_file)
+        self.assertEqual(self.xbee.load_node_table(), 1)
+        self.assertFalse(os.path.exists(self.xbee.node_table_file + ".tmp"))
+
+    def test_max_age(self):
+        self.save_routers(2, time.time() - zigbee.NODE_MAX_AGE - 60)
+        self.assertEqual(self.xbee.load_node_table(), 2)
+        self.xbee.discover_nodes().wait()
+        self.assertEqual([node.type for node in self.xbee.node_table], ["coordinator"])
+
+    def test_load_version_1(self):
+        fp = open(self.xbee.node_table_file, "w")
+        fp.write('{"version":1,"nodes":[["[00:13:a2:00:50:00:00:01]!","[0101]!","[0000]!","end",49413,4126,"n1"]]}')
+        fp.close()
+        self.assertEqual(self.xbee.load_node_table(), 1)
+        node = self.xbee.node_table.get("[00:13:a2:00:50:00:00:01]!")
+        self.assertEqual((node.type, node.addr_short, node.label), ("end", "[0101]!", b"n1"))
+        self.assertEqual(node.last_seen, os.path.getmtime(self.xbee.node_table_file))
+
+
+class Topology_Test(XBee_Test_Case):
+    "ZigBee node discoveries that read the neighbor table of the local node"
+    local = 0x0013A20040010203
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.lqi_discovery_time = zigbee.LQI_DISCOVERY_TIME
+        zigbee.LQI_DISCOVERY_TIME = 0.2
+        self.topology_max_age = zigbee.TOPOLOGY_MAX_AGE
+        self.serial.timeout = 0.1
+        self.serial.handle = self.lqi_handle
+        self.neighbors = []
+        "The local node's neighbor table, as (64-bit address, 16-bit address, device type, relationship)"
+        self.lqi_requests = 0
+        self.xbee.start_reader()
+
+    def tearDown(self):
+        zigbee.LQI_DISCOVERY_TIME = self.lqi_discovery_time
+        zigbee.TOPOLOGY_MAX_AGE = self.topology_max_age
+        XBee_Test_Case.tearDown(self)
+
+    def lqi_handle(self, api_id, data):
+        "Answer Mgmt_Lqi_req sent to the local node, other routers don't answer"
+        if api_id != 0x11 or data[13:15] != b"\x00\x31":
+            return Fake_Serial.handle(self.serial, api_id, data)
+        if struct.unpack(">Q", data[1:9])[0] != self.local:
+            return
+        self.lqi_requests += 1
+        transaction_sequence_number, start = bytearray(data[19:21])
+        page = self.neighbors[start:start + 3]
+        response = struct.pack("<BBBB", 0, len(self.neighbors), start, len(page))
+        for addr_extended, addr_short, device_type, relationship in page:
+            response += struct.pack("<QQHBBBB", 0x1234, addr_extended, addr_short,
+                                    device_type | (1 << 2) | (relationship << 4), 0, 1, 200)
+        self.serial.inject(0x91, struct.pack(">QH", self.local, 0) + b"\x00\x00\x80\x31\x00\x00\x01" +
+                           bytearray([transaction_sequence_number]) + response)
+
+    def add_node(self, type, addr_extended, addr_short, addr_parent, last_seen):
+        node = zigbee.Node(type, addr_extended, addr_short, addr_parent)
+        node.last_seen = last_seen
+        self.xbee.node_table.add(node)
+
+    def test_remove_lost_children(self):
+        old = time.time() - 60
+        self.neighbors = [(0x0013A2005000000A, 0x010A, 2, zigbee.Neighbor_Link.CHILD)]
+        self.add_node("end", "[00:13:a2:00:50:00:00:0a]!", "[010A]!", "[0000]!", old)
+        self.add_node("end", "[00:13:a2:00:50:00:00:0b]!", "[010B]!", "[0000]!", old)
+        self.add_node("end", "[00:13:a2:00:50:00:00:0c]!", "[010C]!", "[0777]!", old)
+        self.add_node("router", "[00:13:a2:00:50:00:00:05]!", "[0777]!", "[FFFE]!", old)
+        self.xbee.discover_nodes().wait()
+        local = "[00:13:a2:00:40:01:02:03]!"
+        self.assertTrue(self.wait_for(lambda: local in self.xbee.topology.refreshed))
+        table = self.xbee.node_table
+        # listed by the local node
+        self.assertTrue(table.get("[00:13:a2:00:50:00:00:0a]!") is not None)
+        # its parent no longer lists it
+        self.assertTrue(table.get("[00:13:a2:00:50:00:00:0b]!") is None)
+        # the child of a router that hasn't answered, and the router
+        self.assertTrue(table.get("[00:13:a2:00:50:00:00:0c]!") is not None)
+        self.assertTrue(table.get("[00:13:a2:00:50:00:00:05]!") is not None)
+        # a child that leaves is removed when the table is read again
+        self.neighbors = []
+        self.xbee.refresh_topology(max_age = 0)
+        self.assertTrue(self.wait_for(lambda: table.get("[00:13:a2:00:50:00:00:0a]!") is None))
+
+    def lock_free(self):
+        "Returns True if another thread can take _global_lock"
+        acquired = []
+        def take():
+            for attempt in range(50):
+                if zigbee._global_lock.acquire(False):
+                    zigbee._global_lock.release()
+                    acquired.append(True)
+                    return
+                time.sleep(0.01)
+        thread = threading.Thread(target = take)
+        thread.start()
+        thread.join(2)
+        return bool(acquired)
+
+    def test_stream(self):
+        zigbee.LQI_DISCOVERY_TIME = 1
+        self.neighbors = [(0x0013A2005000000A, 0x010A, 2, zigbee.Neighbor_Link.CHILD),
+                          (0x0013A2005000000B, 0x010B, 2, zigbee.Neighbor_Link.CHILD)]
+        found = []
+        discovery = self.xbee.discover_nodes(callback = found.append)
+        streamed = []
+        for node in discovery:
+            # the lock is free while the caller handles the node
+            self.assertTrue(self.lock_free())
+            streamed.append((node.addr_extended, discovery.done()))
+        self.assertEqual(streamed, [("[00:13:a2:00:40:01:02:03]!", False), ("[00:13:a2:00:50:00:00:0a]!", False),
+                                    ("[00:13:a2:00:50:00:00:0b]!", False)])
+        self.assertTrue(discovery.done())
+        self.assertEqual(found, discovery.nodes)
+
+    def test_periodic_refresh(self):
+        zigbee.TOPOLOGY_MAX_AGE = 0.3
+        self.xbee.discover_nodes().wait()
+        self.assertTrue(self.wait_for(lambda: self.lqi_requests >= 3))
+        self.xbee.close_serial()
+        self.assertTrue(self.xbee.topology_timer is None)
+
+
+class Select_Test(XBee_Test_Case):
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+        self.select_polling = zigbee._xbee_select_polling
+        zigbee._xbee_select_polling = self.fail_polling
+
+    def tearDown(self):
+        zigbee._xbee_select_polling = self.select_polling
+        XBee_Test_Case.tearDown(self)
+
+    def fail_polling(self, *args):
+        raise AssertionError("xbee_select polled the XBee")
+
+    def test_wakes_on_message(self):
+        receiver = self.bind(0xE8)
+        frame = struct.pack(">QH", 0x0013A2004001ABCD, 0x1234) + b"\xe9\xe8\x00\x11\xc1\x05\x01hello"
+        timer = threading.Timer(0.2, self.serial.inject, (0x91, frame))
+        timer.start()
+        start = time.time()
+        self.assertEqual(zigbee.xbee_select([receiver], [], [], 5), ([receiver], [], []))
+        self.assertTrue(0.15 <= time.time() - start < 1)
+        timer.join()
+        self.assertEqual(receiver.recvfrom(100)[0], b"hello")
+
+    def test_timeout(self):
+        receiver = self.bind(0xE8)
+        start = time.time()
+        self.assertEqual(zigbee.xbee_select([receiver], [], [], 0.2), ([], [], []))
+        self.assertTrue(0.15 <= time.time() - start < 1)
+
+    def test_other_sockets(self):
+        receiver = self.bind(0xE8)
+        reader, writer = socket.socketpair()
+        try:
+            timer = threading.Timer(0.1, writer.send, (b"x",))
+            timer.start()
+            self.assertEqual(zigbee.xbee_select([receiver, reader], [], [], 5), ([reader], [], []))
+            timer.join()
+        finally:
+            reader.close()
+            writer.close()
+
+
+class Receive_Timeout_Test(XBee_Test_Case):
+
+    def test_settimeout(self):
+        receiver = self.bind(0xE9)
+        receiver.settimeout(0.2)
+        start = time.time()
+        self.assertRaises(socket.timeout, receiver.recvfrom, 100)
+        self.assertTrue(0.15 <= time.time() - start < 1)
+
+    def test_rcvtimeo(self):
+        receiver = self.bind(0xE9)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, 0.2)
+        self.assertEqual(receiver.gettimeout(), 0.2)
+        self.assertRaises(socket.timeout, receiver.recvfrom, 100)
+
+    def test_woken_by_message(self):
+        sender = self.bind(0xE8)
+        receiver = self.bind(0xE9)
+        receiver.settimeout(2)
+        timer = threading.Timer(0.1, sender.sendto, (b"hello", ("", 0xE9, 0xC105, 0x11)))
+        timer.start()
+        start = time.time()
+        self.assertEqual(receiver.recvfrom(100)[0], b"hello")
+        self.assertTrue(time.time() - start < 1)
+        timer.join()
+
+    def test_dontwait(self):
+        receiver = self.bind(0xE9)
+        receiver.settimeout(2)
+        start = time.time()
+        self.assertEqual(receiver.recvfrom(100, socket.MSG_DONTWAIT), (None, None))
+        # along with other flags
+        self.assertEqual(receiver.recvfrom(100, socket.MSG_DONTWAIT | 0x1), (None, None))
+        self.assertTrue(time.time() - start < 0.5)
+
+
+class Poll_Test(XBee_Test_Case):
+
+    def test_pollin(self):
+        sender = self.bind(0xE8)
+        receiver = self.bind(0xE9)
+        poller = zigbee.XBeePoll()
+        poller.register(receiver, select.POLLIN)
+        self.assertEqual(poller.poll(0), [])
+        sender.sendto(b"hello", ("", 0xE9, 0xC105, 0x11))
+        events = poller.poll(1000)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][0], receiver.fileno())
+        self.assertTrue(events[0][1] & select.POLLIN)
+        receiver.recvfrom(100)
+        self.assertEqual(poller.poll(0), [])
+
+    def test_pollout(self):
+        sender = self.bind(0xE8)
+        other = self.bind(0xE9)
+        poller = zigbee.XBeePoll()
+        poller.register(sender, select.POLLOUT)
+        poller.register(other, select.POLLIN | select.POLLOUT)
+        # one Tx wakeup for the XBee, registered once
+        self.assertEqual(len(poller.tx_wakeups), 1)
+        self.assertEqual(dict(poller.poll(0)), {sender.fileno(): select.POLLOUT, other.fileno(): select.POLLOUT})
+        frame_ids = self.xbee.frame_ids
+        pending = [frame_ids.allocate(10, "[00:13:a2:00:40:00:00:%02x]!" % i) for i in range(zigbee.TX_WINDOW)]
+        self.assertEqual(poller.poll(100), [])
+        def release():
+            zigbee._global_lock.acquire()
+            try:
+                frame_ids.release(pending[0].frame_id)
+                self.xbee._tx_window_changed()
+            finally:
+                zigbee._global_lock.release()
+        timer = threading.Timer(0.1, release)
+        timer.start()
+        start = time.time()
+        self.assertEqual(dict(poller.poll(2000)), {sender.fileno(): select.POLLOUT, other.fileno(): select.POLLOUT})
+        self.assertTrue(time.time() - start < 1)
+        timer.join()
+        poller.modify(other, select.POLLIN)
+        self.assertEqual(len(poller.tx_wakeups), 1)
+        poller.unregister(sender)
+        self.assertEqual(poller.tx_wakeups, {})
+
+    def test_epoll(self):
+        if not hasattr(select, "epoll"):
+            return
+        sender = self.bind(0xE8)
+        receiver = self.bind(0xE9)
+        poller = zigbee.XBeeEPoll()
+        try:
+            poller.register(receiver, select.EPOLLIN | select.EPOLLOUT)
+            self.assertEqual(poller.poll(0), [(receiver.fileno(), select.EPOLLOUT)])
+            sender.sendto(b"hello", ("", 0xE9, 0xC105, 0x11))
+            self.assertEqual(poller.poll(1), [(receiver.fileno(), select.EPOLLIN | select.EPOLLOUT)])
+        finally:
+            poller.close()
+
+
+class Batch_Receive_Test(XBee_Test_Case):
+    destination = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE9, 0xC105, 0x11)
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.sender = self.bind(0xE8)
+        self.receiver = self.bind(0xE9)
+        self.receiver.setblocking(False)
+
+    def send(self, *payloads):
+        for payload in payloads:
+            self.sender.sendto(payload, ("", 0xE9, 0xC105, 0x11))
+
+    def test_recv_many(self):
+        self.assertEqual(self.receiver.recv_many(10), [])
+        self.send(b"one", b"two", b"three")
+        messages = self.receiver.recv_many(2, 4)
+        self.assertEqual([payload for payload, address in messages], [b"one", b"two"])
+        self.assertEqual(messages[0][1][:4], ("", 0xE8, 0xC105, 0x11))
+        self.assertEqual([payload for payload, address in self.receiver.recv_many(10, 4)], [b"thre"])
+
+    def test_recvfrom_into(self):
+        self.send(b"hello", b"world")
+        buffer = bytearray(3)
+        nbytes, address = self.receiver.recvfrom_into(buffer)
+        self.assertEqual((nbytes, bytes(buffer)), (3, b"hel"))
+        self.assertEqual(address[:4], ("", 0xE8, 0xC105, 0x11))
+        buffer = bytearray(10)
+        self.assertEqual(self.receiver.recvfrom_into(memoryview(buffer)[2:], 2)[0], 2)
+        self.assertEqual(bytes(buffer[:5]), b"\x00\x00wo\x00")
+        self.assertEqual(self.receiver.recvfrom_into(buffer), (0, None))
+
+    def test_sendto_buffers(self):
+        for payload in (bytearray(b"abc"), memoryview(b"xdefx")[1:4]):
+            self.assertEqual(self.sender.sendto(payload, self.destination), 3)
+        self.assertEqual(self.sender.sendto_many(bytearray(b"ghi"), [self.destination]), 1)
+        self.assertEqual([data[19:] for api_id, data in self.serial.tx_frames if api_id == 0x11],
+                         [b"abc", b"def", b"ghi"])
+        self.send(bytearray(b"local"))
+        self.assertEqual(self.receiver.recvfrom(100)[0], b"local")
+
+
+class Loopback_Test(XBee_Test_Case):
+
+    def test_loopback(self):
+        sender = self.bind(0xE8)
+        receiver = self.bind(0xE9)
+        self.assertEqual(sender.sendto(b"hello", ("", 0xE9, 0xC105, 0x11)), 5)
+        payload, address = receiver.recvfrom(100)
+        self.assertEqual(payload, b"hello")
+        self.assertEqual(address[:4], ("", 0xE8, 0xC105, 0x11))
+
+    def test_loopback_transaction_id(self):
+        sender = self.bind(0xE8)
+        receiver = self.bind(0xE9)
+        self.assertEqual(sender.sendto(b"hello", ("", 0xE9, 0xC105, 0x11, 0, 7)), 5)
+        self.assertEqual(receiver.recvfrom(100)[0], b"hello")
+        status, address = sender.recvfrom(100)
+        self.assertEqual(bytearray(status)[0], zigbee.ZigBee_Tx_Status_Data.rx_id)
+        tx_status = zigbee.ZigBee_Tx_Status_Data()
+        tx_status.extract(status[1:])
+        self.assertEqual(tx_status.delivery_status, zigbee.ZigBee_Tx_Status_Data.SUCCESS)
+        self.assertEqual(address, ("[00:00:00:00:00:00:00:00]!", 0xE8, 0xC105, 0x8B, 0, 7))
+        # only the payload counts as received bytes
+        self.assertEqual(self.xbee.rx_messages[0xE8].statistics.bytes_rx, 0)
+        self.assertEqual(self.xbee.rx_messages[0xE9].statistics.bytes_rx, 5)
+
+
+class Address_Cache_Test(XBee_Test_Case):
+    destination = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE9, 0xC105, 0x11)
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+        self.sender = self.bind(0xE8)
+
+    def send(self):
+        "Send to destination, returns the 16-bit address of the frame written once its Tx Status is handled"
+        self.sender.sendto(b"hello", self.destination)
+        self.assertTrue(self.wait_for(lambda: not self.xbee.frame_ids.in_flight))
+        return struct.unpack(">H", self.serial.tx_frames[-1][1][9:11])[0]
+
+    def test_tx_status(self):
+        cache = self.xbee.network_addresses
+        self.assertEqual(self.send(), 0xFFFE)
+        # the Tx Status reports the network address
+        self.assertEqual(cache.lookup(self.destination[0]), 0x1234)
+        self.assertEqual(self.send(), 0x1234)
+        self.serial.tx_status = zigbee.ZigBee_Tx_Status_Data.ADDRESS_NOT_FOUND
+        self.assertEqual(self.send(), 0x1234)
+        self.assertEqual(cache.lookup(self.destination[0]), zigbee.Network_Address_Cache.UNKNOWN)
+        self.assertEqual(self.send(), 0xFFFE)
+
+    def test_received(self):
+        self.serial.inject(0x91, b"\x00\x13\xa2\x00\x40\x0a\x0b\x0c\x56\x78\xe9\xe8\x00\x11\xc1\x05\x01hi")
+        cache = self.xbee.network_addresses
+        self.assertTrue(self.wait_for(lambda: cache.lookup(self.destination[0]) == 0x5678))
+        self.assertEqual(self.send(), 0x5678)
+
+    def test_limit(self):
+        cache = zigbee.Network_Address_Cache(2)
+        cache.learn("[00:13:a2:00:40:00:00:01]!", "[0001]!")
+        cache.learn("[00:13:a2:00:40:00:00:02]!", 2)
+        # broadcast and unknown addresses aren't cached
+        cache.learn("[00:00:00:00:00:00:ff:ff]!", 3)
+        cache.learn("[00:13:a2:00:40:00:00:04]!", 0xFFFE)
+        self.assertEqual(cache.lookup("[00:13:a2:00:40:00:00:02]!"), 2)
+        cache.learn("[00:13:a2:00:40:00:00:05]!", 5)
+        self.assertEqual(cache.lookup("[00:13:a2:00:40:00:00:01]!"), 0xFFFE)
+        self.assertEqual(cache.lookup("[00:13:a2:00:40:00:00:05]!"), 5)
+
+
+class Statistics_Test(XBee_Test_Case):
+    destination = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE9, 0xC105, 0x11)
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+
+    def statistic(self, sock, optname):
+        return sock.getsockopt(socket.XBS_SOL_ENDPOINT, optname)
+
+    def test_tx(self):
+        sender = self.bind(0xE8)
+        for i in range(2):
+            sender.sendto(b"hello", self.destination)
+        self.assertTrue(self.wait_for(lambda: not self.xbee.frame_ids.in_flight))
+        self.serial.tx_status = 0x21 # network ACK failure
+        sender.sendto(b"hi", self.destination)
+        self.assertTrue(self.wait_for(lambda: not self.xbee.frame_ids.in_flight))
+        self.serial.tx_status = 0x24 # address not found
+        sender.sendto(b"hi", self.destination)
+        self.assertTrue(self.wait_for(lambda: not self.xbee.frame_ids.in_flight))
+        self.assertEqual(self.statistic(sender, socket.XBS_SO_EP_FRAMES_TX), 4)
+        self.assertEqual(self.statistic(sender, socket.XBS_SO_EP_BYTES_TX), 14)
+        self.assertEqual(self.statistic(sender, socket.XBS_SO_EP_TX_FAILURES), 2)
+        statistics = sender.export_statistics()
+        self.assertEqual(statistics["tx_status_failures"], {0x21: 1, 0x24: 1})
+        latency = statistics["tx_status_latency"]
+        self.assertEqual(latency["count"], 4)
+        self.assertEqual(sum([count for bound, count in latency["buckets"]]), 4)
+        self.assertTrue(0 <= latency["average"] <= latency["maximum"] < 1)
+        self.assertEqual(statistics["rx_latency"]["count"], 0)
+
+    def test_rx(self):
+        receiver = self.bind(0xE8)
+        receiver.settimeout(2)
+        for payload in (b"abcd", b"efghij"):
+            self.serial.inject(0x91, struct.pack(">QH", 0x0013A2004001ABCD, 0x1234) + b"\xe9\xe8\x00\x11\xc1\x05\x01" +
+                               payload)
+        self.assertTrue(self.wait_for(lambda: self.statistic(receiver, socket.XBS_SO_EP_RCV_DEPTH) == 2))
+        self.assertEqual(self.statistic(receiver, socket.XBS_SO_EP_RCV_HIGH_WATER), 2)
+        self.assertEqual(receiver.recvfrom(100)[0], b"abcd")
+        self.assertEqual(self.statistic(receiver, socket.XBS_SO_EP_FRAMES_RX), 2)
+        self.assertEqual(self.statistic(receiver, socket.XBS_SO_EP_BYTES_RX), 10)
+        self.assertEqual(self.statistic(receiver, socket.XBS_SO_EP_RCV_DROPS), 0)
+        statistics = receiver.export_statistics()
+        self.assertEqual((statistics["frames_tx"], statistics["rcv_depth"]), (0, 1))
+        self.assertEqual(statistics["rx_latency"]["count"], 1)
+
+
+class Decoder_Test(unittest.TestCase):
+
+    def test_split_frames(self):
+        first = api_frame(0x8B, b"\x01\x12\x34\x00\x00\x00")
+        second = api_frame(0x88, b"\x02NI\x00node")
+        decoder = zigbee.API_Frame_Decoder()
+        decoder.feed(first[:3])
+        self.assertTrue(decoder.next_frame() is None)
+        decoder.feed(first[3:] + second[:-1])
+        self.assertEqual(decoder.next_frame(), first)
+        self.assertTrue(decoder.next_frame() is None)
+        decoder.feed(second[-1:])
+        self.assertEqual(decoder.next_frame(), second)
+        self.assertTrue(decoder.next_frame() is None)
+        self.assertEqual(len(decoder), 0)
+
+    def test_bad_checksum(self):
+        frame = api_frame(0x8B, b"\x01\x12\x34\x00\x00\x00")
+        bad = frame[:-1] + bytes(bytearray([bytearray(frame)[-1] ^ 1]))
+        decoder = zigbee.API_Frame_Decoder()
+        decoder.feed(b"noise" + bad + frame)
+        self.assertEqual(decoder.next_frame(), frame)
+        self.assertTrue(decoder.next_frame() is None)
+
+    def test_compact(self):
+        frame = api_frame(0x8B, b"\x01\x12\x34\x00\x00\x00")
+        decoder = zigbee.API_Frame_Decoder()
+        count = zigbee.API_Frame_Decoder.COMPACT_SIZE // len(frame) * 3
+        decoder.feed(frame * count + frame[:4])
+        for i in range(count):
+            self.assertEqual(decoder.next_frame(), frame)
+        self.assertEqual(len(decoder), 4)
+        self.assertTrue(len(decoder.buffer) < zigbee.API_Frame_Decoder.COMPACT_SIZE * 2)
+        decoder.feed(frame[4:])
+        self.assertEqual(decoder.next_frame(), frame)
+
+
+class Frame_ID_Pool_Test(unittest.TestCase):
+    destination = "[00:13:a2:00:40:0a:0b:0c]!"
+
+    def test_allocate(self):
+        pool = zigbee.Frame_ID_Pool()
+        frame_ids = [pool.allocate(10).frame_id for i in range(255)]
+        self.assertEqual(sorted(frame_ids), list(range(1, 256)))
+        self.assertRaises(Exception, pool.allocate, 10)
+        pool.release(7)
+        self.assertEqual(pool.allocate(10).frame_id, 7)
+
+    def test_in_flight(self):
+        pool = zigbee.Frame_ID_Pool()
+        first = pool.allocate(10, self.destination)
+        pool.allocate(10, self.destination)
+        pool.allocate(10)
+        self.assertEqual(pool.in_flight, 2)
+        self.assertEqual(pool.in_flight_to(self.destination), 2)
+        self.assertTrue(pool.release(first.frame_id) is first)
+        self.assertEqual(pool.in_flight, 1)
+        self.assertEqual(pool.in_flight_to(self.destination), 1)
+
+    def test_expire(self):
+        pool = zigbee.Frame_ID_Pool()
+        pool.allocate(-1, self.destination)
+        pool.allocate(10, self.destination)
+        self.assertTrue(pool.next_expiry() < time.time())
+        self.assertEqual(pool.expire_transmissions(), 1)
+        self.assertEqual(pool.in_flight_to(self.destination), 1)
+        self.assertEqual(len(pool), 1)
+
+
+class Send_Test(XBee_Test_Case):
+
+    def test_closed_port(self):
+        self.serial.open = False
+        message = zigbee.API_Message()
+        message.api_data = zigbee.Local_AT_Data(b"NI")
+        self.assertFalse(self.xbee.send_many([message]))
+        self.assertEqual(len(self.xbee.frame_ids), 0)
+        self.xbee.send_zb(0xE8, ("[00:13:a2:00:40:0a:0b:0c]!", 0xE8, 0xC105, 0x11), b"hello")
+        self.assertEqual(len(self.xbee.frame_ids), 0)
+        self.assertTrue(self.xbee.tx_window_open())
+
+
+class Endpoint_Queue_Test(unittest.TestCase):
+
+    def fill(self, queue, count):
+        zigbee._global_lock.acquire()
+        try:
+            return [queue.append((bytes(bytearray([i])), ("", 0xE8, 0, 0))) for i in range(count)]
+        finally:
+            zigbee._global_lock.release()
+
+    def test_drop_oldest(self):
+        queue = zigbee.Endpoint_Queue(3, zigbee.Endpoint_Queue.DROP_OLDEST)
+        self.assertEqual(self.fill(queue, 5), [True, True, True, False, False])
+        self.assertEqual([message[0] for message in queue.popmany(10)], [b"\x02", b"\x03", b"\x04"])
+        self.assertEqual((queue.drops, queue.high_water), (2, 3))
+        self.assertEqual(queue.statistics.frames_rx, 5)
+
+    def test_drop_newest(self):
+        queue = zigbee.Endpoint_Queue(3, zigbee.Endpoint_Queue.DROP_NEWEST)
+        self.assertEqual(self.fill(queue, 5), [True, True, True, False, False])
+        self.assertEqual(queue.popleft()[0], b"\x00")
+        self.assertEqual([message[0] for message in queue.popmany(1)], [b"\x01"])
+        self.assertEqual(len(queue), 1)
+        self.assertEqual((queue.drops, queue.high_water), (2, 3))
+
+    def test_no_limit(self):
+        queue = zigbee.Endpoint_Queue(0)
+        self.fill(queue, 50)
+        self.assertEqual((len(queue), queue.drops), (50, 0))
+
+
+class Tx_Window_Test(XBee_Test_Case):
+    destination = "[00:13:a2:00:40:0a:0b:0c]!"
+    other = "[00:13:a2:00:40:0a:0b:0d]!"
+
+    def test_destination_window(self):
+        frame_ids = self.xbee.frame_ids
+        pending = [frame_ids.allocate(10, self.destination) for i in range(zigbee.TX_DESTINATION_WINDOW)]
+        self.assertFalse(self.xbee.tx_window_open(self.destination))
+        self.assertTrue(self.xbee.tx_window_open(self.other))
+        self.assertTrue(self.xbee.tx_window_open())
+        frame_ids.release(pending[0].frame_id)
+        self.assertTrue(self.xbee.tx_window_open(self.destination))
+        self.assertFalse(self.xbee.tx_window_open(self.destination, queued_to_destination = 1))
+
+    def test_window(self):
+        frame_ids = self.xbee.frame_ids
+        for i in range(zigbee.TX_WINDOW - 1):
+            frame_ids.allocate(10, "[00:13:a2:00:40:00:00:%02x]!" % i)
+        self.assertTrue(self.xbee.tx_window_open(self.destination))
+        self.assertFalse(self.xbee.tx_window_open(self.destination, queued = 1))
+        frame_ids.allocate(10, self.other)
+        self.assertFalse(self.xbee.tx_window_open())
+
+    def test_overdue(self):
+        # a transmission whose Tx Status never arrived doesn't keep the window shut
+        for i in range(zigbee.TX_DESTINATION_WINDOW):
+            self.xbee.frame_ids.allocate(-1, self.destination)
+        self.assertTrue(self.xbee.tx_window_open(self.destination))
+        self.assertEqual(self.xbee.frame_ids.in_flight, 0)
+
+
+class DDO_Cache_Test(unittest.TestCase):
+    remote = "[00:13:a2:00:40:0a:0b:0c]!"
+
+    def test_ttl(self):
+        cache = zigbee.DDO_Cache({b"SH": None, b"MY": 0.1, b"NI": 0})
+        for address in (None, self.remote):
+            cache.store(address, "SH", b"\x00\x13\xa2\x00")
+            cache.store(address, "my", b"\x12\x34")
+            cache.store(address, "NI", b"node")
+            cache.store(address, "D0", b"\x04")
+        self.assertEqual(cache.get(self.remote, b"MY"), b"\x12\x34")
+        # parameters with no time to live, or not listed, are always read
+        self.assertTrue(cache.get(self.remote, "NI") is None)
+        self.assertTrue(cache.get(self.remote, "D0") is None)
+        time.sleep(0.15)
+        self.assertTrue(cache.get(None, "MY") is None)
+        self.assertTrue(cache.get(self.remote, "MY") is None)
+        self.assertEqual(cache.get(self.remote, "SH"), b"\x00\x13\xa2\x00")
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+    def test_invalidate(self):
+        cache = zigbee.DDO_Cache({b"SH": None, b"SL": None})
+        for address in (None, self.remote):
+            cache.store(address, "SH", b"\x00\x13\xa2\x00")
+            cache.store(address, "SL", b"\x40\x0a\x0b\x0c")
+        cache.invalidate(self.remote, "SL")
+        self.assertTrue(cache.get(self.remote, "SL") is None)
+        self.assertEqual(cache.get(self.remote, "SH"), b"\x00\x13\xa2\x00")
+        cache.invalidate(self.remote)
+        self.assertTrue(cache.get(self.remote, "SH") is None)
+        self.assertEqual(cache.get(None, "SL"), b"\x40\x0a\x0b\x0c")
+        cache.clear()
+        self.assertTrue(cache.get(None, "SL") is None)
+
+
+class Timer_Wheel_Test(unittest.TestCase):
+
+    def test_expiry(self):
+        wheel = zigbee.Timer_Wheel(0.1, 8)
+        start = wheel.tick * wheel.resolution
+        called = []
+        wheel.schedule(start + 0.25, lambda: called.append("soon"))
+        wheel.schedule(start + 5, lambda: called.append("later"))
+        cancelled = wheel.schedule(start + 0.25, lambda: called.append("cancelled"))
+        self.assertEqual(len(wheel), 3)
+        cancelled.cancel()
+        self.assertEqual(len(wheel), 2)
+        self.assertEqual(wheel.advance(start + 0.15), 0)
+        self.assertEqual(wheel.advance(start + 0.35), 1)
+        self.assertEqual(called, ["soon"])
+        # more than one turn of the wheel later
+        self.assertEqual(wheel.advance(start + 2), 0)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(start + 5.05), 1)
+        self.assertEqual(called, ["soon", "later"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_past_deadline(self):
+        wheel = zigbee.Timer_Wheel(0.1, 8)
+        start = wheel.tick * wheel.resolution
+        called = []
+        wheel.schedule(start - 10, lambda: called.append("late"))
+        self.assertEqual(wheel.advance(start + 0.15), 1)
+        self.assertEqual(called, ["late"])
+
+    def test_callback_exception(self):
+        wheel = zigbee.Timer_Wheel(0.1, 8)
+        start = wheel.tick * wheel.resolution
+        called = []
+        wheel.schedule(start + 0.1, lambda: 1 / 0)
+        wheel.schedule(start + 0.1, lambda: called.append("after"))
+        self.assertEqual(wheel.advance(start + 0.25), 2)
+        self.assertEqual(called, ["after"])
+
+
+class ZDO_Conversation_Test(XBee_Test_Case):
+    router = "[00:13:a2:00:40:0a:0b:0c]!"
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.1
+        self.xbee.start_reader()
+        self.client = zigbee.ZDO_Mgmt_Lqi_cluster_client(self.xbee)
+        self.responses = []
+        self.timeouts = []
+
+    def send(self, address):
+        zigbee._global_lock.acquire()
+        try:
+            return self.client.send_command(address, 0, lambda conversation, frame, response:
+                                            self.responses.append(conversation),
+                                            self.timeouts.append, 5)
+        finally:
+            zigbee._global_lock.release()
+
+    def respond(self, address, transaction_sequence_number):
+        frame = zigbee.ZDO_Frame(bytes(bytearray([transaction_sequence_number, 0, 0, 0, 0])),
+                                 (address, 0, 0, 0x8031))
+        return self.client.handle_message(frame)
+
+    def test_response(self):
+        conversation = self.send(self.router)
+        transaction_sequence_number = conversation.frame.transaction_sequence_number
+        self.assertEqual(conversation.key(), (self.router, transaction_sequence_number))
+        # the same sequence number from another node isn't a response
+        self.assertFalse(self.respond("[00:13:a2:00:40:0a:0b:0d]!", transaction_sequence_number))
+        self.assertTrue(self.respond(self.router, transaction_sequence_number))
+        self.assertEqual(self.responses, [conversation])
+        self.assertFalse(self.client.conversations)
+        self.assertTrue(conversation.timer.cancelled)
+
+    def test_timeout(self):
+        conversation = self.send(self.router)
+        zigbee._global_lock.acquire()
+        try:
+            self.xbee.timers.advance(time.time() + 10)
+        finally:
+            zigbee._global_lock.release()
+        self.assertEqual(self.timeouts, [conversation])
+        self.assertFalse(self.client.conversations)
+        self.assertFalse(self.respond(self.router, conversation.frame.transaction_sequence_number))
+
+    def test_sequence_number_reused(self):
+        first = self.send(self.router)
+        other = self.send("[00:13:a2:00:40:0a:0b:0d]!")
+        self.client.sequence_number = first.frame.transaction_sequence_number - 1
+        second = self.send(self.router)
+        # the conversation that was never answered times out
+        self.assertEqual(self.timeouts, [first])
+        self.assertEqual(len(self.client.conversations), 2)
+        self.assertTrue(self.respond(self.router, second.frame.transaction_sequence_number))
+        self.assertEqual(self.responses, [second])
+        self.assertTrue(other.key() in self.client.conversations)
+
+
+class Address_Test(unittest.TestCase):
+
+    def test_extended(self):
+        address = zigbee.MAC_to_address_string(0x0013A2004001ABCD)
+        self.assertEqual(address, "[00:13:a2:00:40:01:ab:cd]!")
+        self.assertTrue(zigbee.MAC_to_address_string(0x0013A2004001ABCD) is address)
+        self.assertEqual(zigbee.address_string_to_MAC(address), 0x0013A2004001ABCD)
+        self.assertEqual(zigbee.address_string_to_MAC("[00:13:a2:00:40:01:ab:cd]!"), 0x0013A2004001ABCD)
+        self.assertEqual(zigbee.MAC_to_address_string(0x0102, 2), "[01:02]!")
+
+    def test_short(self):
+        address = zigbee.short_to_address_string(0x1234)
+        self.assertEqual(address, "[1234]!")
+        self.assertTrue(zigbee.short_to_address_string(0x1234) is address)
+        self.assertEqual(zigbee.address_string_to_short(address), 0x1234)
+        self.assertEqual(zigbee.address_string_to_short("[ABCD]!"), 0xABCD)
+
+
+def tearDownModule():
+    shutil.rmtree(_test_dir, True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# Tests for zigbee_asyncio.py (Python 3 only), see test_zigbee.py.  Run from
+# this directory with:
+#
+#    python3 -m unittest test_zigbee_asyncio
+
+import asyncio
+import unittest
+
+from test_zigbee import XBee_Test_Case, zigbee
+import zigbee_asyncio
+
+
+class Datagram_Endpoint_Test(XBee_Test_Case):
+    destination = ("[00:13:a2:00:40:0a:0b:0c]!", 0xE9, 0xC105, 0x11)
+
+    def setUp(self):
+        XBee_Test_Case.setUp(self)
+        self.serial.timeout = 0.05
+        self.xbee.start_reader()
+
+    def test_datagram_received(self):
+        asyncio.run(self.datagram_received())
+
+    async def datagram_received(self):
+        received = asyncio.get_running_loop().create_future()
+        class Protocol(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                received.set_result((data, addr))
+        transport, protocol = await zigbee_asyncio.create_xbee_datagram_endpoint(Protocol, ("", 0xE8, 0, 0),
+                                                                                 xbee = self.xbee)
+        try:
+            self.serial.inject(0x91, b"\x00\x13\xa2\x00\x40\x01\xab\xcd\x12\x34\xe9\xe8\x00\x11\xc1\x05\x01hello")
+            data, addr = await asyncio.wait_for(received, 2)
+            self.assertEqual(data, b"hello")
+            self.assertEqual(addr[:4], ("[00:13:a2:00:40:01:ab:cd]!", 0xE9, 0xC105, 0x11))
+        finally:
+            transport.close()
+            await asyncio.sleep(0)
+
+    def test_pause_writing(self):
+        asyncio.run(self.pause_writing())
+
+    async def pause_writing(self):
+        events = []
+        class Protocol(asyncio.DatagramProtocol):
+            def pause_writing(self):
+                events.append("pause")
+            def resume_writing(self):
+                events.append("resume")
+        transport, protocol = await zigbee_asyncio.create_xbee_datagram_endpoint(Protocol, ("", 0xE8, 0, 0),
+                                                                                 self.destination, self.xbee)
+        try:
+            transport.HIGH_WATER = 4
+            transport.LOW_WATER = 1
+            # no Tx Status arrives, the destination's window fills up
+            self.serial.reply = False
+            for i in range(7):
+                transport.sendto(b"%d" % i)
+            self.assertEqual(events, ["pause"])
+            self.assertEqual(transport.get_write_buffer_size(), 7 - zigbee.TX_DESTINATION_WINDOW)
+            self.serial.reply = True
+            for api_id, data in list(self.serial.tx_frames):
+                if api_id == 0x11:
+                    self.serial.inject(0x8B, data[0:1] + b"\x12\x34\x00\x00\x00")
+            for i in range(100):
+                if not transport.get_write_buffer_size():
+                    break
+                await asyncio.sleep(0.02)
+            self.assertEqual(transport.get_write_buffer_size(), 0)
+            self.assertEqual(events, ["pause", "resume"])
+            self.assertEqual([data[19:] for api_id, data in self.serial.tx_frames if api_id == 0x11],
+                             [b"%d" % i for i in range(7)])
+        finally:
+            transport.close()
+            await asyncio.sleep(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
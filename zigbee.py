@@ -23,25 +23,27 @@
 # Limitations:
 # Must import zigbee before doing either "from socket import *" or "from select import *"
 # Must import zigbee to use zigbee socket.
-# Must import zigbee to use zigbee select.
+# Must import zigbee to use zigbee select, poll or epoll.
 # Zigbee socket options not support (except non_blocking)
 # Incomplete error checking.
 # Anything else not implemented from the TODO list below.
 
 # TODO List:
-#    Add socket options (mostly counters needed).
-#    Check message size before sending (could split into multiple messages).
 #    Add more error checking and match ConnectPort errors
-#    Support for blocking calls for sendto
 #    Add new parameters to getnodelist, ddo_get_param, ddo_set_param
 
 import struct
-import string
 import time
+import errno
+import collections
 import socket
 import select
 import logging
-from threading import RLock
+import threading
+import json
+import os
+import random
+from threading import RLock, Condition
 
 # set up logger
 logger = logging.getLogger("cp4pc.xbee")
@@ -50,8 +52,105 @@ logger.setLevel(logging.INFO)
 MESH_TRACEBACK = False
 "Set this to true to enable printing of all ZigBee traffic"
 
+SERIAL_READ_TIMEOUT = 0.1
+"Seconds the reader thread blocks in a serial read, bounds how long it takes to notice the port closing"
+SERIAL_POLL_TIME = 0.01
+"Seconds between serial port polls while waiting for a response without a reader thread"
+FRAME_TIMEOUT = 10
+"Seconds a frame ID is reserved for a response, unless the sender gives a timeout"
+TX_WINDOW = 8
+"Transmissions that may wait on their Tx Status at once, per XBee"
+TX_DESTINATION_WINDOW = 2
+"Transmissions that may wait on their Tx Status at once, per destination address"
+TX_STATUS_TIMEOUT = 5
+"Seconds a transmission holds its place in the Tx windows if its Tx Status never arrives"
+DEFAULT_MAX_PAYLOAD = 84
+"Payload bytes that fit in one ZigBee frame, used if the XBee doesn't report NP"
+FRAGMENT_RETRIES = 3
+"Times a fragment of a message is sent again before the message is given up on"
+FRAGMENT_TIMEOUT = 10
+"Seconds a partly received message is kept waiting for its missing fragments"
+FRAGMENT_BUFFERS = 8
+"Partly received messages kept per endpoint, the oldest is dropped to make room"
+FRAGMENT_COMPLETED = 32
+"""Messages completed recently that are remembered per endpoint, for
+FRAGMENT_TIMEOUT, so fragments of them that are sent again are ignored"""
+DDO_CACHE_TTL = {b"SH": None, b"SL": None, b"HV": None, b"VR": None, b"NP": None,
+                 b"MY": 10, b"MP": 10, b"NI": 60, b"NT": 60}
+"""Seconds values read with ddo_get_param are cached, by AT command (None to
+keep them until the XBee resets).  Parameters not listed are always read."""
+NODE_TABLE_FILE = "nodes.json"
+"Name of the file, next to settings.json, the node table of the default XBee is saved to"
+NODE_MAX_AGE = 24 * 60 * 60
+"Seconds after which a node that hasn't been heard from is removed from the node table"
+LQI_DISCOVERY_TIME = 3 #NOTE: used to be 6.625 (as measured on CPX2)
+"Seconds a ZigBee node discovery waits for the neighbor tables of the nodes"
+TOPOLOGY_MAX_AGE = 300
+"Seconds the neighbor table read from a router is current, older ones are read again, every TOPOLOGY_MAX_AGE seconds"
+LQI_QUERY_LIMIT = 4
+"Most neighbor tables (Mgmt_Lqi_req conversations) read at a time"
+LQI_QUERY_TIMEOUT = 10
+"Seconds to wait for each page of a neighbor table"
+TIMER_RESOLUTION = 0.1
+"Seconds per slot of the timer wheel of an XBee"
+TIMER_SLOTS = 256
+"Slots of the timer wheel of an XBee, timers further away than a turn of the wheel wait in their slot"
+DDO_BATCH_LIMIT = 16
+"Most AT requests a DDO_Batch has waiting for their response"
+DDO_BATCH_NODE_LIMIT = 1
+"Most AT requests a DDO_Batch has waiting for their response from each node"
+DDO_BATCH_RATE = 20
+"AT requests per second a DDO_Batch sends (None for no limit)"
+DDO_BATCH_RETRIES = 2
+"Times a DDO_Batch resends a request that timed out or could not be delivered"
+DDO_BATCH_TIMEOUT = 3
+"Seconds a DDO_Batch waits for the response to a request"
+
+# Python 2 and 3 compatibility.  Frames, payloads and DDO values are byte
+# strings (str on Python 2, bytes on Python 3), addresses are native strings.
+try:
+    long
+except NameError:
+    long = int
+STRING_TYPES = (str, bytes)
+"Types accepted for DDO command names and values"
+_BYTE = struct.Struct(">B")
+"A single unsigned byte, used to build and parse frames"
+
+def _to_bytes(value):
+    "Encode a native string, like the AT command name \"NI\", to a byte string"
+    if not isinstance(value, bytes):
+        return value.encode("latin-1")
+    return value
+
+def _payload_bytes(data):
+    "Copy a bytearray or memoryview payload to a byte string, byte strings are returned as is"
+    if isinstance(data, bytes):
+        return data
+    if isinstance(data, bytearray):
+        return bytes(data)
+    return data.tobytes()
+
+def _ddo_value(value):
+    "Convert a DDO parameter value to a byte string, integers are big endian and None is empty"
+    if value is None:
+        return b""
+    if isinstance(value, int) or isinstance(value, long):
+        value_str = b""
+        # convert to big endian string representation
+        while value > 0:
+            value_str = _BYTE.pack(value & 0xFF) + value_str
+            value >>= 8
+        if value_str == b"":
+            # default to zero
+            value_str = b"\x00"
+        return value_str
+    return _to_bytes(value)
+
 # set parameters
-__all__ = ["ddo_get_param", "ddo_set_param", "getnodelist", "get_node_list", "register_joining_device"]
+__all__ = ["ddo_get_param", "ddo_set_param", "getnodelist", "get_node_list", "register_joining_device",
+           "ddo_get_param_async", "ddo_set_param_async", "ddo_command_async", "ddo_get_params", "ddo_set_params",
+           "ddo_batch", "discover_nodes"]
 
 # Globals
 "Set this to function that accepts string to get passed MESH_TRACEBACK data"
@@ -72,37 +171,91 @@ def __register_with_socket_module(object_name):
         # there is no __all__ defined for socket object
         pass
 
+class XBeeAddress(str):
+    """An address string in the "[xx:xx:xx:xx:xx:xx:xx:xx]!" or "[XXXX]!" format
+    that also carries the integer value of the address.
+    
+    Being a str, it can be used anywhere the address strings of the socket
+    address tuples are used.  Instances are interned by MAC_to_address_string
+    and short_to_address_string, so the string form of an address is only
+    built the first time it is seen, and converting it back to an integer
+    for transmitting is an attribute lookup."""
+
+    def __new__(cls, address_string, value, num_bytes):
+        self = str.__new__(cls, address_string)
+        self.value = value
+        "Integer value of the address"
+        self.num_bytes = num_bytes
+        "Number of bytes in the address (8 for extended, 2 for short)"
+        return self
+
+ADDRESS_CACHE_SIZE = 4096
+"Maximum number of addresses of each kind that are interned"
+_extended_addresses = {}
+"Interned extended addresses, key = 64-bit address, value = XBeeAddress"
+_short_addresses = {}
+"Interned short addresses, key = 16-bit address, value = XBeeAddress"
+_address_values = {}
+"Parsed values of address strings given by the user, key = string, value = address"
+
+def _intern_address(cache, value, address):
+    "Add address to one of the bounded address caches"
+    if len(cache) >= ADDRESS_CACHE_SIZE:
+        # keep the memory used bounded, start over
+        cache.clear()
+    cache[value] = address
+    return address
+
 def MAC_to_address_string(MAC_address, num_bytes = 8):
     """Convert a MAC address to a string with "[" and "]" """
-    address_string = "["
-    for index in range(num_bytes - 1, -1, -1):
-        address_string += string.hexdigits[0xF & (MAC_address >> (index * 8 + 4))]
-        address_string += string.hexdigits[0xF & (MAC_address >> (index * 8))]
-        if index:
-            address_string += ":"
-        else:
-            address_string += "]!"
-    return address_string
+    if num_bytes == 8:
+        address = _extended_addresses.get(MAC_address)
+        if address is None:
+            digits = "%016x" % MAC_address
+            address = _intern_address(_extended_addresses, MAC_address,
+                                      XBeeAddress("[%s]!" % ":".join([digits[index:index + 2] for index in range(0, 16, 2)]),
+                                                  MAC_address, 8))
+        return address
+    digits = "%0*x" % (num_bytes * 2, MAC_address & ((1 << (num_bytes * 8)) - 1))
+    return XBeeAddress("[%s]!" % ":".join([digits[index:index + 2] for index in range(0, num_bytes * 2, 2)]),
+                       MAC_address, num_bytes)
         
 def address_string_to_MAC(address_string):
     "Convert an address string to a MAC address"
-    if address_string[0] == "[":
-        return int("0x" + string.replace(address_string[1:-2], ":", ""), 16)
-    else:
-        return int("0x" + string.replace(address_string[0:-1], ":", ""), 16)
+    if isinstance(address_string, XBeeAddress):
+        return address_string.value
+    MAC_address = _address_values.get(address_string)
+    if MAC_address is None:
+        if address_string[0] == "[":
+            MAC_address = int(address_string[1:-2].replace(":", ""), 16)
+        else:
+            MAC_address = int(address_string[0:-1].replace(":", ""), 16)
+        _intern_address(_address_values, address_string, MAC_address)
+    return MAC_address
         
 def short_to_address_string(short_address):
     "Convert a short (network) address to a string"
-    return "[%02X%02X]!" % ((short_address >> 8) & 0xFF, short_address & 0xFF)    
+    address = _short_addresses.get(short_address)
+    if address is None:
+        address = _intern_address(_short_addresses, short_address,
+                                  XBeeAddress("[%04X]!" % (short_address & 0xFFFF), short_address, 2))
+    return address
     
 def address_string_to_short(address_string):
     "Convert an address string to a short (network) address"
-    return int("0x" + address_string[1:-2], 16)
+    if isinstance(address_string, XBeeAddress):
+        return address_string.value
+    return int(address_string[1:-2], 16)
 
 
-class API_Data:
+class API_Data(object):
     """Base class for storing data in an API message
-    Also stores a static frame ID for different messages to use."""
+    Also stores a static frame ID for different messages to use.
+    
+    Subclasses list their attributes in __slots__ so that the frame objects
+    created for every received message don't each carry a __dict__, and
+    keep the layout of their fixed size fields in a precompiled struct.Struct."""
+    __slots__ = ("data", "frame_id")
 
     xbee_frame_id = 1
     "Frame ID for transmitting to the XBee node"
@@ -113,12 +266,13 @@ class API_Data:
 
     def __init__(self):
         "Creates API_Data object"
-        self.data = ""
+        self.data = b""
         self.frame_id = 0
 
     @staticmethod
     def next_frame():
-        "Returns the next frame ID for sending a message"
+        """Returns the next frame ID for sending a message, used for frames that
+        weren't given an ID by the Frame_ID_Pool of an XBee"""
         API_Data.xbee_frame_id += 1
         if API_Data.xbee_frame_id >= 256:
             API_Data.xbee_frame_id = 1
@@ -135,14 +289,19 @@ class API_Data:
 
 class IEEE_802_15_4_64_Data(API_Data):
     "Extracts an 802.15.4 frame from the XBee Rx message and outputs a XBee transmit frame."
+    __slots__ = ("source_address", "destination_address", "payload", "rssi")
     BROADCAST_RADIUS = 0
     "Number of hops on the XBee network."
     rx_id = 0x80
     "Receive API message type ID"
     tx_id = 0x00
     "Transmit API message type ID"
+    rx_format = struct.Struct(">QBB")
+    "source_address_64, rssi, options"
+    tx_format = struct.Struct(">BQB")
+    "frame_id, destination_address_64, options"
     
-    def __init__(self, source_address = None, destination_address = None, payload = ""):
+    def __init__(self, source_address = None, destination_address = None, payload = b""):
         "Initializes the zb_data with no data."
         API_Data.__init__(self)        
         self.source_address = source_address
@@ -154,9 +313,9 @@ class IEEE_802_15_4_64_Data(API_Data):
         "Extract a XBee message from a 0x80 XBee frame cmd_data"
         if len(cmd_data) < 10:
             #Message too small, return error
-            logger.warn("Malformed message - too small")
+            logger.warning("Malformed message - too small")
             return -1
-        source_address_64, self.rssi, options = struct.unpack(">QBB", cmd_data[:10])
+        source_address_64, self.rssi, options = self.rx_format.unpack_from(cmd_data)
         self.payload = cmd_data[10:]
         # use the device's EUI address
         address_string = MAC_to_address_string(source_address_64)            
@@ -168,27 +327,32 @@ class IEEE_802_15_4_64_Data(API_Data):
         
     def export(self):
         "Export a XBee message as a 0x00 XBee frame cmd_data"
-        self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id) #frame id
-        cmd_data += struct.pack(">Q", address_string_to_MAC(self.destination_address[0])) # destination_address_64
+        if not self.frame_id:
+            self.frame_id = self.next_frame()
         if len(self.destination_address) > 4:
-            cmd_data += chr(self.destination_address[4])
+            options = self.destination_address[4]
         else:
-            cmd_data += chr(0) # default to no options
-        cmd_data += self.payload
-        return cmd_data
+            options = 0 # default to no options
+        return self.tx_format.pack(self.frame_id,
+                                   address_string_to_MAC(self.destination_address[0]), # destination_address_64
+                                   options) + self.payload
 
 
 class IEEE_802_15_4_16_Data(API_Data):
     "Extracts an 802.15.4 frame from the XBee Rx message and outputs a XBee transmit frame."
+    __slots__ = ("source_address", "destination_address", "payload", "rssi")
     BROADCAST_RADIUS = 0
     "Number of hops on the XBee network."
     rx_id = 0x81
     "Receive API message type ID"
     tx_id = 0x01
     "Transmit API message type ID"
+    rx_format = struct.Struct(">HBB")
+    "source_address_16, rssi, options"
+    tx_format = struct.Struct(">BHB")
+    "frame_id, destination_address_16, options"
     
-    def __init__(self, source_address = None, destination_address = None, payload = ""):
+    def __init__(self, source_address = None, destination_address = None, payload = b""):
         "Initializes the zb_data with no data."
         API_Data.__init__(self)        
         self.source_address = source_address
@@ -200,9 +364,9 @@ class IEEE_802_15_4_16_Data(API_Data):
         "Extract a XBee message from a 0x81 XBee frame cmd_data"
         if len(cmd_data) < 4:
             #Message too small, return error
-            logger.warn("Malformed message - too small")
+            logger.warning("Malformed message - too small")
             return -1
-        source_address_16, self.rssi, options = struct.unpack(">HBB", cmd_data[:4])
+        source_address_16, self.rssi, options = self.rx_format.unpack_from(cmd_data)
         self.payload = cmd_data[4:]
         # use the device's short address
         address_string = short_to_address_string(source_address_16)            
@@ -214,42 +378,53 @@ class IEEE_802_15_4_16_Data(API_Data):
         
     def export(self):
         "Export a XBee message as a 0x01 XBee frame cmd_data"
-        self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id) #frame id
-        cmd_data += struct.pack(">H", address_string_to_short(self.destination_address[0])) # destination_address_16
+        if not self.frame_id:
+            self.frame_id = self.next_frame()
         if len(self.destination_address) > 4:
-            cmd_data += chr(self.destination_address[4])
+            options = self.destination_address[4]
         else:
-            cmd_data += chr(0) # default to no options
-        cmd_data += self.payload
-        return cmd_data
+            options = 0 # default to no options
+        return self.tx_format.pack(self.frame_id,
+                                   address_string_to_short(self.destination_address[0]), # destination_address_16
+                                   options) + self.payload
 
 
 class ZB_Data(API_Data):
     "Extracts a ZigBee frame from the XBee Rx message and outputs a XBee transmit frame."
+    __slots__ = ("source_address", "destination_address", "payload", "source_address_16", "destination_address_16")
     BROADCAST_RADIUS = 0
     "Number of hops on the XBee network."
     rx_id = 0x91
     "Receive API message type ID"
     tx_id = 0x11
     "Transmit API message type ID"
+    rx_format = struct.Struct(">QHBBHHB")
+    "source_address_64, source_address_16, source_endpoint, destination_endpoint, cluster_id, profile_id, options"
+    tx_format = struct.Struct(">BQHBBHHBB")
+    """frame_id, destination_address_64, destination_address_16, source_endpoint,
+    destination_endpoint, cluster_id, profile_id, broadcast_radius, options"""
     
-    def __init__(self, source_address = None, destination_address = None, payload = ""):
+    def __init__(self, source_address = None, destination_address = None, payload = b""):
         "Initializes the zb_data with no data."
         API_Data.__init__(self)        
         self.source_address = source_address
         self.destination_address = destination_address
         self.payload = payload
+        self.source_address_16 = 0xFFFE
+        "Network address of the sender of a received message"
+        self.destination_address_16 = 0xFFFE
+        "Network address to send to when the destination is an extended address, 0xFFFE if unknown"
 
     def extract(self, cmd_data):
         "Extract a XBee message from a 0x91 XBee frame cmd_data"
         if len(cmd_data) < 17:
             #Message too small, return error
-            logger.warn("Malformed message - too small")
+            logger.warning("Malformed message - too small")
             return -1
         source_address_64, source_address_16, source_endpoint, destination_endpoint, \
-            cluster_id, profile_id, options = struct.unpack(">QHBBHHB", cmd_data[:17])
+            cluster_id, profile_id, options = self.rx_format.unpack_from(cmd_data)
         self.payload = cmd_data[17:]
+        self.source_address_16 = source_address_16
         if source_address_64 == 0xFFFFFFFFFFFFFFFF:
             # only short address information available
             address_string = short_to_address_string(source_address_16)
@@ -265,35 +440,41 @@ class ZB_Data(API_Data):
         
     def export(self):
         "Export a XBee message as a 0x11 XBee frame cmd_data"
-        self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id) #frame id
+        if not self.frame_id:
+            self.frame_id = self.next_frame()
         if len(self.destination_address[0]) == 7: # [XXXX]! short address
-            cmd_data += struct.pack(">Q", 0xFFFFFFFFFFFFFFFF)
-            cmd_data += struct.pack(">H", address_string_to_short(self.destination_address[0]))
+            destination_address_64 = 0xFFFFFFFFFFFFFFFF
+            destination_address_16 = address_string_to_short(self.destination_address[0])
         else: # long address
-            cmd_data += struct.pack(">Q", address_string_to_MAC(self.destination_address[0])) # destination_address_64
-            # TTDO: should set to last know short address to improve performance
-            cmd_data += chr(0xFF) + chr(0xFE) # destination_address_16
-        cmd_data += struct.pack(">BBHHB", self.source_address[1], # source_endpoint
-                                          self.destination_address[1],# destination_endpoint
-                                          self.destination_address[3], # cluster_id
-                                          self.destination_address[2], # profile_id
-                                          self.BROADCAST_RADIUS) # broadcast radius
+            destination_address_64 = address_string_to_MAC(self.destination_address[0])
+            # the last known network address saves the XBee an address discovery
+            destination_address_16 = self.destination_address_16
         if len(self.destination_address) > 4:
-            cmd_data += chr(self.destination_address[4])
+            options = self.destination_address[4]
         else:
-            cmd_data += chr(0) # default to no options
-        cmd_data += self.payload
-        return cmd_data
+            options = 0 # default to no options
+        return self.tx_format.pack(self.frame_id,
+                                   destination_address_64,
+                                   destination_address_16,
+                                   self.source_address[1], # source_endpoint
+                                   self.destination_address[1],# destination_endpoint
+                                   self.destination_address[3], # cluster_id
+                                   self.destination_address[2], # profile_id
+                                   self.BROADCAST_RADIUS, # broadcast radius
+                                   options) + self.payload
     
 
 class Local_AT_Data(API_Data):
     "Extracts from an AT Response frame and exports to an AT Command frame."
+    __slots__ = ("AT_cmd", "status", "value")
     rx_id = 0x88
     "Receive API message type ID"
     tx_id = 0x08
     "Transmit API message type ID"
-    def __init__(self, AT_cmd = "", value = ""):
+    rx_format = struct.Struct(">B2sB")
+    "frame_id, AT_cmd, status"
+
+    def __init__(self, AT_cmd = b"", value = b""):
         API_Data.__init__(self)
         "Initializes the AT frame with no data."
         self.AT_cmd = AT_cmd
@@ -308,28 +489,39 @@ class Local_AT_Data(API_Data):
         if len(cmd_data) < 4:
             #Message too small, return error
             return -1
-        self.frame_id = ord(cmd_data[0])
-        self.AT_cmd = cmd_data[1:3]
-        self.status = ord(cmd_data[3])
+        self.frame_id, self.AT_cmd, self.status = self.rx_format.unpack_from(cmd_data)
         self.value = cmd_data[4:] #NOTE: some messages have no value
         return 0
         
     def export(self):
         "Export an AT message as a 0x08 xbee frame cmd_data"
-        self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id)
-        cmd_data += self.AT_cmd
-        cmd_data += self.value
-        return cmd_data
+        if not self.frame_id:
+            self.frame_id = self.next_frame()
+        return _BYTE.pack(self.frame_id) + self.AT_cmd + self.value
+
+
+class Local_AT_Queue_Data(Local_AT_Data):
+    """Exports to an AT Command - Queue Parameter Value frame, the value is
+    applied by a later AC (or any AT Command frame).  Responses are
+    Local_AT_Data."""
+    __slots__ = ()
+    tx_id = 0x09
+    "Transmit API message type ID"
 
 
 class Remote_AT_Data(API_Data):
     "Extracts from a Remote AT Response frame and exports to a Remote AT Command frame."
+    __slots__ = ("remote_address", "AT_cmd", "status", "value", "apply")
     rx_id = 0x97
     "Receive API message type ID"
     tx_id = 0x17
     "Transmit API message type ID"
-    def __init__(self, remote_address = None, AT_cmd = "", value = ""):
+    rx_format = struct.Struct(">BQH2sB")
+    "frame_id, source_address_64, source_address_16, AT_cmd, status"
+    tx_format = struct.Struct(">BQHB")
+    "frame_id, destination_address_64, destination_address_16, command options"
+
+    def __init__(self, remote_address = None, AT_cmd = b"", value = b"", apply = True):
         API_Data.__init__(self)
         "Initializes the AT frame with no data."
         self.remote_address = remote_address
@@ -340,42 +532,46 @@ class Remote_AT_Data(API_Data):
         "Status of a received message"
         self.value = value
         "Value received or to be set for the AT command"
+        self.apply = apply
+        "Apply changes right away, otherwise they are queued until an AC"
 
     def extract(self, cmd_data):
         "Extract a remote AT response message from a 0x97 xbee frame cmd_data"
         if len(cmd_data) < 14: #TODO: make sure this is the right number.
             #Message too small, return error
             return -1
-        self.frame_id, source_address_64, source_address_16 = struct.unpack(">BQH", cmd_data[:11])
+        self.frame_id, source_address_64, source_address_16, self.AT_cmd, self.status = self.rx_format.unpack_from(cmd_data)
         self.remote_address = MAC_to_address_string(source_address_64)
-        self.AT_cmd = cmd_data[11:13]
-        self.status = ord(cmd_data[13])
         self.value = cmd_data[14:] #NOTE: some messages have no value
         return 0
         
     def export(self):
         "Export a remote AT message as a 0x17 xbee frame cmd_data"
-        self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id)
-        cmd_data += struct.pack(">Q", address_string_to_MAC(self.remote_address)) # destination_address_64
-        cmd_data += chr(0xFF) + chr(0xFE) # destination_address_16
-        cmd_data += chr(0x02) # Command Options (Always set immediately)        
-        cmd_data += self.AT_cmd
-        cmd_data += self.value
-        return cmd_data
+        if not self.frame_id:
+            self.frame_id = self.next_frame()
+        return self.tx_format.pack(self.frame_id,
+                                   address_string_to_MAC(self.remote_address), # destination_address_64
+                                   0xFFFE, # destination_address_16
+                                   0x02 if self.apply else 0x00 # Command Options (apply changes)
+                                   ) + self.AT_cmd + self.value
 
 
 class Register_Device_Data(API_Data):
     "Extracts from a Register Joining Device Status frame and exports to a Register Device frame."
+    __slots__ = ("remote_address", "link_key", "status")
     rx_id = 0xA4
     "Receive Register Joining Device Status message type ID"
     tx_id = 0x24
     "Register Device message type ID"
+    rx_format = struct.Struct(">BB")
+    "frame_id, status"
+    tx_format = struct.Struct(">BQHB")
+    "frame_id, destination_address_64, destination_address_16, key options"
     # status values
     SUCCESS = 0x00
     INVALID_ADDRESS = 0xB3
     KEY_NOT_FOUND = 0xFF
-    def __init__(self, remote_address = None, link_key = ""):
+    def __init__(self, remote_address = None, link_key = b""):
         API_Data.__init__(self)
         "Initializes the register device with no data."
         self.remote_address = remote_address
@@ -390,25 +586,27 @@ class Register_Device_Data(API_Data):
         if len(cmd_data) < 2:
             #Message too small, return error
             return -1
-        self.frame_id = ord(cmd_data[0])
-        self.status = ord(cmd_data[1])
+        self.frame_id, self.status = self.rx_format.unpack_from(cmd_data)
         return 0
         
     def export(self):
         "Export a register device message as a 0x24 xbee frame cmd_data"
-        self.frame_id = self.next_frame()
-        cmd_data = chr(self.frame_id)
-        cmd_data += struct.pack(">Q", address_string_to_MAC(self.remote_address)) # destination_address_64
-        cmd_data += chr(0xFF) + chr(0xFE) # destination_address_16, always set to 0xFFFE
-        cmd_data += chr(0x00) # Key Options (Always set to 0)        
-        cmd_data += self.link_key
-        return cmd_data
+        if not self.frame_id:
+            self.frame_id = self.next_frame()
+        return self.tx_format.pack(self.frame_id,
+                                   address_string_to_MAC(self.remote_address), # destination_address_64
+                                   0xFFFE, # destination_address_16, always set to 0xFFFE
+                                   0x00 # Key Options (Always set to 0)
+                                   ) + self.link_key
 
 
 class IEEE_802_15_4_Tx_Status_Data(API_Data):
     "Extracts from an 802.15.4 Tx Status frame."
+    __slots__ = ("delivery_status",)
     rx_id = 0x89
     "Receive ZigBee Tx Status message type ID"
+    rx_format = struct.Struct(">BB")
+    "frame_id, delivery_status"
     # Delivery Status
     SUCCESS = 0x00
     NO_ACK_RECEIVED = 0x01
@@ -427,20 +625,21 @@ class IEEE_802_15_4_Tx_Status_Data(API_Data):
             #Message too small, return error
             return -1
         # extract data
-        self.frame_id, self.delivery_status = struct.unpack(">BB", cmd_data[:2])
+        self.frame_id, self.delivery_status = self.rx_format.unpack_from(cmd_data)
         return 2
         
     def export(self):
         "Will export a TX Status Message.  May be used for local message routing."
-        cmd_data = chr(self.frame_id)
-        cmd_data += chr(self.delivery_status)
-        return cmd_data
+        return self.rx_format.pack(self.frame_id, self.delivery_status)
 
 
 class ZigBee_Tx_Status_Data(API_Data):
     "Extracts from a ZigBee Tx Status frame."
+    __slots__ = ("remote_network_address", "transmit_retry_count", "delivery_status", "discovery_status")
     rx_id = 0x8B
     "Receive ZigBee Tx Status message type ID"
+    rx_format = struct.Struct(">BHBBB")
+    "frame_id, remote_address_16, transmit_retry_count, delivery_status, discovery_status"
     # Delivery Status
     SUCCESS = 0x00
     CCA_FAILURE = 0x02
@@ -477,26 +676,28 @@ class ZigBee_Tx_Status_Data(API_Data):
             #Message too small, return error
             return -1
         # extract data
-        self.frame_id, short_address, self.transmit_retry_count, self.delivery_status, self.discovery_status = struct.unpack(">BHBBB", cmd_data)
+        self.frame_id, short_address, self.transmit_retry_count, self.delivery_status, self.discovery_status = self.rx_format.unpack_from(cmd_data)
         #convert short network address to string
         self.remote_network_address = short_to_address_string(short_address)
         return 6
         
     def export(self):
         "Will export a TX Status Message.  May be used for local message routing."
-        cmd_data = chr(self.frame_id)
-        cmd_data += struct.pack(">H", address_string_to_short(self.remote_network_address)) # remote_address_16
-        cmd_data += chr(self.transmit_retry_count)        
-        cmd_data += chr(self.delivery_status)
-        cmd_data += chr(self.discovery_status)
-        return cmd_data            
+        return self.rx_format.pack(self.frame_id,
+                                   address_string_to_short(self.remote_network_address), # remote_address_16
+                                   self.transmit_retry_count,
+                                   self.delivery_status,
+                                   self.discovery_status)
 
 
 class IEEE_802_15_4_64_IO(API_Data):
     "Extracts from an 802.15.4 Receive 64-bit Address IO."
+    __slots__ = ("source_address", "rssi", "payload")
     rx_id = 0x82
+    rx_format = struct.Struct(">QBB")
+    "source_address_64, rssi, options"
 
-    def __init__(self, source_address = None, destination_address = None, rssi=None, payload = ""):
+    def __init__(self, source_address = None, destination_address = None, rssi=None, payload = b""):
         "Initializes the IO data with no data."
         API_Data.__init__(self)        
         self.source_address = source_address
@@ -507,9 +708,9 @@ class IEEE_802_15_4_64_IO(API_Data):
         "Extract a XBee message from a 0x82 XBee frame cmd_data"
         if len(cmd_data) < 10:
             #Message too small, return error
-            logger.warn("Malformed message - too small")
+            logger.warning("Malformed message - too small")
             return -1
-        source_address_64, self.rssi, options = struct.unpack(">QBB", cmd_data[:10])
+        source_address_64, self.rssi, options = self.rx_format.unpack_from(cmd_data)
         self.payload = cmd_data[10:]
         # use the device's EUI address
         address_string = MAC_to_address_string(source_address_64)            
@@ -520,9 +721,12 @@ class IEEE_802_15_4_64_IO(API_Data):
 
 class IEEE_802_15_4_16_IO(API_Data):
     "Extracts from an 802.15.4 Receive 16-bit Address IO."
+    __slots__ = ("source_address", "rssi", "payload")
     rx_id = 0x83
+    rx_format = struct.Struct(">HBB")
+    "source_address_16, rssi, options"
 
-    def __init__(self, source_address = None, destination_address = None, rssi=None, payload = ""):
+    def __init__(self, source_address = None, destination_address = None, rssi=None, payload = b""):
         "Initializes the IO data with no data."
         API_Data.__init__(self)        
         self.source_address = source_address
@@ -533,9 +737,9 @@ class IEEE_802_15_4_16_IO(API_Data):
         "Extract a XBee message from a 0x83 XBee frame cmd_data"
         if len(cmd_data) < 4:
             #Message too small, return error
-            logger.warn("Malformed message - too small")
+            logger.warning("Malformed message - too small")
             return -1
-        source_address_16, self.rssi, options = struct.unpack(">HBB", cmd_data[:4])
+        source_address_16, self.rssi, options = self.rx_format.unpack_from(cmd_data)
         self.payload = cmd_data[4:]
         # use the device's EUI address
         address_string = short_to_address_string(source_address_16)            
@@ -545,8 +749,43 @@ class IEEE_802_15_4_16_IO(API_Data):
         return 0
 
 
-class API_Message:
+class Modem_Status_Data(API_Data):
+    "Extracts from a Modem Status frame."
+    __slots__ = ("status",)
+    rx_id = 0x8A
+    "Receive Modem Status message type ID"
+    rx_format = struct.Struct(">B")
+    "status"
+    # Status
+    HARDWARE_RESET = 0x00
+    WATCHDOG_TIMER_RESET = 0x01
+    JOINED_NETWORK = 0x02
+    DISASSOCIATED = 0x03
+    COORDINATOR_STARTED = 0x06
+    NETWORK_SECURITY_KEY_UPDATED = 0x07
+    MODEM_CONFIGURATION_CHANGED = 0x11
+
+    def __init__(self, status = HARDWARE_RESET):
+        API_Data.__init__(self)
+        self.status = status
+        "What happened to the XBee"
+
+    def extract(self, cmd_data):
+        "Extract a Modem Status message from a 0x8A xbee frame cmd_data"
+        if len(cmd_data) < 1:
+            #Message too small, return error
+            return -1
+        self.status, = self.rx_format.unpack_from(cmd_data)
+        return 1
+
+    def export(self):
+        "Will export a Modem Status Message.  May be used for local message routing."
+        return self.rx_format.pack(self.status)
+
+
+class API_Message(object):
     "Creates API message for the XBee"
+    __slots__ = ("length", "API_ID", "cmd_data", "api_data", "checksum")
     
     API_IDs = {ZB_Data.rx_id: ZB_Data, 
                Local_AT_Data.rx_id: Local_AT_Data, 
@@ -557,15 +796,18 @@ class API_Message:
                IEEE_802_15_4_64_Data.rx_id: IEEE_802_15_4_64_Data, 
                IEEE_802_15_4_16_Data.rx_id: IEEE_802_15_4_16_Data,
                IEEE_802_15_4_64_IO.rx_id: IEEE_802_15_4_64_IO,
-               IEEE_802_15_4_16_IO.rx_id: IEEE_802_15_4_16_IO}
-    "Stores the different APIs"
+               IEEE_802_15_4_16_IO.rx_id: IEEE_802_15_4_16_IO,
+               Modem_Status_Data.rx_id: Modem_Status_Data}
+    "Stores the different APIs, used to dispatch received frames by API ID"
+    header_format = struct.Struct(">BHB")
+    "start delimiter, length, API_ID"
     
     def __init__(self):
         self.length = 0
         "Length field of the frame"
         self.API_ID = 0
         "Frame message ID."
-        self.cmd_data = ""
+        self.cmd_data = b""
         "Data payload for the frame"
         self.api_data = API_Data()
         "Formatted command data"
@@ -578,11 +820,7 @@ class API_Message:
 
     def calc_checksum(self):
         "Calculates the checksum, based on cmd_data"
-        checksum = self.API_ID
-        for byte in self.cmd_data:
-            checksum += ord(byte)
-            checksum &= 0xFF
-        return 0xFF - checksum
+        return 0xFF - ((self.API_ID + sum(bytearray(self.cmd_data))) & 0xFF)
     
     def set_length(self):
         "Calculates the length and sets it, based on cmd_data"
@@ -604,22 +842,19 @@ class API_Message:
         if len(buffer) < 5:
             return -1
         
-        # pull out length (MSB)
-        length = ord(buffer[1]) * 255 + ord(buffer[2])
+        # pull out length
+        start_delimiter, length, API_ID = self.header_format.unpack_from(buffer)
         
         if len(buffer) < length + 4:
             return -1
 
         # we have a full XBee message, lets extract it.
         self.length = length
-        self.API_ID = ord(buffer[3])
+        self.API_ID = API_ID
         self.cmd_data = buffer[4:length+3]
-        if self.API_ID in self.API_IDs.keys():
-            self.api_data = self.API_IDs[self.API_ID]()
-        else:
-            self.api_data = API_Data()
+        self.api_data = self.API_IDs.get(self.API_ID, API_Data)()
         self.api_data.extract(self.cmd_data)
-        self.checksum = ord(buffer[length + 3])
+        self.checksum = _BYTE.unpack_from(buffer, length + 3)[0]
 
         return len(self)
 
@@ -631,7 +866,414 @@ class API_Message:
         self.cmd_data = self.api_data.export() # must be done before calculating checksum
         self.checksum = self.calc_checksum() # calculate the new checksum and set it
         self.set_length() # set the new length
-        return chr(0x7E) + chr(self.length / 255) + chr(self.length & 0xFF) + chr(self.API_ID) + self.cmd_data + chr(self.checksum)
+        return self.header_format.pack(0x7E, self.length, self.API_ID) + self.cmd_data + _BYTE.pack(self.checksum)
+
+
+class API_Frame_Decoder:
+    """Incremental decoder for the XBee API frames read from the serial port.
+    
+    Serial data is appended to a bytearray and frames are located by moving a
+    read offset through it, so the header is parsed in place and each frame is
+    copied out exactly once.  The consumed part of the buffer is only discarded
+    once it is larger than both COMPACT_SIZE and the unread data (or the buffer
+    has been fully consumed), which keeps the cost of compacting linear."""
+
+    START_DELIMITER = b"\x7E"
+    COMPACT_SIZE = 4096
+    "Number of consumed bytes that are allowed to build up before compacting"
+
+    def __init__(self):
+        self.buffer = bytearray()
+        "Data received from the serial port"
+        self.offset = 0
+        "Index of the first byte in buffer that has not been consumed"
+
+    def __len__(self):
+        "Number of bytes waiting to be decoded"
+        return len(self.buffer) - self.offset
+
+    def clear(self):
+        "Throw away any partially received data"
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        "Add data read from the serial port"
+        self.buffer += data
+
+    def _consume(self, end):
+        "Move the read offset up to end, compacting the buffer when worthwhile"
+        if end >= len(self.buffer):
+            del self.buffer[:]
+            self.offset = 0
+        elif end >= self.COMPACT_SIZE and end * 2 >= len(self.buffer):
+            del self.buffer[:end]
+            self.offset = 0
+        else:
+            self.offset = end
+
+    def next_frame(self):
+        """Returns the next complete frame as a string, including the start
+        delimiter, length and checksum.  Frames with a bad checksum are skipped.
+        Returns None when there is no complete frame in the buffer."""
+        buffer = self.buffer
+        while 1:
+            start = buffer.find(self.START_DELIMITER, self.offset)
+            if start < 0:
+                # no candidate API frame, nothing here is worth keeping
+                self._consume(len(buffer))
+                return None
+            self.offset = start
+            if len(buffer) - start < 5:
+                return None
+            end = start + ((buffer[start + 1] << 8) | buffer[start + 2]) + 4
+            if len(buffer) < end:
+                return None
+            # API ID, frame data and checksum add up to 0xFF on a valid frame
+            if sum(buffer[start + 3:end]) & 0xFF == 0xFF:
+                frame = memoryview(buffer)[start:end].tobytes()
+                self._consume(end)
+                return frame
+            # Skip the start delimiter; useful in the case where ~~ appears in
+            # the stream unexpectedly.  It's been seen on OSX a few times; likely
+            # due to faulty flow control.  The decoder must advance in order to
+            # allow it to continue.
+            self._consume(start + 1)
+
+
+class Pending_Frame(object):
+    "A frame sent to the XBee that may still get a response"
+    __slots__ = ("frame_id", "deadline", "responses", "tx_status", "destination", "source_endpoint", "sent",
+                 "tx_callback")
+
+    def __init__(self, frame_id, deadline):
+        self.frame_id = frame_id
+        "XBee frame ID of the frame"
+        self.deadline = deadline
+        "Time after which the frame ID may be reused"
+        self.responses = []
+        "AT responses received for the frame"
+        self.tx_status = None
+        "(transaction_id, endpoint_id) to queue the Tx Status for, if requested"
+        self.destination = None
+        "Destination address of a transmission, counted in the Tx windows until its Tx Status"
+        self.source_endpoint = None
+        "Endpoint a transmission was sent from, for its statistics"
+        self.sent = None
+        "Time a transmission was written to the XBee"
+        self.tx_callback = None
+        "Called with the Tx Status data of a transmission, if set"
+
+
+class Frame_ID_Pool:
+    """Allocates the frame IDs for the frames sent to one XBee.
+    
+    Frame IDs are only 8 bits, so the frames still waiting on a response are
+    tracked until their deadline and their IDs are skipped when allocating.
+    This allows many AT commands and transmissions to be outstanding at once
+    without their responses getting mixed up.  Transmissions are also counted,
+    in total and by destination, until their Tx Status arrives so the XBee
+    can limit how many are in flight."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_frame_id = 0
+        "Last frame ID handed out"
+        self.pending = {}
+        "Frames waiting on a response, key = frame ID, value = Pending_Frame"
+        self.in_flight = 0
+        "Number of transmissions waiting on their Tx Status"
+        self.destinations = {}
+        "Number of transmissions waiting on their Tx Status, key = destination address"
+
+    def __len__(self):
+        return len(self.pending)
+
+    def allocate(self, timeout, destination = None):
+        """Returns a Pending_Frame with an unused frame ID, tracked for timeout
+        seconds.  Frames sent to a destination are counted as in flight."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for i in range(255):
+                frame_id = self.last_frame_id % 255 + 1
+                self.last_frame_id = frame_id
+                pending = self.pending.get(frame_id)
+                if pending is None or pending.deadline < now:
+                    if pending is not None:
+                        self._forget(pending)
+                    pending = Pending_Frame(frame_id, now + timeout)
+                    if destination is not None:
+                        pending.destination = destination
+                        self.in_flight += 1
+                        self.destinations[destination] = self.destinations.get(destination, 0) + 1
+                    self.pending[frame_id] = pending
+                    return pending
+        finally:
+            self.lock.release()
+        raise Exception("Frame_ID_Pool: all XBee frame IDs are in use")
+
+    def _forget(self, pending):
+        "Stop counting a transmission as in flight, must hold lock"
+        destination = pending.destination
+        if destination is not None:
+            pending.destination = None
+            self.in_flight -= 1
+            count = self.destinations[destination] - 1
+            if count:
+                self.destinations[destination] = count
+            else:
+                del self.destinations[destination]
+
+    def in_flight_to(self, destination):
+        "Number of transmissions to destination waiting on their Tx Status"
+        return self.destinations.get(destination, 0)
+
+    def expire_transmissions(self):
+        """Release the transmissions whose Tx Status is overdue, returns the
+        number released"""
+        now = time.time()
+        expired = 0
+        self.lock.acquire()
+        try:
+            if self.in_flight:
+                for frame_id, pending in list(self.pending.items()):
+                    if pending.destination is not None and pending.deadline < now:
+                        self._forget(pending)
+                        del self.pending[frame_id]
+                        expired += 1
+        finally:
+            self.lock.release()
+        return expired
+
+    def next_expiry(self):
+        "Time at which the next in flight transmission expires, None if there are none"
+        self.lock.acquire()
+        try:
+            deadlines = [pending.deadline for pending in self.pending.values()
+                         if pending.destination is not None]
+        finally:
+            self.lock.release()
+        if deadlines:
+            return min(deadlines)
+        return None
+
+    def get(self, frame_id):
+        "Returns the Pending_Frame for frame_id, or None"
+        return self.pending.get(frame_id)
+
+    def release(self, frame_id):
+        "Stop tracking frame_id, returns its Pending_Frame or None"
+        self.lock.acquire()
+        try:
+            pending = self.pending.pop(frame_id, None)
+            if pending is not None:
+                self._forget(pending)
+            return pending
+        finally:
+            self.lock.release()
+
+
+class Network_Address_Cache:
+    """Remembers the last known network (16-bit) address of nodes by their
+    extended (64-bit) address.
+    
+    Transmissions to an extended address carry the cached network address, so
+    the XBee doesn't have to discover it first.  Entries are learned from
+    received messages, device announces, LQI neighbor tables, node discovery
+    and Tx Status, and forgotten when the XBee reports the address was wrong."""
+    UNKNOWN = 0xFFFE
+    "Network address used when the node's network address is unknown"
+
+    def __init__(self, limit = ADDRESS_CACHE_SIZE):
+        self.addresses = {}
+        "Key = 64-bit address, value = 16-bit address"
+        self.limit = limit
+        "Maximum number of addresses kept"
+
+    def _key(self, addr_extended):
+        "64-bit value of an extended address, None for a network address"
+        if isinstance(addr_extended, (int, long)):
+            return addr_extended
+        if len(addr_extended) <= 8: # '[XXXX]!' network address
+            return None
+        return address_string_to_MAC(addr_extended)
+
+    def learn(self, addr_extended, addr_short):
+        "Remember addr_short (address string or integer) as the network address of addr_extended"
+        key = self._key(addr_extended)
+        if not isinstance(addr_short, (int, long)):
+            addr_short = address_string_to_short(addr_short)
+        if key is None or key in (0, 0xFFFF, 0xFFFFFFFFFFFFFFFF) or addr_short >= 0xFFF8:
+            # broadcast or unknown addresses
+            return
+        addresses = self.addresses
+        if addresses.get(key) != addr_short:
+            if len(addresses) >= self.limit and key not in addresses:
+                # keep the memory used bounded, start over
+                addresses.clear()
+            addresses[key] = addr_short
+
+    def lookup(self, addr_extended):
+        "Returns the network address of addr_extended, UNKNOWN if it isn't known"
+        key = self._key(addr_extended)
+        return self.addresses.get(key, self.UNKNOWN)
+
+    def invalidate(self, addr_extended):
+        "Forget the network address of addr_extended"
+        key = self._key(addr_extended)
+        self.addresses.pop(key, None)
+
+    def clear(self):
+        self.addresses.clear()
+
+
+class DDO_Cache:
+    """Values of DDO parameters read from XBees, by address and AT command.
+    
+    Each AT command has its own time to live, see DDO_CACHE_TTL, and values
+    that never change (like SH and SL) are kept until the cache is cleared.
+    Setting a parameter, or running a command, forgets the cached value."""
+
+    def __init__(self, ttls = DDO_CACHE_TTL):
+        self.ttls = dict(ttls)
+        "Seconds values are cached, by AT command (None for no expiry)"
+        self.values = {}
+        "Key = (64-bit address or None for the local XBee, AT command), value = (expiry time, value)"
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, addr_extended, id):
+        if addr_extended is not None:
+            addr_extended = address_string_to_MAC(addr_extended)
+        return addr_extended, _to_bytes(id).upper()
+
+    def get(self, addr_extended, id):
+        "Returns the cached value of a parameter, None if there is none"
+        key = self._key(addr_extended, id)
+        entry = self.values.get(key)
+        if entry is not None:
+            expiry, value = entry
+            if expiry is None or time.time() < expiry:
+                self.hits += 1
+                return value
+            self.values.pop(key, None)
+        self.misses += 1
+        return None
+
+    def store(self, addr_extended, id, value):
+        "Cache a value read from a parameter, if that parameter is cached"
+        key = self._key(addr_extended, id)
+        if key[1] not in self.ttls:
+            return
+        ttl = self.ttls[key[1]]
+        if ttl is None:
+            self.values[key] = (None, value)
+        elif ttl > 0:
+            self.values[key] = (time.time() + ttl, value)
+
+    def invalidate(self, addr_extended, id = None):
+        "Forget the value of a parameter, or all of the values for an address when id is None"
+        if id is not None:
+            self.values.pop(self._key(addr_extended, id), None)
+            return
+        address = self._key(addr_extended, b"")[0]
+        for key in list(self.values.keys()):
+            if key[0] == address:
+                del self.values[key]
+
+    def clear(self):
+        self.values.clear()
+
+
+class Timer(object):
+    "A callback scheduled on a Timer_Wheel"
+    __slots__ = ("wheel", "deadline", "callback", "cancelled")
+
+    def __init__(self, wheel, deadline, callback):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        "Don't call the callback, if it hasn't been called yet"
+        if not self.cancelled:
+            self.cancelled = True
+            self.wheel.count -= 1
+
+
+class Timer_Wheel(object):
+    """Calls callbacks once their deadline has passed, shared by everything
+    in an XBee that times out (DDO requests, ZDO conversations, node
+    discoveries).
+    
+    Timers are kept in slots of resolution seconds, by deadline, so
+    scheduling and cancelling a timer take constant time and advance() only
+    looks at the slots whose time has come.  Cancelled timers are dropped
+    when their slot comes up.  Callbacks are run by whoever calls advance(),
+    while holding _global_lock."""
+
+    def __init__(self, resolution = TIMER_RESOLUTION, slots = TIMER_SLOTS):
+        self.resolution = resolution
+        self.slots = [[] for i in range(slots)]
+        self.tick = int(time.time() / resolution)
+        "Last tick advance() handled"
+        self.count = 0
+        "Timers waiting to be called"
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, callback):
+        "Call callback() once time.time() reaches deadline, returns the Timer"
+        timer = Timer(self, deadline, callback)
+        tick = max(int(deadline / self.resolution) + 1, self.tick + 1)
+        self.slots[tick % len(self.slots)].append(timer)
+        self.count += 1
+        return timer
+
+    def advance(self, now = None):
+        "Call the callbacks of the timers whose deadline has passed, returns how many were called"
+        if now is None:
+            now = time.time()
+        current = int(now / self.resolution)
+        if current <= self.tick:
+            return 0
+        ticks = min(current - self.tick, len(self.slots))
+        self.tick = current
+        due = []
+        for tick in range(current - ticks + 1, current + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if slot:
+                waiting = []
+                for timer in slot:
+                    if timer.cancelled:
+                        continue
+                    if timer.deadline <= now:
+                        due.append(timer)
+                    else:
+                        # due on a later turn of the wheel
+                        waiting.append(timer)
+                self.slots[index] = waiting
+        for timer in due:
+            if timer.cancelled:
+                # cancelled by one of the callbacks
+                continue
+            timer.cancel()
+            try:
+                timer.callback()
+            except Exception as e:
+                logger.warning("exception in timer callback: %s" % e)
+        return len(due)
+
+    def clear(self):
+        for index in range(len(self.slots)):
+            for timer in self.slots[index]:
+                timer.cancelled = True
+            self.slots[index] = []
+        self.count = 0
 
 
 class ZDO_Frame:
@@ -640,14 +1282,14 @@ class ZDO_Frame:
         self.address = address
         if buf is None:
             self.transaction_sequence_number = 0
-            self.payload = ""
+            self.payload = b""
         else:
-            self.transaction_sequence_number = ord(buf[0])
+            self.transaction_sequence_number = _BYTE.unpack_from(buf)[0]
             self.payload = buf[1:]
     
     def export(self):
         """Create frame as a string of bytes"""
-        return chr(self.transaction_sequence_number) + self.payload
+        return _BYTE.pack(self.transaction_sequence_number) + self.payload
    
 
 class Conversation:
@@ -672,6 +1314,8 @@ class Conversation:
         else:
             self.timeout = timeout
         self.extra_data = extra_data  #there are times when it is useful to store additional information in a conversation
+        self.timer = None
+        "Timer that times out the conversation"
         
     def match_frame(self, frame):
         #a base conversation object should always fail matches
@@ -680,17 +1324,29 @@ class Conversation:
     def tick_sec(self):
         if (time.time() - self.start_time > self.timeout):
             # we timed out on the response
-            self.active = False
-            if self.timeout_callback is not None:
-                self.timeout_callback(self)
-            else:
-                #TTDO: this is now an uncommon case; should we just print an error or still rely
-                #on a raise (and catch in tick_sec)?
-                #raise Exception("Conversation Timeout: Address = %s" % str(self.frame.address))
-                pass
+            self.timed_out()
+
+    def timed_out(self):
+        "End the conversation without a response"
+        self.active = False
+        if self.timeout_callback is not None:
+            self.timeout_callback(self)
+        else:
+            #TTDO: this is now an uncommon case; should we just print an error or still rely
+            #on a raise (and catch in tick_sec)?
+            #raise Exception("Conversation Timeout: Address = %s" % str(self.frame.address))
+            pass
+
+    def key(self):
+        "Key for matching responses to the conversation in constant time"
+        return None
 
 
 class ZDO_Conversation(Conversation):
+    def key(self):
+        "Responses come from the address the request was sent to, with the same transaction sequence number"
+        return (self.frame.address[0], self.frame.transaction_sequence_number)
+
     def match_frame(self, frame):
         matched = False
         if (self.frame.address[0] == frame.address[0] and
@@ -724,7 +1380,7 @@ class ZDO_Device_annce_cluster_server:
                 record.extract(frame.payload)
                 # TTDO: should this be a record list?
                 self.callback(record)
-            except Exception, e:
+            except Exception as e:
                 logger.debug("Error: ZDO_Device_annce_cluster_server: %s" % str(e))
 
 
@@ -732,22 +1388,48 @@ class ZDO_Mgmt_Lqi_cluster_client:
     cluster_id = 0x0031
     
     def __init__(self, xbee = None):
-        self.conversations = []
+        self.conversations = {}
+        "Conversations waiting for a response, key = (address, transaction sequence number)"
         self.xbee = xbee
         self.sequence_number = 0
     
     def send_frame(self, frame):
         self.xbee.send_zb(0, frame.address, frame.export())
     
-    def send_command(self, dest_address, start_index, callback = None):
+    def send_command(self, dest_address, start_index, callback = None, timeout_callback = None, timeout = None):
         if callback == None:
             callback = self.default_callback
         frame = ZDO_Frame()
         frame.transaction_sequence_number = self.next_sequence_number()
-        frame.payload = chr(start_index)
+        frame.payload = _BYTE.pack(start_index)
         frame.address = (dest_address, 0, 0, self.cluster_id)
+        conversation = ZDO_Conversation(frame, callback, timeout_callback, timeout)
+        previous = self.conversations.get(conversation.key())
+        if previous is not None:
+            # the sequence numbers wrapped around before a response arrived
+            self.end_conversation(previous)
+            previous.timed_out()
+        self.conversations[conversation.key()] = conversation
+        conversation.timer = self.xbee.timers.schedule(conversation.start_time + conversation.timeout,
+                                                       self._timeout_callback(conversation))
         self.send_frame(frame)
-        self.conversations.append(ZDO_Conversation(frame, callback))
+        return conversation
+
+    def _timeout_callback(self, conversation):
+        return lambda: self._timed_out(conversation)
+
+    def _timed_out(self, conversation):
+        if self.conversations.get(conversation.key()) is conversation:
+            del self.conversations[conversation.key()]
+            conversation.timed_out()
+
+    def end_conversation(self, conversation):
+        "Stop waiting for the response to a conversation"
+        conversation.active = False
+        if self.conversations.get(conversation.key()) is conversation:
+            del self.conversations[conversation.key()]
+        if conversation.timer is not None:
+            conversation.timer.cancel()
                                   
     def next_sequence_number(self):
         "Get the next transaction sequence number to use for sending a message."
@@ -757,18 +1439,11 @@ class ZDO_Mgmt_Lqi_cluster_client:
     
     def handle_message(self, frame):
         #print "Received LQI message from %s" % str(source_address)
-        #purge any dead conversations
-        for temp_conversation in self.conversations[:]:
-            if temp_conversation.active == False:
-                self.conversations.remove(temp_conversation)
-        #check all conversations for matches with the frame; if no conversations match raise exception 
-        conversation = None
-        for temp_conversation in self.conversations:
-            if temp_conversation.match_frame(frame):
-                conversation = temp_conversation
-                break
+        #look up the conversation the frame responds to
+        conversation = self.conversations.get((frame.address[0], frame.transaction_sequence_number))
         
         if conversation is not None:
+            self.end_conversation(conversation)
             if conversation.callback is not None:
                 #print [hex(ord(x)) for x in frame.payload]
                 mgmt_lqi_rsp = Mgmt_Lqi_rsp()
@@ -784,23 +1459,44 @@ class ZDO_Mgmt_Lqi_cluster_client:
 
 
 class LQI_aggregator:
-    def __init__(self, client_lqi_cluster, dest_address, start_index = 0, callback = None):
+    def __init__(self, client_lqi_cluster, dest_address, start_index = 0, callback = None, timeout = LQI_QUERY_TIMEOUT,
+                 timeout_callback = None):
         self.client_lqi_cluster = client_lqi_cluster
         self.dest_address = dest_address
         self.start_index = start_index
         self.neighbor_table_descriptors = []
         self.final_callback = callback
-        self.client_lqi_cluster.send_command(self.dest_address, start_index, self.callback)
+        self.timeout = timeout
+        "Seconds to wait for each page"
+        self.timeout_callback = timeout_callback
+        "Called with the aggregator when a page doesn't arrive in time"
+        self.started = time.time()
+        "Time the neighbor table started to be read"
+        self.conversation = self.client_lqi_cluster.send_command(self.dest_address, start_index, self.callback,
+                                                                 self._timed_out, self.timeout)
     
     def callback(self, conversation, frame, lqi_record):
         #print "Internal LQI_aggregator callback"
         self.neighbor_table_descriptors.extend(lqi_record.neighbor_table_list)
+        if lqi_record.status != 0:
+            # the neighbor table can't be read (any further)
+            self.final_callback(self.neighbor_table_descriptors)
+            return
         end_index = lqi_record.start_index + len(lqi_record.neighbor_table_list)
-        if end_index < lqi_record.neighbor_table_entries:
+        if end_index < lqi_record.neighbor_table_entries and lqi_record.neighbor_table_list:
             #send another command            
-            self.client_lqi_cluster.send_command(self.dest_address, end_index)
+            self.conversation = self.client_lqi_cluster.send_command(self.dest_address, end_index, self.callback,
+                                                                     self._timed_out, self.timeout)
         else:
             self.final_callback(self.neighbor_table_descriptors)
+
+    def _timed_out(self, conversation):
+        if self.timeout_callback is not None:
+            self.timeout_callback(self)
+
+    def cancel(self):
+        "Stop waiting for the neighbor table"
+        self.client_lqi_cluster.end_conversation(self.conversation)
     
     def default_callback(self, conversation, frame, record_list):
         pass
@@ -846,7 +1542,7 @@ class NeighborTableDescriptorRecord:
             self.addr_extended = MAC_to_address_string(self.addr_extended, 8)
             self.addr_short = short_to_address_string(self.addr_short)
             return 22
-        except Exception, e:
+        except Exception as e:
             raise Exception("Error: NeighborTableListRecord.extract() - %s" % e)
     
     def export(self):
@@ -880,12 +1576,12 @@ class Mgmt_Lqi_rsp:
         self.neighbor_table_list = neighbor_table_list
     
     def extract(self, buffer):
-        self.status = ord(buffer[0])
+        self.status = _BYTE.unpack_from(buffer)[0]
         if self.status == 0: #SUCCESS 
             self.neighbor_table_entries, self.start_index, neighbor_table_list_count = struct.unpack("<BBB", buffer[1:4])
             if neighbor_table_list_count > 0:
                 offset = 4
-                for i in xrange(neighbor_table_list_count):
+                for i in range(neighbor_table_list_count):
                     record = NeighborTableDescriptorRecord()
                     offset += record.extract(buffer[offset:])
                     self.neighbor_table_list.append(record)
@@ -927,10 +1623,1200 @@ class Device_Annce:
         #Allocate address                 1         
         try:
             self.nwk_addr, self.IEEE_addr, self.capability = struct.unpack("<HQB", buffer[0:11])
-        except Exception,e:
+        except Exception as e:
             raise Exception("Error: Device_Annce.extract() - %s" % e)
 
 
+class Neighbor_Link(object):
+    "A neighbor reported in the neighbor table of a router"
+    __slots__ = ("router", "neighbor", "addr_short", "device_type", "rx_on_when_idle", "relationship",
+                 "depth", "lqi", "last_seen")
+    # Relationship
+    PARENT = 0
+    CHILD = 1
+    SIBLING = 2
+    NONE = 3
+    PREVIOUS_CHILD = 4
+
+    def __init__(self, router, record, last_seen):
+        self.router = router
+        "64-bit address of the router"
+        self.neighbor = record.addr_extended
+        "64-bit address of the neighbor"
+        self.addr_short = record.addr_short
+        self.device_type = record.device_type
+        self.rx_on_when_idle = record.rx_on_when_idle
+        self.relationship = record.relationship
+        "What the neighbor is to the router"
+        self.depth = record.depth
+        self.lqi = record.lqi
+        "Link quality of the neighbor as received by the router"
+        self.last_seen = last_seen
+        "Time the router's neighbor table was read"
+
+
+class Topology(object):
+    """The links of the network, from the neighbor tables (Mgmt_Lqi_rsp
+    records) read from its routers.
+    
+    Each router's links are replaced when its neighbor table is read again,
+    and stale() tells which routers have not been read recently, so only
+    those are read again (see XBee.refresh_topology())."""
+
+    def __init__(self):
+        self.links = {}
+        "Key = 64-bit address of a router, value = {64-bit address of a neighbor: Neighbor_Link}"
+        self.refreshed = {}
+        "Time each router's neighbor table was last read, or failed to be, by 64-bit address"
+        self.parents = {}
+        "Key = 64-bit address of a node, value = set of the 64-bit addresses of the routers listing it as a child"
+
+    def update(self, router, records):
+        "Replace the links of a router with the records read from its neighbor table"
+        now = time.time()
+        self._forget_children(router)
+        links = {}
+        for record in records:
+            link = Neighbor_Link(router, record, now)
+            links[record.addr_extended] = link
+            if link.relationship == Neighbor_Link.CHILD:
+                self.parents.setdefault(link.neighbor, set()).add(router)
+        self.links[router] = links
+        self.refreshed[router] = now
+
+    def _forget_children(self, router):
+        "Remove the children of a router from parents"
+        for link in self.links.get(router, {}).values():
+            if link.relationship == Neighbor_Link.CHILD:
+                routers = self.parents.get(link.neighbor)
+                if routers is not None:
+                    routers.discard(router)
+                    if not routers:
+                        del self.parents[link.neighbor]
+
+    def failed(self, router):
+        "Note that the neighbor table of a router couldn't be read, its links are kept"
+        self.refreshed[router] = time.time()
+
+    def stale(self, router, max_age = TOPOLOGY_MAX_AGE):
+        "Returns True if the neighbor table of a router hasn't been read for max_age seconds"
+        refreshed = self.refreshed.get(router)
+        return refreshed is None or refreshed + max_age <= time.time()
+
+    def neighbors(self, router):
+        "Returns the Neighbor_Links of a router"
+        return list(self.links.get(router, {}).values())
+
+    def parent(self, addr_extended):
+        "Returns the 64-bit address of the parent of a node, None if it isn't known"
+        for link in self.links.get(addr_extended, {}).values():
+            if link.relationship == Neighbor_Link.PARENT:
+                return link.neighbor
+        routers = self.parents.get(addr_extended)
+        if routers:
+            # the router read most recently
+            return max(routers, key = lambda router: self.refreshed.get(router, 0))
+        return None
+
+    def children(self, router):
+        "Returns the 64-bit addresses of the children of a router"
+        return [link.neighbor for link in self.links.get(router, {}).values()
+                if link.relationship == Neighbor_Link.CHILD]
+
+    def remove(self, router):
+        "Forget the links of a router"
+        self._forget_children(router)
+        self.links.pop(router, None)
+        self.refreshed.pop(router, None)
+
+    def clear(self):
+        self.links.clear()
+        self.refreshed.clear()
+        self.parents.clear()
+
+
+class Wakeup(object):
+    """A pair of connected sockets, used to let select() wait on events inside
+    this module: the read end is readable for as long as the wakeup is set."""
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+        self.is_set = False
+
+    def fileno(self):
+        "File descriptor that is readable while the wakeup is set"
+        return self.reader.fileno()
+
+    def set(self):
+        if not self.is_set:
+            self.is_set = True
+            try:
+                self.writer.send(b"\x00")
+            except socket.error:
+                pass
+
+    def clear(self):
+        if self.is_set:
+            self.is_set = False
+            try:
+                self.reader.recv(64)
+            except socket.error:
+                pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+class Latency_Histogram(object):
+    """Counts latencies in buckets that double in size, from under 1 ms up to
+    the last bucket which holds everything of 2 ** (BUCKETS - 2) ms and more."""
+    BUCKETS = 16
+    "Number of buckets, the upper bounds are 1, 2, 4, ... ms"
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        "Sum of the latencies in seconds"
+        self.maximum = 0.0
+
+    def record(self, latency):
+        "Count a latency, in seconds"
+        self.count += 1
+        self.total += latency
+        if latency > self.maximum:
+            self.maximum = latency
+        bucket = 0
+        limit = 0.001
+        while latency >= limit and bucket < self.BUCKETS - 1:
+            bucket += 1
+            limit *= 2
+        self.buckets[bucket] += 1
+
+    def export(self):
+        """Returns a dictionary with the count, average and maximum latency in
+        seconds, and a list of (upper bound in ms, count) for the buckets, where
+        the upper bound of the last bucket is None."""
+        average = 0.0
+        if self.count:
+            average = self.total / self.count
+        bounds = [2 ** i for i in range(self.BUCKETS - 1)] + [None]
+        return {"count": self.count, "average": average, "maximum": self.maximum,
+                "buckets": list(zip(bounds, self.buckets))}
+
+
+class Endpoint_Statistics(object):
+    "Frame, byte and Tx Status counters for an endpoint"
+
+    def __init__(self):
+        self.frames_tx = 0
+        "Frames sent from the endpoint"
+        self.bytes_tx = 0
+        "Payload bytes sent from the endpoint"
+        self.frames_rx = 0
+        "Messages added to the receive queue, including any that were dropped"
+        self.bytes_rx = 0
+        "Payload bytes added to the receive queue"
+        self.tx_status_failures = {}
+        "Count of the Tx Status with a failed delivery, by delivery status"
+        self.tx_status_latency = Latency_Histogram()
+        "Time from writing a frame to the XBee to its Tx Status"
+        self.rx_latency = Latency_Histogram()
+        "Time from a message arriving from the XBee to it being received from the queue"
+
+    def sent(self, frames, payload_length):
+        "Count frames of payload_length bytes sent"
+        self.frames_tx += frames
+        self.bytes_tx += frames * payload_length
+
+    def tx_status(self, delivery_status, latency):
+        "Count a Tx Status, latency is the seconds since the frame was sent"
+        if delivery_status:
+            self.tx_status_failures[delivery_status] = self.tx_status_failures.get(delivery_status, 0) + 1
+        self.tx_status_latency.record(latency)
+
+    def export(self):
+        "Returns the statistics as a dictionary"
+        return {"frames_tx": self.frames_tx,
+                "bytes_tx": self.bytes_tx,
+                "frames_rx": self.frames_rx,
+                "bytes_rx": self.bytes_rx,
+                "tx_status_failures": dict(self.tx_status_failures),
+                "tx_status_latency": self.tx_status_latency.export(),
+                "rx_latency": self.rx_latency.export()}
+
+
+FRAGMENT_HEADER = struct.Struct(">HBB")
+"message_id, fragment index, fragment count; starts every payload on endpoints using fragmentation"
+
+class Fragment_Sender(object):
+    """Sends the fragments of one message to a remote node.
+    
+    As many fragments as fit in the Tx windows of the XBee are in flight at
+    once.  Each is tracked until its Tx Status, and only the fragments that
+    failed, or whose Tx Status never arrived, are sent again.  The sender is
+    driven by the Tx Status of its fragments, by timers on the XBee's
+    Timer_Wheel for the Tx Status that are overdue and by the Tx windows
+    changing, see XBee.send_fragments()."""
+    NO_TX_STATUS = -1
+    "delivery_status when a fragment's Tx Status never arrived"
+
+    def __init__(self, xbee, source_endpoint, destination_address, fragments, retries = FRAGMENT_RETRIES):
+        self.xbee = xbee
+        self.source_endpoint = source_endpoint
+        self.destination_address = destination_address
+        self.fragments = fragments
+        "Payloads of the fragments, including their FRAGMENT_HEADER"
+        self.retries = retries
+        self.next_index = 0
+        "Index of the next fragment to send for the first time"
+        self.retransmit = []
+        "Indexes of the fragments to send again"
+        self.attempts = [0] * len(fragments)
+        self.in_flight = {}
+        "Key = fragment index, value = (attempt, time sent)"
+        self.timers = {}
+        "Key = fragment index, value = Timer for its Tx Status being overdue"
+        self.delivered = 0
+        self.done = False
+        self.delivery_status = None
+        "0 once every fragment was delivered, otherwise the status of the fragment that failed"
+        self.pumping = False
+
+    def pump(self):
+        "Send the fragments that fit in the Tx windows, must hold _global_lock"
+        if self.pumping or self.done:
+            return
+        self.pumping = True
+        try:
+            destination = self.destination_address[0]
+            while not self.done and (self.retransmit or self.next_index < len(self.fragments)) and \
+                  self.xbee.tx_window_open(destination):
+                if self.retransmit:
+                    index = self.retransmit.pop(0)
+                else:
+                    index = self.next_index
+                    self.next_index += 1
+                self.attempts[index] += 1
+                sent = time.time()
+                self.in_flight[index] = (self.attempts[index], sent)
+                self.timers[index] = self.xbee.timers.schedule(sent + TX_STATUS_TIMEOUT,
+                                                               self._timeout_callback(index, self.attempts[index]))
+                self.xbee.send_zb(self.source_endpoint, self.destination_address, self.fragments[index],
+                                  self._tx_callback(index, self.attempts[index]))
+        finally:
+            self.pumping = False
+
+    def _tx_callback(self, index, attempt):
+        return lambda status_data: self.tx_status(index, attempt, status_data)
+
+    def _timeout_callback(self, index, attempt):
+        return lambda: self.tx_status_overdue(index, attempt)
+
+    def tx_status_overdue(self, index, attempt):
+        "Send a fragment again when its Tx Status never arrived, must hold _global_lock"
+        if self.done or self.in_flight.get(index, (None,))[0] != attempt:
+            return
+        del self.in_flight[index]
+        del self.timers[index]
+        self._failed(index, self.NO_TX_STATUS)
+        self.pump()
+
+    def tx_status(self, index, attempt, status_data):
+        "Handle the Tx Status of a fragment, must hold _global_lock"
+        if self.done or self.in_flight.get(index, (None,))[0] != attempt:
+            # a late Tx Status for a fragment that has been sent again
+            return
+        del self.in_flight[index]
+        self.timers.pop(index).cancel()
+        if status_data.delivery_status == 0:
+            self.delivered += 1
+            if self.delivered == len(self.fragments):
+                self._finish(0)
+        else:
+            self._failed(index, status_data.delivery_status)
+        self.pump()
+
+    def _failed(self, index, delivery_status):
+        if self.attempts[index] > self.retries:
+            self._finish(delivery_status)
+        else:
+            self.retransmit.append(index)
+
+    def _finish(self, delivery_status):
+        self.done = True
+        self.delivery_status = delivery_status
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        if self in self.xbee.fragment_senders:
+            self.xbee.fragment_senders.remove(self)
+        self.xbee.tx_condition.notify_all()
+
+    def cancel(self):
+        "Stop sending the message"
+        if not self.done:
+            self._finish(self.delivery_status)
+
+    def wait(self, timeout = None):
+        """Wait up to timeout seconds (forever when None) for the message to be
+        delivered or given up on, must hold _global_lock.  Returns done."""
+        xbee = self.xbee
+        end_time = None
+        if timeout:
+            end_time = time.time() + timeout
+        while not self.done:
+            wait = TX_STATUS_TIMEOUT
+            if self.in_flight:
+                # wake up in time to send again a fragment whose Tx Status is overdue
+                wait = min([sent for attempt, sent in self.in_flight.values()]) + TX_STATUS_TIMEOUT - time.time()
+            if end_time is not None:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                wait = min(wait, remaining)
+            if xbee.serial is not None and not xbee.reader_running():
+                # no reader thread, poll the serial port for Tx Status
+                xbee.read_messages()
+                wait = min(wait, SERIAL_POLL_TIME)
+            if not self.done:
+                xbee.tx_condition.wait(max(wait, 0))
+                self.pump()
+        return self.done
+
+
+class Fragment_Reassembler(object):
+    """Puts received fragments back together into messages for an endpoint.
+    
+    Up to limit partly received messages are kept, by sender and message ID,
+    for timeout seconds after their first fragment arrived.  The last
+    completed_limit messages completed are remembered for timeout seconds,
+    so a fragment sent again after its Tx Status was lost isn't taken for a
+    new message."""
+
+    def __init__(self, limit = FRAGMENT_BUFFERS, timeout = FRAGMENT_TIMEOUT, completed_limit = FRAGMENT_COMPLETED):
+        self.limit = limit
+        self.timeout = timeout
+        self.completed_limit = completed_limit
+        self.partial = {}
+        "Key = (address, endpoint, profile, cluster, message_id), value = (time, count, fragments by index)"
+        self.completed = {}
+        "Key = (address, endpoint, profile, cluster, message_id) of a message completed recently, value = time"
+        self.completed_order = collections.deque()
+        "(time, key) of the messages in completed, oldest first"
+        self.drops = 0
+        "Number of partly received messages dropped, for timing out or lack of room"
+        self.duplicates = 0
+        "Number of fragments ignored because their message was already completed"
+
+    def _completed(self, key, now):
+        "Remember that the message with key was completed"
+        completed = self.completed
+        order = self.completed_order
+        while order and (len(order) >= self.completed_limit or order[0][0] + self.timeout < now):
+            started, old_key = order.popleft()
+            if completed.get(old_key) == started:
+                del completed[old_key]
+        completed[key] = now
+        order.append((now, key))
+
+    def add(self, payload, address):
+        """Add a received payload, returns the (payload, address) of the message
+        once it is complete, None until then."""
+        if len(payload) < FRAGMENT_HEADER.size:
+            self.drops += 1
+            return None
+        message_id, index, count = FRAGMENT_HEADER.unpack_from(payload)
+        payload = payload[FRAGMENT_HEADER.size:]
+        if index >= count:
+            self.drops += 1
+            return None
+        now = time.time()
+        key = (address[0], address[1], address[2], address[3], message_id)
+        completed = self.completed.get(key)
+        if completed is not None and completed + self.timeout >= now:
+            # sent again after its Tx Status was lost
+            self.duplicates += 1
+            return None
+        if count == 1:
+            # the whole message fit in one frame
+            self._completed(key, now)
+            return payload, address
+        partial = self.partial
+        if partial:
+            for key, (started, expected, fragments) in list(partial.items()):
+                if started + self.timeout < now:
+                    del partial[key]
+                    self.drops += 1
+        entry = partial.get(key)
+        if entry is None or entry[1] != count:
+            if len(partial) >= self.limit:
+                # make room by dropping the oldest message
+                del partial[min([(entry[0], key) for key, entry in partial.items()])[1]]
+                self.drops += 1
+            entry = partial[key] = (now, count, {})
+        fragments = entry[2]
+        fragments[index] = payload
+        if len(fragments) < count:
+            return None
+        del partial[key]
+        self._completed(key, now)
+        return b"".join([fragments[index] for index in range(count)]), address
+
+
+class DDO_Future(object):
+    """The outcome of a DDO request sent to an XBee, complete once the response
+    arrives or the request times out.
+    
+    Modeled on concurrent.futures.Future: result() waits for the value, or
+    raises the error, of the request and add_done_callback() registers a
+    function to call with the future when it completes.  Callbacks are run by
+    the thread that reads the response from the serial port while it holds
+    _global_lock, so they should not block."""
+
+    def __init__(self, xbee, deadline, handle_response, force_com = False):
+        self.xbee = xbee
+        self.deadline = deadline
+        "Time after which the request times out"
+        self.handle_response = handle_response
+        "Returns the result for the AT response, None on a timeout, or raises the error"
+        self.force_com = force_com
+        self.frame_id = 0
+        "Frame ID of the request"
+        self.timer = None
+        "Timer that times out the request"
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        "Returns True once the request has completed"
+        return self._done
+
+    def _complete(self, at_response):
+        "Complete the request with its AT response, or None on a timeout, must hold _global_lock"
+        try:
+            self._set_result(self.handle_response(at_response))
+        except Exception as e:
+            self._exception = e
+            self._set_result(None)
+
+    def _set_result(self, result):
+        "Complete the request with result"
+        self._result = result
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.warning("exception in DDO callback: %s" % e)
+
+    def add_done_callback(self, callback):
+        "Call callback with this future when the request completes (right away if it has)"
+        _global_lock.acquire(True)
+        try:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        finally:
+            _global_lock.release()
+        callback(self)
+
+    def wait(self, timeout = None):
+        """Wait up to timeout seconds (until the request completes or times out
+        when None) for the request, returns done()"""
+        xbee = self.xbee
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        _global_lock.acquire(True)
+        try:
+            while not self._done:
+                now = time.time()
+                if self.deadline <= now:
+                    xbee._expire_ddo_request(self.frame_id)
+                    continue
+                wait = self.deadline - now
+                if end_time is not None:
+                    if end_time <= now:
+                        break
+                    wait = min(wait, end_time - now)
+                if not xbee.reader_running():
+                    # no reader thread, poll the serial port
+                    xbee.read_messages(force_com = self.force_com)
+                    if self._done:
+                        break
+                    wait = min(wait, SERIAL_POLL_TIME)
+                xbee.rx_condition.wait(wait)
+            return self._done
+        finally:
+            _global_lock.release()
+
+    def result(self, timeout = None):
+        "Wait for the request, returns its result or raises its error"
+        if not self.wait(timeout):
+            raise Exception("DDO_Future: timeout waiting for the DDO request")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout = None):
+        "Wait for the request, returns its error or None if it succeeded"
+        if not self.wait(timeout):
+            raise Exception("DDO_Future: timeout waiting for the DDO request")
+        return self._exception
+
+
+class DDO_Job(object):
+    """An AT request run by a DDO_Batch: reads id from the XBee at addr_extended
+    (None for the local XBee) when param is None, otherwise sets or runs id
+    with param.  Once the job is returned by DDO_Batch.results(), status is
+    the status of the AT response (or TIMEOUT) and result is the value it
+    returned."""
+    __slots__ = ("addr_extended", "id", "param", "apply", "attempts", "status", "result")
+    # Status
+    OK = 0
+    ERROR = 1
+    INVALID_COMMAND = 2
+    INVALID_PARAMETER = 3
+    TX_FAILURE = 4
+    TIMEOUT = -1
+    "No response was received"
+    RETRY = (TX_FAILURE, TIMEOUT)
+    "Status for which the request is sent again"
+
+    def __init__(self, addr_extended, id, param = None, apply = True):
+        self.addr_extended = addr_extended
+        self.id = _to_bytes(id)
+        self.param = param
+        "Value to set, None to read the parameter"
+        self.apply = apply
+        self.attempts = 0
+        "Times the request has been sent"
+        self.status = None
+        self.result = None
+
+    def __repr__(self):
+        return "<DDO_Job %s@%s status=%s result=%r>" % (self.id.decode("latin-1"), self.addr_extended,
+                                                         self.status, self.result)
+
+
+class DDO_Batch(object):
+    """Runs many AT requests, usually to remote XBees, at the same time.
+    
+    Jobs are added with add() and run while iterating over results(), which
+    returns each DDO_Job as it completes.  At most limit requests are waiting
+    for their response at a time, and node_limit for each node, and they are
+    sent at up to rate per second.  Jobs for a node run in the order they
+    were added, while the nodes take turns.  Requests that time out, or
+    could not be delivered, are sent again up to retries times.  The next
+    requests are sent as soon as responses arrive, by whichever thread
+    reads them, or by the XBee's timers when the rate holds them back."""
+
+    def __init__(self, xbee, limit = DDO_BATCH_LIMIT, node_limit = DDO_BATCH_NODE_LIMIT, rate = DDO_BATCH_RATE,
+                 retries = DDO_BATCH_RETRIES, timeout = DDO_BATCH_TIMEOUT):
+        self.xbee = xbee
+        self.limit = limit
+        self.node_limit = node_limit
+        self.rate = rate
+        self.retries = retries
+        self.timeout = timeout
+        self.queues = {}
+        "Jobs waiting to be sent, key = address, value = deque of DDO_Jobs"
+        self.ready = collections.deque()
+        "Addresses with jobs waiting that may be sent a request, in turn"
+        self._ready = set()
+        self.running = {}
+        "Requests waiting for a response, key = address, value = count"
+        self.in_flight = 0
+        self.waiting = 0
+        "Jobs added that have not completed yet"
+        self.completed = collections.deque()
+        "Completed DDO_Jobs not yet returned by results()"
+        self.next_send = 0
+        "Time the rate allows the next request to be sent"
+        self.timer = None
+        "Timer that sends more requests once the rate allows, while one is needed"
+
+    def add(self, addr_extended, id, param = None, apply = True):
+        "Add a job, returns its DDO_Job"
+        if not isinstance(id, STRING_TYPES) or len(id) != 2:
+            raise Exception("DDO_Batch.add: id must be a two character string")
+        if addr_extended is not None:
+            addr_extended = MAC_to_address_string(address_string_to_MAC(addr_extended))
+        job = DDO_Job(addr_extended, id, param, apply)
+        _global_lock.acquire(True)
+        try:
+            self.queues.setdefault(addr_extended, collections.deque()).append(job)
+            self.waiting += 1
+            self._check_ready(addr_extended)
+        finally:
+            _global_lock.release()
+        return job
+
+    def _check_ready(self, address):
+        "Let address take its turn if it has jobs waiting and room for a request, must hold _global_lock"
+        if (address not in self._ready and self.queues.get(address) and
+            self.running.get(address, 0) < self.node_limit):
+            self._ready.add(address)
+            self.ready.append(address)
+
+    def _start_jobs(self):
+        """Send the requests the limits allow, must hold _global_lock.
+        Returns the seconds until the rate allows another request, or None."""
+        while self.ready and self.in_flight < self.limit:
+            now = time.time()
+            if self.rate and self.next_send > now:
+                return self.next_send - now
+            address = self.ready.popleft()
+            self._ready.discard(address)
+            queue = self.queues[address]
+            job = queue.popleft()
+            if not queue:
+                del self.queues[address]
+            self.running[address] = self.running.get(address, 0) + 1
+            self.in_flight += 1
+            self._check_ready(address)
+            if self.rate:
+                self.next_send = max(now, self.next_send) + 1.0 / self.rate
+            self._send(job)
+        return None
+
+    def _pump(self):
+        """Send the requests the limits allow, and have the timers send the
+        next ones when the rate holds them back, must hold _global_lock.
+        Returns the seconds until the rate allows another request, or None."""
+        wait = self._start_jobs()
+        if wait is not None and self.timer is None:
+            self.timer = self.xbee.timers.schedule(time.time() + wait, self._rate_timer_expired)
+        return wait
+
+    def _rate_timer_expired(self):
+        self.timer = None
+        self._pump()
+
+    def _send(self, job):
+        "Send the request for job, must hold _global_lock"
+        job.attempts += 1
+        message = API_Message()
+        param = _ddo_value(job.param)
+        if job.addr_extended is None:
+            if job.apply:
+                message.api_data = Local_AT_Data(job.id, param)
+            else:
+                message.api_data = Local_AT_Queue_Data(job.id, param)
+        else:
+            message.api_data = Remote_AT_Data(job.addr_extended, job.id, param, job.apply)
+        def done(future):
+            self._job_done(job, future.result())
+            self._pump()
+        try:
+            self.xbee._send_ddo_request(message, self.timeout, lambda at_response: at_response, done)
+        except Exception as e:
+            logger.warning("DDO_Batch: failed to send %s: %s" % (job, e))
+            self._job_done(job, None)
+
+    def _job_done(self, job, at_response):
+        "Handle the response to a job's request (None on a timeout), must hold _global_lock"
+        address = job.addr_extended
+        self.in_flight -= 1
+        self.running[address] -= 1
+        if not self.running[address]:
+            del self.running[address]
+        if at_response is None:
+            job.status = DDO_Job.TIMEOUT
+            job.result = None
+        else:
+            job.status = at_response.api_data.status
+            job.result = at_response.api_data.value
+        if job.status in DDO_Job.RETRY and job.attempts <= self.retries:
+            # first in line for its node, to keep the order of its jobs
+            self.queues.setdefault(address, collections.deque()).appendleft(job)
+        else:
+            if job.status == DDO_Job.OK:
+                if job.param is None:
+                    self.xbee.ddo_cache.store(address, job.id, job.result)
+                else:
+                    self.xbee.ddo_cache.invalidate(address, job.id)
+            self.waiting -= 1
+            self.completed.append(job)
+        self._check_ready(address)
+
+    def results(self):
+        "Run the jobs, returns an iterator of the DDO_Jobs as they complete"
+        xbee = self.xbee
+        while True:
+            _global_lock.acquire(True)
+            try:
+                while not self.completed:
+                    if not self.waiting:
+                        return
+                    wait = self._pump()
+                    if self.completed:
+                        break
+                    xbee.timers.advance()
+                    if self.completed:
+                        break
+                    if wait is None:
+                        wait = SELECT_SLEEP_TIME
+                    if not xbee.reader_running():
+                        # no reader thread, poll the serial port
+                        xbee.read_messages()
+                        if self.completed:
+                            break
+                        wait = min(wait, SERIAL_POLL_TIME)
+                    xbee.rx_condition.wait(wait)
+                job = self.completed.popleft()
+            finally:
+                _global_lock.release()
+            yield job
+
+    __iter__ = results
+
+
+class Node_Table(object):
+    """The nodes known to an XBee, in the order they were found, indexed by
+    their 64-bit and 16-bit addresses.
+    
+    Short and parent addresses of nodes must be changed with set_short() and
+    set_parent(), to keep the indexes up to date.  The table can be saved to
+    a file and loaded from it, so the nodes are known as soon as the gateway
+    starts.  Loaded nodes keep the time they were last heard from, so they
+    are removed like the other nodes: once a complete discovery doesn't find
+    them, or once they haven't been heard from for NODE_MAX_AGE."""
+
+    FILE_VERSION = 2
+    "Version of the format written by save(), load() also reads version 1, which has no last_seen"
+
+    UNKNOWN_SHORT = "[FFFE]!"
+    "16-bit address of nodes whose network address isn't known"
+
+    UNKNOWN_VALUES = (None, "", b"", "unknown")
+    """Values of node fields that say nothing about the node, which add()
+    doesn't merge.  Addresses are also unknown when they are 0xFFFE."""
+
+    def __init__(self):
+        self.nodes = []
+        "Nodes, in the order they were added"
+        self.by_extended = {}
+        "Key = 64-bit address string, value = Node"
+        self.by_short = {}
+        "Key = 16-bit address string, value = Node"
+        self.by_parent = {}
+        "Key = 16-bit address string of a parent, value = {64-bit address string: Node} of its children"
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def list(self):
+        "Returns a copy of the list of nodes"
+        return self.nodes[:]
+
+    def get(self, addr_extended):
+        "Returns the node with a 64-bit address, None if there isn't one"
+        return self.by_extended.get(addr_extended)
+
+    def get_short(self, addr_short):
+        "Returns the node with a 16-bit address, None if there isn't one"
+        return self.by_short.get(addr_short)
+
+    def children(self, addr_short):
+        "Returns the nodes whose parent has a 16-bit address"
+        return list(self.by_parent.get(addr_short, {}).values())
+
+    def _parent_key(self, addr_parent):
+        "16-bit address string of a parent address (string or integer), None when there is no parent"
+        if addr_parent is None:
+            return None
+        if not isinstance(addr_parent, str):
+            addr_parent = short_to_address_string(addr_parent)
+        if addr_parent == self.UNKNOWN_SHORT:
+            return None
+        return addr_parent
+
+    def add(self, node):
+        """Add a node, returns the node in the table.  A node already in the
+        table with the same 64-bit address is updated with what is known
+        about the node instead, fields that are empty or unknown are left as
+        they were."""
+        known = self.by_extended.get(node.addr_extended)
+        if known is not None:
+            for name in ("type", "profile_id", "manufacturer_id", "label"):
+                value = getattr(node, name)
+                if value not in self.UNKNOWN_VALUES:
+                    setattr(known, name, value)
+            if self._parent_key(node.addr_parent) is not None:
+                self.set_parent(known, node.addr_parent)
+            if node.addr_short is not None and node.addr_short != self.UNKNOWN_SHORT:
+                self.set_short(known, node.addr_short)
+            if node.last_seen is not None and (known.last_seen is None or known.last_seen < node.last_seen):
+                known.last_seen = node.last_seen
+            return known
+        self.nodes.append(node)
+        self.by_extended[node.addr_extended] = node
+        if node.addr_short is not None and node.addr_short != self.UNKNOWN_SHORT:
+            previous = self.by_short.get(node.addr_short)
+            if previous is not None and previous is not node:
+                # the address was given to a new node
+                previous.addr_short = self.UNKNOWN_SHORT
+            self.by_short[node.addr_short] = node
+        parent = self._parent_key(node.addr_parent)
+        if parent is not None:
+            self.by_parent.setdefault(parent, {})[node.addr_extended] = node
+        return node
+
+    def seen(self, node, addr_short = None):
+        "Note that a node was heard from, using addr_short if given"
+        node.last_seen = time.time()
+        if addr_short is not None:
+            self.set_short(node, addr_short)
+
+    def set_short(self, node, addr_short):
+        "Change the 16-bit address of a node"
+        if node.addr_short == addr_short:
+            return
+        if self.by_short.get(node.addr_short) is node:
+            del self.by_short[node.addr_short]
+        node.addr_short = addr_short
+        if addr_short is not None and addr_short != self.UNKNOWN_SHORT:
+            previous = self.by_short.get(addr_short)
+            if previous is not None and previous is not node:
+                # the address was given to a new node
+                previous.addr_short = self.UNKNOWN_SHORT
+            self.by_short[addr_short] = node
+
+    def set_parent(self, node, addr_parent):
+        "Change the parent address of a node"
+        self._remove_child(node)
+        node.addr_parent = addr_parent
+        parent = self._parent_key(addr_parent)
+        if parent is not None:
+            self.by_parent.setdefault(parent, {})[node.addr_extended] = node
+
+    def _remove_child(self, node):
+        "Remove a node from the children of its parent"
+        parent = self._parent_key(node.addr_parent)
+        children = self.by_parent.get(parent)
+        if children is not None and children.get(node.addr_extended) is node:
+            del children[node.addr_extended]
+            if not children:
+                del self.by_parent[parent]
+
+    def remove(self, node):
+        "Remove a node"
+        if self.by_extended.get(node.addr_extended) is not node:
+            return
+        del self.by_extended[node.addr_extended]
+        if self.by_short.get(node.addr_short) is node:
+            del self.by_short[node.addr_short]
+        self._remove_child(node)
+        self.nodes.remove(node)
+
+    def prune(self, since):
+        "Remove the nodes not heard from since a time, returns the nodes removed"
+        removed = [node for node in self.nodes if node.last_seen is None or node.last_seen < since]
+        for node in removed:
+            self.remove(node)
+        return removed
+
+    def clear(self):
+        del self.nodes[:]
+        self.by_extended.clear()
+        self.by_short.clear()
+        self.by_parent.clear()
+
+    def save(self, filename):
+        """Write the nodes to a file.  They are written to a temporary file
+        first, which then replaces filename, so a crash while saving doesn't
+        leave a truncated file behind."""
+        nodes = []
+        for node in self.nodes:
+            addr_parent = node.addr_parent
+            if not isinstance(addr_parent, str):
+                addr_parent = short_to_address_string(addr_parent)
+            label = node.label
+            if isinstance(label, bytes):
+                label = label.decode("latin-1")
+            nodes.append([node.addr_extended, node.addr_short or self.UNKNOWN_SHORT, addr_parent,
+                          node.type, node.profile_id, node.manufacturer_id, label, node.last_seen])
+        temporary = filename + ".tmp"
+        fp = open(temporary, "w")
+        try:
+            json.dump({"version": self.FILE_VERSION, "nodes": nodes}, fp, separators=(",", ":"))
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        if hasattr(os, "replace"):
+            os.replace(temporary, filename)
+        else:
+            if os.name == "nt" and os.path.exists(filename):
+                # Python 2 can't rename over an existing file on Windows
+                os.remove(filename)
+            os.rename(temporary, filename)
+
+    def load(self, filename):
+        "Add the nodes saved to a file by save(), returns the number of nodes added"
+        fp = open(filename, "r")
+        try:
+            data = json.load(fp)
+        finally:
+            fp.close()
+        if data.get("version") not in (1, self.FILE_VERSION):
+            raise Exception("Node_Table.load: unknown file version %r" % data.get("version"))
+        # nodes saved without the time they were last heard from were heard
+        # from before the file was written
+        saved = os.path.getmtime(filename)
+        count = 0
+        for fields in data["nodes"]:
+            addr_extended, addr_short, addr_parent, type, profile_id, manufacturer_id, label = fields[:7]
+            last_seen = None
+            if len(fields) > 7:
+                last_seen = fields[7]
+            if last_seen is None:
+                last_seen = saved
+            if label is not None:
+                label = _to_bytes(label)
+            node = Node(str(type),
+                        MAC_to_address_string(address_string_to_MAC(str(addr_extended))),
+                        short_to_address_string(address_string_to_short(str(addr_short))),
+                        short_to_address_string(address_string_to_short(str(addr_parent))),
+                        profile_id, manufacturer_id, label)
+            node.last_seen = last_seen
+            if self.add(node) is node:
+                count += 1
+        return count
+
+
+class Node_Discovery(object):
+    """A node discovery run in the background by XBee.discover_nodes().
+    
+    Nodes are added to nodes, and to the node list of the XBee, as the ND
+    responses (802.15.4) or neighbor tables (ZigBee) arrive, starting with
+    the local node.  Once an 802.15.4 discovery ends, the nodes in the node
+    list that weren't heard from since prune_before are removed.  A ZigBee
+    discovery only waits for the neighbor tables for a while, so it doesn't
+    remove the nodes it didn't hear from.  Iterating over the discovery
+    returns each node as it is found, until the discovery ends.  Callbacks
+    are run by the thread that reads the responses while it holds
+    _global_lock, so they should not block."""
+
+    def __init__(self, xbee, deadline, frame_id = 0):
+        self.xbee = xbee
+        self.deadline = deadline
+        "Time the discovery ends"
+        self.frame_id = frame_id
+        "Frame ID of the ND command, 0 for a ZigBee discovery"
+        self.started = time.time()
+        self.prune_before = self.started
+        "Nodes in the node list not heard from since this time are removed when the discovery ends, None to keep them"
+        self.nodes = []
+        "Nodes found so far"
+        self._found_addresses = set()
+        self.timer = None
+        "Timer that ends the discovery"
+        self._done = False
+        self._callbacks = []
+
+    def done(self):
+        "Returns True once the discovery has ended"
+        return self._done
+
+    def add_callback(self, callback):
+        "Call callback with each node found, starting with those found already"
+        _global_lock.acquire(True)
+        try:
+            if not self._done:
+                self._callbacks.append(callback)
+            for node in self.nodes:
+                callback(node)
+        finally:
+            _global_lock.release()
+
+    def _found(self, node):
+        "Add a node found by the discovery, must hold _global_lock"
+        if node.addr_extended in self._found_addresses:
+            return
+        self._found_addresses.add(node.addr_extended)
+        self.nodes.append(node)
+        for callback in self._callbacks:
+            try:
+                callback(node)
+            except Exception as e:
+                logger.warning("exception in node discovery callback: %s" % e)
+
+    def _finish(self):
+        "End the discovery, must hold _global_lock"
+        self._done = True
+        self._callbacks = []
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.frame_id:
+            self.xbee.frame_ids.release(self.frame_id)
+
+    def _wait(self, done):
+        "Wait until done() or the discovery ends, must hold _global_lock"
+        xbee = self.xbee
+        while not done() and not self._done:
+            now = time.time()
+            if self.deadline <= now:
+                xbee._expire_node_discovery()
+                continue
+            wait = self.deadline - now
+            if not xbee.reader_running():
+                # no reader thread, poll the serial port
+                xbee.read_messages()
+                wait = min(wait, SERIAL_POLL_TIME)
+            xbee.rx_condition.wait(wait)
+
+    def wait(self):
+        "Wait for the discovery to end, returns the nodes found"
+        _global_lock.acquire(True)
+        try:
+            self._wait(lambda: False)
+            return self.nodes[:]
+        finally:
+            _global_lock.release()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            _global_lock.acquire(True)
+            try:
+                self._wait(lambda: index < len(self.nodes))
+                if index >= len(self.nodes):
+                    return
+                node = self.nodes[index]
+            finally:
+                _global_lock.release()
+            index += 1
+            yield node
+
+
+class Endpoint_Queue(object):
+    """Bounded queue of the messages received for an endpoint, which also
+    keeps the statistics for the queue.
+    
+    When the queue is full, either the oldest message is dropped to make room
+    (DROP_OLDEST) or the new message is dropped (DROP_NEWEST).  The time each
+    message arrived is kept alongside it to measure the receive latency."""
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+    DEFAULT_LIMIT = 1000
+    "Default maximum number of messages in a queue"
+
+    def __init__(self, limit = DEFAULT_LIMIT, policy = DROP_OLDEST):
+        self.messages = collections.deque()
+        "Received (payload, address) tuples"
+        self.arrivals = collections.deque()
+        "Time each message in messages was added"
+        self.limit = limit
+        "Maximum number of messages in the queue, 0 for no limit"
+        self.policy = policy
+        "What to drop when the queue is full"
+        self.high_water = 0
+        "Most messages the queue has held"
+        self.drops = 0
+        "Number of messages dropped because the queue was full"
+        self.wakeup = None
+        "Wakeup that is set while there are messages, created by fileno()"
+        self.condition = Condition(_global_lock)
+        "Notified when a message is added or the queue is closed"
+        self.closed = False
+        self.statistics = Endpoint_Statistics()
+        self.reassembler = None
+        "Fragment_Reassembler when the endpoint uses fragmentation"
+
+    def __len__(self):
+        return len(self.messages)
+
+    def fileno(self):
+        "File descriptor that select() sees as readable while there are messages"
+        if self.wakeup is None:
+            self.wakeup = Wakeup()
+            if self.messages:
+                self.wakeup.set()
+        return self.wakeup.fileno()
+
+    def close(self):
+        "Release the wakeup, if one was created, and wake up any receivers"
+        self.closed = True
+        self.condition.notify_all()
+        if self.wakeup is not None:
+            self.wakeup.close()
+            self.wakeup = None
+
+    def append(self, message, payload = True):
+        """Add a message to the queue, returns False if a message had to be
+        dropped.  payload is False for messages that aren't received data,
+        like Tx Status, which don't count towards bytes_rx."""
+        messages = self.messages
+        statistics = self.statistics
+        statistics.frames_rx += 1
+        if payload:
+            statistics.bytes_rx += len(message[0])
+        dropped = False
+        if self.limit and len(messages) >= self.limit:
+            self.drops += 1
+            dropped = True
+            if self.policy == self.DROP_NEWEST:
+                return False
+            while len(messages) >= self.limit:
+                messages.popleft()
+                self.arrivals.popleft()
+        messages.append(message)
+        self.arrivals.append(time.time())
+        if len(messages) > self.high_water:
+            self.high_water = len(messages)
+        if self.wakeup is not None:
+            self.wakeup.set()
+        self.condition.notify()
+        return not dropped
+
+    def deliver(self, message):
+        """Add a received (payload, address) message, which is first put back
+        together from its fragments when the endpoint uses fragmentation"""
+        if self.reassembler is not None:
+            message = self.reassembler.add(message[0], message[1])
+            if message is None:
+                return True
+        return self.append(message)
+
+    def popleft(self):
+        "Remove and return the oldest message"
+        message = self.messages.popleft()
+        self.statistics.rx_latency.record(time.time() - self.arrivals.popleft())
+        if not self.messages and self.wakeup is not None:
+            self.wakeup.clear()
+        return message
+
+    def popmany(self, count):
+        "Remove and return a list of up to count of the oldest messages"
+        messages = self.messages
+        arrivals = self.arrivals
+        if count >= len(messages):
+            popped = list(messages)
+            messages.clear()
+        else:
+            popleft = messages.popleft
+            popped = [popleft() for i in range(count)]
+        now = time.time()
+        record = self.statistics.rx_latency.record
+        for i in range(len(popped)):
+            record(now - arrivals.popleft())
+        if not messages and self.wakeup is not None:
+            self.wakeup.clear()
+        return popped
+
+
 class XBee:
     "Handles the connection to an XBee module"
     DIGI_PROFILE_ID = 0xC105
@@ -938,24 +2824,63 @@ class XBee:
     device_types = ["coordinator", "router", "end"]
     
     def __init__(self, serial = None):
-        # mutual exclusion lock:
-        global _global_lock
-        _global_lock = RLock()
         "Creates the connection to the XBee using the serial port."
         self.serial = serial
         "Serial port that connects to the xbee"
+        self.reader_thread = None
+        "Thread that reads from the serial port, see start_reader()"
+        self.reader_serial = None
+        "Serial port the reader thread reads from, the thread exits once it is closed or replaced"
+        self.rx_condition = Condition(_global_lock)
+        "Notified after received frames have been processed"
+        self.frame_ids = Frame_ID_Pool()
+        "Frame IDs of the frames sent to the XBee that are waiting on a response"
+        self.network_addresses = Network_Address_Cache()
+        "Last known network addresses of the remote nodes"
+        self.tx_window = TX_WINDOW
+        "Transmissions that may wait on their Tx Status at once"
+        self.tx_destination_window = TX_DESTINATION_WINDOW
+        "Transmissions to one destination that may wait on their Tx Status at once"
+        self.tx_condition = Condition(_global_lock)
+        "Notified when transmissions leave the Tx windows"
+        self.tx_wakeups = []
+        "Wakeups that are set while there is room in the Tx window, see add_tx_wakeup()"
+        self.tx_wakeup = None
+        "Tx wakeup shared by select and poll, see get_tx_wakeup()"
+        self.fragment_senders = []
+        "Fragment_Senders with fragments left to deliver, see send_fragments()"
+        self.max_payload_size = None
+        "Payload bytes that fit in one frame (NP), see max_payload()"
+        self.ddo_requests = {}
+        "DDO_Futures waiting on their AT response, key = frame ID"
+        self.ddo_cache = DDO_Cache()
+        "Parameter values read with ddo_get_param"
         self.rx_messages = {}
-        "Messages received from the XBee. Key = endpoint_id, value = (payload, full_source_address)"
-        self.rx_buffer = ""
+        "Messages received from the XBee. Key = endpoint_id, value = Endpoint_Queue of (payload, full_source_address)"
+        self.rx_decoder = API_Frame_Decoder()
         "Receive buffer for the serial port"
-        self.node_list = []
-        "Node list for the get_node_list function"
-        self.tx_status = {}
-        "Tx Status message buffer, key = XBee frame ID, value = (transaction_id, endpoint_id)"
+        self.node_table = Node_Table()
+        "Nodes for the get_node_list function"
+        self.discovery = None
+        "Node_Discovery in progress"
+        self.node_table_file = None
+        """File the node table is saved to when a node discovery ends or the
+        serial port is closed, and loaded from by load_node_table()"""
         # This needs to be here to allow us to support broadcasts at the top of ZigBee_Node.tick()
-        self.rx_messages[0xFF] = []
+        self.rx_messages[0xFF] = Endpoint_Queue()
         
+        self.timers = Timer_Wheel()
+        "Timeouts of DDO requests, ZDO conversations, node discoveries and fragments, and the topology refresh"
         self.lqi_cluster = ZDO_Mgmt_Lqi_cluster_client(self)
+        self.topology = Topology()
+        "Links of the network, from the neighbor tables of its routers"
+        self.lqi_queue = collections.deque()
+        "64-bit addresses of the routers waiting for their neighbor table to be read"
+        self._lqi_queued = set()
+        self.lqi_queries = {}
+        "LQI_aggregators reading neighbor tables, key = 64-bit address of the router"
+        self.topology_timer = None
+        "Timer that reads the neighbor tables that are out of date again, see refresh_topology()"
         self.device_annce_cluster = ZDO_Device_annce_cluster_server(self.device_announce_handler)
         self.hw_version = None
         self.sw_version = None
@@ -967,13 +2892,77 @@ class XBee:
             if self.serial:
                 self.serial.close()
             self.serial = None
-            self.rx_buffer = ""
-            self.node_list = []
+            self.rx_decoder.clear()
+            # a discovery or crawl in progress has a partial table, the
+            # last complete one was saved when it finished
+            self._save_node_table_when_refreshed()
+            self.node_table.clear()
+            self.topology.clear()
+            self.lqi_queue.clear()
+            self._lqi_queued.clear()
+            for aggregator in self.lqi_queries.values():
+                aggregator.cancel()
+            self.lqi_queries.clear()
+            if self.topology_timer is not None:
+                self.topology_timer.cancel()
+                self.topology_timer = None
+            if self.discovery is not None:
+                self.discovery._finish()
+                self.discovery = None
+            self.network_addresses.clear()
+            self.max_payload_size = None
+            self.ddo_cache.clear()
             #NOTE: leaving any messages that had been completely received
             com_port_opened = False  
+            # the reader thread exits once its current read times out, wake
+            # up anyone waiting on it now.
+            self.rx_condition.notify_all()
+        finally:
+            _global_lock.release()
+
+    def start_reader(self):
+        """Start a thread that drains the serial port in the background and
+        processes the frames as they arrive.  The serial port should have a
+        read timeout, so the thread can notice when the port is closed."""
+        _global_lock.acquire(True)
+        try:
+            if not self.reader_running():
+                # a reader for a previous serial port may still be finishing
+                # its last read, it exits on its own
+                self.reader_serial = self.serial
+                self.reader_thread = threading.Thread(target=self._reader, args=(self.serial,),
+                                                      name="XBee serial reader")
+                self.reader_thread.daemon = True
+                self.reader_thread.start()
         finally:
             _global_lock.release()
 
+    def reader_running(self):
+        "Returns True when the reader thread is handling the serial port"
+        return (self.reader_thread is not None and self.reader_thread.is_alive() and
+                self.reader_serial is self.serial)
+
+    def _reader(self, serial):
+        "Body of the reader thread, runs until serial is closed or replaced"
+        while self.serial is serial and serial is not None:
+            try:
+                # block until data is available (or the read times out)
+                data = serial.read(max(1, serial.inWaiting()))
+            except Exception as e:
+                if self.serial is serial:
+                    logger.warning("exception reading from the XBee serial port: %s" % str(e))
+                break
+            if data or self.timers.count:
+                _global_lock.acquire(True)
+                try:
+                    if self.serial is serial:
+                        self.rx_decoder.feed(data)
+                        self._process_frames(force_com=True)
+                        if self.timers.count:
+                            self.timers.advance()
+                finally:
+                    _global_lock.release()
+
     def set_version(self):
         self.hw_version = struct.unpack(">H", self.ddo_get_param(None, "HV", force_com=True))[0]
         self.sw_version = struct.unpack(">H", self.ddo_get_param(None, "VR", force_com=True))[0]
@@ -987,127 +2976,380 @@ class XBee:
     def register_endpoint(self, endpoint_id):
         "Registers an endpoint to save messages for"
         if endpoint_id not in self.rx_messages:
-            self.rx_messages[endpoint_id] = []
+            self.rx_messages[endpoint_id] = Endpoint_Queue()
 
     def unregister_endpoint(self, endpoint_id):
         "Un-registers an endpoint, so that the messages are no long saved"
-        if endpoint_id in self.rx_messages:
-            del self.rx_messages[endpoint_id]
+        _global_lock.acquire(True)
+        try:
+            if endpoint_id in self.rx_messages:
+                self.rx_messages.pop(endpoint_id).close()
+        finally:
+            _global_lock.release()
 
-    def recv(self, endpoint_id):
-        "Reads the messages from the XBee.  Returns from address and payload as a string"
+    def export_statistics(self, endpoint_id = None):
+        """Returns a dictionary of the statistics of a registered endpoint,
+        see Endpoint_Statistics.export(), with the receive queue depth,
+        high water mark and drops added.  Without endpoint_id, returns a
+        dictionary of them for all registered endpoints by endpoint ID."""
         _global_lock.acquire(True)
         try:
-            if self.serial is None or not self.serial.isOpen():
-                return None, None
-                #TODO: raise exception?
-            # checks for any new messages
-            self.read_messages()
-            # check to see if there are any messages waiting
-            if len(self.rx_messages[endpoint_id]):
-                # there was a message
-                recv_tuple = self.rx_messages[endpoint_id].pop(0)
-                return recv_tuple[0], recv_tuple[1] #payload, address
+            if endpoint_id is None:
+                return dict([(endpoint_id, self.export_statistics(endpoint_id)) for endpoint_id in self.rx_messages])
+            rx_queue = self.rx_messages.get(endpoint_id)
+            if rx_queue is None:
+                return None
+            statistics = rx_queue.statistics.export()
+            statistics["rcv_depth"] = len(rx_queue)
+            statistics["rcv_high_water"] = rx_queue.high_water
+            statistics["rcv_drops"] = rx_queue.drops
+            return statistics
         finally:
             _global_lock.release()
+
+    def recv(self, endpoint_id, timeout = 0):
+        """Reads the messages from the XBee.  Returns from address and payload as a string.
+        Waits up to timeout seconds for a message (forever when timeout is None),
+        returns None, None if there is none."""
+        messages = self.recv_many(endpoint_id, 1, timeout)
+        if messages:
+            return messages[0] #payload, address
         return None, None
 
-    def send(self, message):
+    def recv_many(self, endpoint_id, max_frames, timeout = 0):
+        """Reads up to max_frames messages for an endpoint at once.  Returns a
+        list of (payload, address) tuples, waiting up to timeout seconds for
+        the first message like recv(), and an empty list if there is none."""
+        _global_lock.acquire(True)
+        try:
+            end_time = None
+            if timeout:
+                end_time = time.time() + timeout
+            rx_queue = self.rx_messages[endpoint_id]
+            while 1:
+                if self.serial is not None and self.serial.isOpen():
+                    # checks for any new messages
+                    self.read_messages()
+                # check to see if there are any messages waiting
+                if len(rx_queue):
+                    return rx_queue.popmany(max_frames)
+                if rx_queue.closed or timeout == 0:
+                    return []
+                remaining = None
+                if end_time is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return []
+                if self.serial is not None and not self.reader_running():
+                    # no reader thread, poll the serial port
+                    if remaining is None:
+                        remaining = SERIAL_POLL_TIME
+                    rx_queue.condition.wait(min(remaining, SERIAL_POLL_TIME))
+                else:
+                    # the reader thread (or a local send) will wake us up
+                    rx_queue.condition.wait(remaining)
+        finally:
+            _global_lock.release()
+
+    def send(self, message, timeout = FRAME_TIMEOUT):
         "Send an API message"
+        self.send_many([message], timeout)
+
+    def send_many(self, messages, timeout = FRAME_TIMEOUT):
+        """Send a list of API messages.  The frames are all built up front and
+        written to the serial port with a single write.  Each message is given
+        a frame ID from frame_ids, reserved for timeout seconds or until the
+        response is handled.  Returns False if the serial port isn't open."""
         _global_lock.acquire(True)
         try:
-            # dev_idea: could keep track of frame_id and the responses.
-            if self.serial is not None and self.serial.isOpen():
-                self.serial.write(message.export())
-                debug_str = ""
-                if message.API_ID == 0x11:  #TODO: temporary filter
-                    debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
-                    #frame ID
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[0:1]]) + "]:"
-                    #64-bit address        
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[1:9]]) + "]:"
-                    #16-bit address        
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[9:11]]) + "]:"
-                    #source endpoint      
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[11:12]]) + "]:"
-                    #destination endpoint      
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[12:13]]) + "]:"
-                    #cluster     
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[13:15]]) + "]:"
-                    #profile     
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[15:17]]) + "]:"
-                    #broadcast radius   
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[17:18]]) + "]:"
-                    #options   
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[18:19]]) + "]:"
-                    #payload     
-                    debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[19:]]) + "]"
-                    if MESH_TRACEBACK and debug_callback is not None:
-                        debug_callback(debug_str)
+            if self.serial is None or not self.serial.isOpen():
+                # don't hold frame IDs for frames that aren't sent
+                return False
+            for message in messages:
+                if not message.api_data.frame_id:
+                    message.api_data.frame_id = self.frame_ids.allocate(timeout).frame_id
+            self.serial.write(b"".join([message.export() for message in messages]))
+            if MESH_TRACEBACK or logger.isEnabledFor(logging.DEBUG):
+                for message in messages:
+                    self._debug_tx(message)
+            return True
+        finally:
+            _global_lock.release()
+
+    def tx_window_open(self, destination = None, queued = 0, queued_to_destination = 0):
+        """Returns True if there is room in the Tx windows for another
+        transmission (to destination, if given).  queued and
+        queued_to_destination count transmissions the caller is about to send.
+        Transmissions whose Tx Status is overdue are released to make room."""
+        _global_lock.acquire(True)
+        try:
+            for attempt in (0, 1):
+                frame_ids = self.frame_ids
+                if frame_ids.in_flight + queued < self.tx_window and \
+                   (destination is None or
+                    frame_ids.in_flight_to(destination) + queued_to_destination < self.tx_destination_window):
+                    return True
+                if attempt or not frame_ids.expire_transmissions():
+                    return False
+                self._tx_window_changed()
+        finally:
+            _global_lock.release()
+
+    def wait_tx_window(self, destination = None, timeout = None):
+        """Wait for room in the Tx windows for a transmission to destination,
+        for up to timeout seconds (forever when timeout is None).  Returns
+        False if there is still no room."""
+        _global_lock.acquire(True)
+        try:
+            end_time = None
+            if timeout:
+                end_time = time.time() + timeout
+            while not self.tx_window_open(destination):
+                if timeout == 0:
+                    return False
+                # wake up when the oldest transmission is overdue, in case
+                # its Tx Status never arrives
+                wait = self.tx_window_wait_time()
+                if wait is None or wait < SERIAL_POLL_TIME:
+                    wait = SERIAL_POLL_TIME
+                if end_time is not None:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                if self.serial is not None and not self.reader_running():
+                    # no reader thread, poll the serial port for Tx Status
+                    self.read_messages()
+                    wait = min(wait, SERIAL_POLL_TIME)
+                self.tx_condition.wait(wait)
+            return True
+        finally:
+            _global_lock.release()
+
+    def tx_window_wait_time(self):
+        "Seconds until the oldest transmission in the Tx windows is overdue, None if there are none"
+        expiry = self.frame_ids.next_expiry()
+        if expiry is None:
+            return None
+        return max(expiry - time.time(), 0)
+
+    def add_tx_wakeup(self):
+        """Returns a new Wakeup that is set while there is room in the Tx window
+        of the XBee, release it with remove_tx_wakeup()"""
+        _global_lock.acquire(True)
+        try:
+            wakeup = Wakeup()
+            self.tx_wakeups.append(wakeup)
+            self._tx_window_changed()
+            return wakeup
+        finally:
+            _global_lock.release()
+
+    def remove_tx_wakeup(self, wakeup):
+        "Release a Wakeup returned by add_tx_wakeup()"
+        _global_lock.acquire(True)
+        try:
+            if wakeup in self.tx_wakeups:
+                self.tx_wakeups.remove(wakeup)
+                wakeup.close()
+        finally:
+            _global_lock.release()
+
+    def get_tx_wakeup(self):
+        "Returns the Tx wakeup shared by select and poll"
+        _global_lock.acquire(True)
+        try:
+            if self.tx_wakeup is None:
+                self.tx_wakeup = self.add_tx_wakeup()
+            return self.tx_wakeup
+        finally:
+            _global_lock.release()
+
+    def _tx_window_changed(self):
+        """Update the Tx wakeups and wake up the senders waiting on the Tx
+        windows, must hold _global_lock"""
+        if self.tx_wakeups:
+            window_open = self.frame_ids.in_flight < self.tx_window
+            for wakeup in self.tx_wakeups:
+                if window_open:
+                    wakeup.set()
                 else:
-                    debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
-                    debug_str += str([hex(ord(x)) for x in message.cmd_data])    
-                logger.debug(debug_str)
+                    wakeup.clear()
+        self.tx_condition.notify_all()
+        for sender in self.fragment_senders[:]:
+            sender.pump()
+
+    def max_payload(self):
+        "Payload bytes that fit in one frame, as reported by the XBee (NP)"
+        if self.max_payload_size is None:
+            try:
+                max_payload_size = 0
+                for byte in bytearray(self.ddo_get_param(None, "NP")):
+                    max_payload_size = (max_payload_size << 8) | byte
+            except Exception as e:
+                logger.debug("NP not available, using the default maximum payload: %s" % e)
+                max_payload_size = DEFAULT_MAX_PAYLOAD
+            self.max_payload_size = max_payload_size
+        return self.max_payload_size
+
+    def send_fragments(self, source_endpoint, destination_address, payload, message_id):
+        """Sends payload split into fragments that fit in a frame, each starting
+        with a FRAGMENT_HEADER.  Returns the Fragment_Sender delivering them, or
+        None if the message was looped back to a local endpoint."""
+        if destination_address[0] == "":
+            self.send_zb(source_endpoint, destination_address, FRAGMENT_HEADER.pack(message_id, 0, 1) + payload)
+            return None
+        size = self.max_payload() - FRAGMENT_HEADER.size
+        if len(destination_address) > 4 and destination_address[4] & socket.XBS_OPT_TX_APSSEC:
+            # APS encryption takes up room in the frame
+            size -= 4
+        count = max((len(payload) + size - 1) // size, 1)
+        if count > 255:
+            raise socket.error(errno.EMSGSIZE, "Message too long")
+        fragments = [FRAGMENT_HEADER.pack(message_id, index, count) + payload[index * size:(index + 1) * size]
+                     for index in range(count)]
+        _global_lock.acquire(True)
+        try:
+            sender = Fragment_Sender(self, source_endpoint, tuple(destination_address[:5]), fragments)
+            self.fragment_senders.append(sender)
+            sender.pump()
+            return sender
         finally:
             _global_lock.release()
+
+    def _debug_tx(self, message):
+        "Log a transmitted API message"
+        debug_str = ""
+        if message.API_ID == 0x11:  #TODO: temporary filter
+            debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
+            #frame ID
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[0:1])]) + "]:"
+            #64-bit address        
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[1:9])]) + "]:"
+            #16-bit address        
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[9:11])]) + "]:"
+            #source endpoint      
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[11:12])]) + "]:"
+            #destination endpoint      
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[12:13])]) + "]:"
+            #cluster     
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[13:15])]) + "]:"
+            #profile     
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[15:17])]) + "]:"
+            #broadcast radius   
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[17:18])]) + "]:"
+            #options   
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[18:19])]) + "]:"
+            #payload     
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[19:])]) + "]"
+            if MESH_TRACEBACK and debug_callback is not None:
+                debug_callback(debug_str)
+        else:
+            debug_str = "TX: API ID = %s\n" % hex(message.API_ID)
+            debug_str += str([hex(x) for x in bytearray(message.cmd_data)])    
+        logger.debug(debug_str)
         
-    def send_zb(self, source_endpoint, destination_address, payload):
+    def send_zb(self, source_endpoint, destination_address, payload, tx_callback = None):
         "Sends message to the XBee."
-        if destination_address[0] == "":
-            # this is a local message, loop back to received messages
-            # mask out profile and cluster ID
-            local_endpoint = destination_address[1]
-            if local_endpoint in self.rx_messages:
-                tx_status_tuple = None
+        self.send_zb_many(source_endpoint, [destination_address], payload, tx_callback)
+
+    def send_zb_many(self, source_endpoint, destination_addresses, payload, tx_callback = None):
+        """Sends the same payload to a list of destination addresses.  Messages
+        going out the XBee are written to the serial port all at once, and are
+        counted in the Tx windows until their Tx Status arrives (they are sent
+        even if the windows are full, see wait_tx_window()).  tx_callback, if
+        given, is called with the Tx Status data of each of them."""
+        rx_queue = self.rx_messages.get(source_endpoint)
+        if rx_queue is not None:
+            rx_queue.statistics.sent(len(destination_addresses), len(payload))
+        messages = []
+        for destination_address in destination_addresses:
+            if destination_address[0] == "":
+                self._send_zb_local(source_endpoint, destination_address, payload)
+            else:
+                messages.append(self._zb_message(source_endpoint, destination_address, payload))
+        if not messages:
+            return
+        _global_lock.acquire(True)
+        try:
+            for message in messages:
+                destination_address = message.api_data.destination_address
+                pending = self.frame_ids.allocate(TX_STATUS_TIMEOUT, destination_address[0])
+                pending.source_endpoint = source_endpoint
+                pending.sent = time.time()
+                pending.tx_callback = tx_callback
+                message.api_data.frame_id = pending.frame_id
+                #Handle 6th address parameter to receive transmit status.
                 if len(destination_address) >= 6 and destination_address[5] != -1:
-                    # create the tx status response
-                    tx_status_tuple = (0, "00:00:00:00:00:00:00:00!", source_endpoint, 0xC105, 0x8B, 0, destination_address[5])
-                
-                # create the tuple to store the message
-                # the source address will not have the profile and cluster IDs
-                # these are added based on the destination address
-                options = 0
-                if len(destination_address) > 4:
-                    # flag APS encryption if in original options
-                    options = destination_address[4] & socket.XBS_OPT_TX_APSSEC 
-                    # flag packet acknowledged, if not disabled
-                    options |= destination_address[4] ^ socket.XBS_OPT_RX_ACK 
-                full_source_address = ("", source_endpoint, destination_address[2], destination_address[3], options)
-                recv_tuple = (payload, full_source_address)
-                # add data to the message queue
-                if tx_status_tuple is not None:
-                    self.rx_messages[source_endpoint].append(tx_status_tuple)                            
-                self.rx_messages[local_endpoint].append(recv_tuple)
-
-        else:
+                    # track Tx Status message
+                    transaction_id = destination_address[5]
+                    pending.tx_status = (transaction_id, source_endpoint)
             # send message out the XBee
-            message = API_Message()
-            if self.is_802_15_4():
-                # create an 802.15.4 message
-                if len(destination_address[0]) <= 8: #'[xxxx]!' or '[xx:xx]!'
-                    # this is a 16-bit address
-                    message.API_ID = IEEE_802_15_4_16_Data.tx_id
-                    zb_data = IEEE_802_15_4_16_Data()
-                else:
-                    # this is a 64-bit address 
-                    message.API_ID = IEEE_802_15_4_64_Data.tx_id
-                    zb_data = IEEE_802_15_4_64_Data()
+            if not self.send_many(messages):
+                # nothing was sent, nothing will be acknowledged
+                for message in messages:
+                    self.frame_ids.release(message.api_data.frame_id)
+            self._tx_window_changed()
+        finally:
+            _global_lock.release()
+
+    def _zb_message(self, source_endpoint, destination_address, payload):
+        "Create the API message to send payload out the XBee"
+        message = API_Message()
+        if self.is_802_15_4():
+            # create an 802.15.4 message
+            if len(destination_address[0]) <= 8: #'[xxxx]!' or '[xx:xx]!'
+                # this is a 16-bit address
+                message.API_ID = IEEE_802_15_4_16_Data.tx_id
+                zb_data = IEEE_802_15_4_16_Data()
             else:
-                #assume this radio uses the ZB packets
-                message.API_ID = ZB_Data.tx_id
-                zb_data = ZB_Data()
-            zb_data.source_address = ("", source_endpoint, 0, 0)
-            zb_data.destination_address = destination_address
-            zb_data.payload = payload
-            message.api_data = zb_data
-            self.send(message)
-        
-            #Handle 6th address parameter to receive transmit status.
+                # this is a 64-bit address 
+                message.API_ID = IEEE_802_15_4_64_Data.tx_id
+                zb_data = IEEE_802_15_4_64_Data()
+        else:
+            #assume this radio uses the ZB packets
+            message.API_ID = ZB_Data.tx_id
+            zb_data = ZB_Data()
+            if len(destination_address[0]) > 8:
+                zb_data.destination_address_16 = self.network_addresses.lookup(destination_address[0])
+        zb_data.source_address = ("", source_endpoint, 0, 0)
+        zb_data.destination_address = destination_address
+        zb_data.payload = payload
+        message.api_data = zb_data
+        return message
+
+    def _send_zb_local(self, source_endpoint, destination_address, payload):
+        "Loop a message for a local endpoint back to the received messages"
+        # this is a local message, loop back to received messages
+        # mask out profile and cluster ID
+        local_endpoint = destination_address[1]
+        if local_endpoint in self.rx_messages:
+            tx_status_tuple = None
             if len(destination_address) >= 6 and destination_address[5] != -1:
-                # track Tx Status message
-                transaction_id = destination_address[5]
-                frame_id = message.api_data.frame_id 
-                self.tx_status[frame_id] = (transaction_id, source_endpoint)
+                # create the tx status response, the same as one from the XBee
+                delivery_status = _BYTE.pack(ZigBee_Tx_Status_Data.rx_id) + ZigBee_Tx_Status_Data().export()
+                tx_status_tuple = (delivery_status, ("[00:00:00:00:00:00:00:00]!", source_endpoint, 0xC105,
+                                                     ZigBee_Tx_Status_Data.rx_id, 0, destination_address[5]))
+            
+            # create the tuple to store the message
+            # the source address will not have the profile and cluster IDs
+            # these are added based on the destination address
+            options = 0
+            if len(destination_address) > 4:
+                # flag APS encryption if in original options
+                options = destination_address[4] & socket.XBS_OPT_TX_APSSEC 
+                # flag packet acknowledged, if not disabled
+                options |= destination_address[4] ^ socket.XBS_OPT_RX_ACK 
+            full_source_address = ("", source_endpoint, destination_address[2], destination_address[3], options)
+            recv_tuple = (payload, full_source_address)
+            # add data to the message queue
+            _global_lock.acquire(True)
+            try:
+                if tx_status_tuple is not None and source_endpoint in self.rx_messages:
+                    self.rx_messages[source_endpoint].append(tx_status_tuple, payload = False)
+                self.rx_messages[local_endpoint].deliver(recv_tuple)
+            finally:
+                _global_lock.release()
 
     def process_message(self, message, message_buffer, AT_frame_id = 0, force_com=False):
         # pass data to XBS_PROT_XAPI sockets if applicable
@@ -1122,26 +3364,26 @@ class XBee:
         if message.API_ID == 0x91:  #TTDO: temporary filter
             debug_str = "RX: API ID = %s\n" % hex(message.API_ID)
             #64-bit address        
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[0:8]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[0:8])]) + "]:"
             #16-bit address
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[8:10]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[8:10])]) + "]:"
             #source endpoint
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[10:11]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[10:11])]) + "]:"
             #destination endpoint
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[11:12]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[11:12])]) + "]:"
             #cluster ID
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[12:14]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[12:14])]) + "]:"
             #profile ID
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[14:16]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[14:16])]) + "]:"
             #options
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[16:17]]) + "]:"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[16:17])]) + "]:"
             #payload
-            debug_str += "[" + ", ".join(["%02X" %(ord(x)) for x in message.cmd_data[17:]]) + "]"
+            debug_str += "[" + ", ".join(["%02X" % x for x in bytearray(message.cmd_data[17:])]) + "]"
             if MESH_TRACEBACK and debug_callback is not None:
                 debug_callback(debug_str)
         else:
             debug_str = "RX: API ID = %s\n" % hex(message.API_ID)
-            debug_str += str([hex(ord(x)) for x in message.cmd_data])
+            debug_str += str([hex(x) for x in bytearray(message.cmd_data)])
         logger.debug(debug_str)
         
         if message.API_ID == ZB_Data.rx_id: # CMD ID for explicit receive
@@ -1149,6 +3391,7 @@ class XBee:
             zb_data = message.api_data
             # make sure the address is registered, check with address = ""
             local_endpoint = zb_data.destination_address[1]
+            self.network_addresses.learn(zb_data.source_address[0], zb_data.source_address_16)
             
             # check for Device Announce
             if zb_data.destination_address[1] == 0 and\
@@ -1165,12 +3408,14 @@ class XBee:
                 self.lqi_cluster.handle_message(frame)
             
             # check if a new remote device
-            if zb_data.destination_address[0]:
-                for node in self.node_list:
-                    if zb_data.destination_address[0] == node.addr_extended:
-                        break
+            source = zb_data.source_address[0]
+            if len(source) > 8 and len(self.node_table): # only the 16-bit address may be known
+                addr_short = short_to_address_string(zb_data.source_address_16)
+                node = self.node_table.get(source)
+                if node is None:
+                    self._new_node(source, addr_short)
                 else:
-                    self._new_node(zb_data.destination_address[0])
+                    self._node_seen(node, addr_short)
                         
             if local_endpoint in self.rx_messages:
                 if zb_data.source_address is None:
@@ -1181,10 +3426,10 @@ class XBee:
                 if local_endpoint == 0xFF:
                     for endpoint_id in self.rx_messages:
                         if endpoint_id != 0:    #but don't give the message to the ZDO endpoint  #TTDO: is this correct?
-                            self.rx_messages[endpoint_id].append(recv_tuple)
+                            self.rx_messages[endpoint_id].deliver(recv_tuple)
                 else:
                     # add data to the message queue
-                    self.rx_messages[local_endpoint].append(recv_tuple)
+                    self.rx_messages[local_endpoint].deliver(recv_tuple)
         elif message.API_ID in (IEEE_802_15_4_16_Data.rx_id, 
                                 IEEE_802_15_4_64_Data.rx_id): # explicit 802.15.4 message
             #extract the message
@@ -1197,7 +3442,7 @@ class XBee:
                 # create the tuple to store the message
                 recv_tuple = (zb_data.payload, zb_data.source_address)
                 # add data to the message queue
-                self.rx_messages[local_endpoint].append(recv_tuple)
+                self.rx_messages[local_endpoint].deliver(recv_tuple)
         elif message.API_ID in (IEEE_802_15_4_16_IO.rx_id,
                                 IEEE_802_15_4_64_IO.rx_id): # 802.15.4 IO message
             #extract the message
@@ -1211,12 +3456,24 @@ class XBee:
         elif message.API_ID == Local_AT_Data.rx_id: #cmd ID for local AT response
             #extract the at_data
             at_data = message.api_data
+            # hand the response to anyone waiting for it
+            pending = self.frame_ids.get(at_data.frame_id)
+            if pending is not None:
+                pending.responses.append(message)
+            self._complete_ddo_request(message)
+            if self.discovery is not None and at_data.frame_id == self.discovery.frame_id:
+                self._node_discovery_response(at_data)
             # check if this is the message we are waiting for
             if at_data.frame_id == AT_frame_id:
                 return message
         elif message.API_ID == Remote_AT_Data.rx_id: #cmd ID for remote AT response
             #extract the at_data
             at_data = message.api_data
+            # hand the response to anyone waiting for it
+            pending = self.frame_ids.get(at_data.frame_id)
+            if pending is not None:
+                pending.responses.append(message)
+            self._complete_ddo_request(message)
             # check if this is the message we are waiting for
             if at_data.frame_id == AT_frame_id:
                 return message
@@ -1224,12 +3481,43 @@ class XBee:
             # match to 6th address parameter if enabled
             # extract the tx_response
             status_data = message.api_data
-            if status_data.frame_id in self.tx_status:
+            destination = None
+            pending = self.frame_ids.get(status_data.frame_id)
+            if pending is not None:
+                destination = pending.destination
+            # the transmission is done, free up its frame ID
+            pending = self.frame_ids.release(status_data.frame_id)
+            if pending is not None and pending.tx_callback is not None:
+                try:
+                    pending.tx_callback(status_data)
+                except Exception as e:
+                    logger.warning("exception in Tx Status callback: %s" % e)
+            if pending is not None:
+                self._tx_window_changed()
+                if message.API_ID == ZigBee_Tx_Status_Data.rx_id and destination is not None:
+                    self._tx_status_address(destination, status_data)
+                rx_queue = self.rx_messages.get(pending.source_endpoint)
+                if rx_queue is not None and pending.sent is not None:
+                    rx_queue.statistics.tx_status(status_data.delivery_status, time.time() - pending.sent)
+            if pending is not None and pending.tx_status is not None:
                 # Tx Status matches existing frame id, queue response in socket
-                transaction_id, endpoint_id = self.tx_status[status_data.frame_id]
-                delivery_status = chr(ZigBee_Tx_Status_Data.rx_id) + status_data.export()
+                transaction_id, endpoint_id = pending.tx_status
+                delivery_status = _BYTE.pack(ZigBee_Tx_Status_Data.rx_id) + status_data.export()
                 tx_status_tuple = (delivery_status, ("[00:00:00:00:00:00:00:00]!", endpoint_id, 0xC105, message.API_ID, 0, transaction_id))
-                self.rx_messages[endpoint_id].append(tx_status_tuple)                                        
+                if endpoint_id in self.rx_messages:
+                    self.rx_messages[endpoint_id].append(tx_status_tuple, payload = False)
+        elif message.API_ID == Modem_Status_Data.rx_id: #cmd ID for Modem Status message
+            status = message.api_data.status
+            if status in (Modem_Status_Data.HARDWARE_RESET, Modem_Status_Data.WATCHDOG_TIMER_RESET):
+                # the XBee restarted, parameters may have changed
+                self.ddo_cache.clear()
+                self.max_payload_size = None
+            elif status in (Modem_Status_Data.JOINED_NETWORK, Modem_Status_Data.DISASSOCIATED,
+                            Modem_Status_Data.COORDINATOR_STARTED):
+                self.ddo_cache.invalidate(None, b"MY")
+                self.ddo_cache.invalidate(None, b"MP")
+            elif status == Modem_Status_Data.MODEM_CONFIGURATION_CHANGED:
+                self.ddo_cache.invalidate(None)
         else:
             # we are currently not handling this message type
             logger.debug("Not handling API message with ID %02X" % message.API_ID)
@@ -1237,49 +3525,96 @@ class XBee:
         return None
 
 
+    def _tx_status_address(self, destination, status_data):
+        """Update the network address cache from the Tx Status of a transmission
+        to destination: a delivered message reports the current network address,
+        a failed address discovery means the cached one was wrong."""
+        if status_data.delivery_status == ZigBee_Tx_Status_Data.SUCCESS:
+            self.network_addresses.learn(destination, status_data.remote_network_address)
+        elif status_data.delivery_status == ZigBee_Tx_Status_Data.ADDRESS_NOT_FOUND or \
+             status_data.discovery_status != ZigBee_Tx_Status_Data.NO_DISCOVERY_OVERHEAD:
+            self.network_addresses.invalidate(destination)
+
     def read_messages(self, AT_frame_id = 0, force_com=False):
         """Reads messages from the serial port, return message if it matches
-        the AT_frame_id (meant to be used for AT commands)"""
+        the AT_frame_id (meant to be used for AT commands).
+        When the reader thread is running it does all of the reading, and
+        this returns None."""
         if not force_com and not com_port_opened:
             return None
         _global_lock.acquire(True)
         try:
+            if self.reader_running():
+                return None
             if self.serial is not None and self.serial.isOpen():
-                self.rx_buffer += self.serial.read(self.serial.inWaiting()) #read everything that is available
-            while 1:
-                # sanitize buffer up to first candidate API frame:
-                s_idx = self.rx_buffer.find('\x7e')
-                if s_idx != -1:
-                    self.rx_buffer = self.rx_buffer[s_idx:]
-                message = API_Message() #create message and try to fill it from the serial port data.
-                status = message.extract(self.rx_buffer)
-                if status < 0:
-                    # not enough buffer for the message
+                self.rx_decoder.feed(self.serial.read(self.serial.inWaiting())) #read everything that is available
+            at_response = self._process_frames(AT_frame_id, force_com)
+            if self.timers.count:
+                self.timers.advance()
+            return at_response
+        finally:
+            _global_lock.release()
+
+    def _process_frames(self, AT_frame_id = 0, force_com=False):
+        """Process the complete frames in the receive buffer, stopping early
+        if one is the AT response for AT_frame_id (which is returned).
+        Must be called holding _global_lock."""
+        at_response = None
+        processed = False
+        while at_response is None:
+            # save off the frame, may be used for XBS_PROT_XAPI
+            message_buffer = self.rx_decoder.next_frame()
+            if message_buffer is None:
+                # not enough buffer for the message
+                break
+            message = API_Message() #create message and fill it from the frame
+            message.extract(message_buffer)
+            processed = True
+            try:
+                at_response = self.process_message(message, message_buffer, AT_frame_id, force_com)
+            except Exception as e:
+                logger.warning("exception during API message processing: %s" % str(e))
+        if processed:
+            self.rx_condition.notify_all()
+        return at_response
+
+    def _wait_AT_response(self, frame_id, timeout, force_com=False, collect=False):
+        """Wait for the AT response to the command sent with frame_id, then
+        release the frame ID.  Returns the response, or None on a timeout.  When collect is True, all of the responses received
+        within the timeout are returned in a list (used for node discovery).
+        _global_lock is released while waiting."""
+        end_time = time.time() + timeout
+        _global_lock.acquire(True)
+        try:
+            pending = self.frame_ids.get(frame_id)
+            if pending is None:
+                return None
+            responses = pending.responses
+            while collect or not responses:
+                remaining = end_time - time.time()
+                if remaining <= 0:
                     break
-                # save off the message, may be used for XBS_PROT_XAPI
-                message_buffer = self.rx_buffer[:status]
-                # received frame, remove from buffer
-                self.rx_buffer = self.rx_buffer[status:]
-                if message.is_valid():
-                    try:
-                        return self.process_message(message, message_buffer, AT_frame_id, force_com)
-                    except Exception, e:
-                        logger.warning("exception during API message processing: %s" % str(e))
+                if self.reader_running():
+                    self.rx_condition.wait(remaining)
                 else:
-                    # Advance rx_buffer; useful in the case where ~~ appears in stream
-                    # unexpectedly. It's been seeon on OSX a few times; likely due to faulty
-                    # flow control. The message parser must advance in order to allow it to
-                    # continue.
-                    self.rx_buffer = self.rx_buffer[1:]
+                    # no reader thread, poll the serial port
+                    self.read_messages(force_com = force_com)
+                    if collect or not responses:
+                        self.rx_condition.wait(min(remaining, SERIAL_POLL_TIME))
+            if collect:
+                return responses
+            elif responses:
+                return responses[0]
+            return None
         finally:
+            self.frame_ids.release(frame_id)
             _global_lock.release()
-        return None
 
     def register_joining_device(self, addr_extended, key, timeout = 0):
         "Register a device with the local XBee using a unique link key"
         #TTDO: keep track of timeout
         message = API_Message()
-        message.api_data = Register_Device_Data(addr_extended, key)
+        message.api_data = Register_Device_Data(addr_extended, _to_bytes(key))
         self.send(message)
         return True
     
@@ -1291,177 +3626,264 @@ class XBee:
         self.send(message)
         return True
     
-    def ddo_get_param(self, addr_extended, id, timeout=1, order=False, force_com=False):
-        "Get a Digi Device Objects parameter value (only local address currently supported)"
-        _global_lock.acquire(True)
-        try:
-            if not force_com and not com_port_opened: #a global
-                raise Exception("ddo_get_param: serial port not open")
-            # check format of id
-            if not isinstance(id, str):
-                raise Exception("ddo_get_param() argument 2 must be string or read-only buffer, not " + str(id.type()))
-            elif len(id) != 2:
-                raise Exception("ddo_get_param: id string must be two characters!")
-            # create message to send.
-            message = API_Message()
-            if addr_extended is None:
-                message.api_data = Local_AT_Data(id)
-                self.send(message)
-            else:
-                if not isinstance(addr_extended, str):
-                    # TTDO: this should be type error
-                    raise Exception("ddo_get_param: addr_extended must be a string or None.")
-#                if len(addr_extended) != 26:
-#                    #TTDO: should do better test of format...
-#                    raise Exception("ddo_get_param: addr_extended format is invalid!")
-                message.api_data = Remote_AT_Data(addr_extended, id)    
-                self.send(message)            
-            # wait to receive response
-            AT_frame_id = message.api_data.frame_id
-            at_response = None
-            start_time = time.time()
-            while start_time + timeout > time.time():
-                at_response = self.read_messages(AT_frame_id, force_com = force_com)
-                if at_response is not None:
-                    break
-            else:
+    def ddo_get_param(self, addr_extended, id, timeout=1, order=False, force_com=False, use_cache=True):
+        """Get a Digi Device Objects parameter value (only local address currently supported).
+        The value may come from ddo_cache, unless use_cache is False."""
+        return self.ddo_get_param_async(addr_extended, id, timeout, order, force_com=force_com,
+                                        use_cache=use_cache).result()
+
+    def ddo_get_param_async(self, addr_extended, id, timeout=1, order=False, callback=None, force_com=False,
+                            use_cache=True):
+        """Start getting a Digi Device Objects parameter value, returns a
+        DDO_Future whose result is the value.  callback, if given, is called
+        with the DDO_Future once the response arrives or times out.  Values in
+        ddo_cache complete the future right away, unless use_cache is False."""
+        if not force_com and not com_port_opened: #a global
+            raise Exception("ddo_get_param: serial port not open")
+        # check format of id
+        if not isinstance(id, STRING_TYPES):
+            raise Exception("ddo_get_param() argument 2 must be string or read-only buffer, not " + type(id).__name__)
+        elif len(id) != 2:
+            raise Exception("ddo_get_param: id string must be two characters!")
+        # create message to send.
+        message = API_Message()
+        if addr_extended is None:
+            message.api_data = Local_AT_Data(_to_bytes(id))
+        else:
+            if not isinstance(addr_extended, str):
+                # TTDO: this should be type error
+                raise Exception("ddo_get_param: addr_extended must be a string or None.")
+#            if len(addr_extended) != 26:
+#                #TTDO: should do better test of format...
+#                raise Exception("ddo_get_param: addr_extended format is invalid!")
+            message.api_data = Remote_AT_Data(addr_extended, _to_bytes(id))    
+        if use_cache:
+            value = self.ddo_cache.get(addr_extended, id)
+            if value is not None:
+                future = DDO_Future(self, time.time(), None)
+                future._set_result(value)
+                if callback is not None:
+                    callback(future)
+                return future
+
+        def handle_response(at_response):
+            if at_response is None:
                 raise Exception("ddo_get_param: timeout fetching DDO parameter (%s@%s)." % (str(id), str(addr_extended)))
+            if at_response.api_data.status == 0:
+                self.ddo_cache.store(addr_extended, id, at_response.api_data.value)
             return at_response.api_data.value
-        finally:
-            _global_lock.release()
+        return self._send_ddo_request(message, timeout, handle_response, callback, force_com)
 
     def ddo_set_param(self, addr_extended, id, value, timeout=1, order=False, apply=True):
         "Set a Digi Device Objects parameter value"
-        _global_lock.acquire(True)
-        try:
-            if not com_port_opened: #a global
-                raise Exception("ddo_set_param: serial port not opened")
-            # check format of id
-            if not isinstance(id, str):
-                # TTDO: this should be a type error
-                raise Exception("ddo_set_param() argument 2 must be string or read-only buffer, not " + str(id.type()))
-            elif len(id) != 2:
-                raise Exception("ddo_set_param: id string must be two characters!")
-            # convert integer values to a string
-            if isinstance(value, int) or isinstance(value, long):
-                value_str = "" 
-                # convert to big endian string representation
-                while value > 0:
-                    value_str = chr(value & 0xFF) + value_str
-                    value /= 0x100
-                if value_str == "":
-                    # default to zero 
-                    value_str = chr(0)
-                value = value_str
-                        
-            # create message to send.
-            message = API_Message()
-            if addr_extended is None:
-                message.api_data = Local_AT_Data(id, value)    
-                self.send(message)
-            else:
-                if not isinstance(addr_extended, str):
-                    # TTDO: this should be type error
-                    raise Exception("ddo_set_param: addr_extended must be a string or None.")
-                if len(addr_extended) != 24 and len(addr_extended) != 26: # depends on "[" and "]"
-                    #TTDO: should do better test of format...
-                    raise Exception("ddo_set_param: addr_extended format is invalid!")
-                message.api_data = Remote_AT_Data(addr_extended, id, value)    
-                self.send(message)
-            
-            # wait to receive response
-            AT_frame_id = message.api_data.frame_id
-            at_response = None
-            start_time = time.time()
-            while start_time + timeout > time.time():
-                at_response = self.read_messages(AT_frame_id)
-                if at_response is not None:
-                    break
+        return self.ddo_set_param_async(addr_extended, id, value, timeout, order, apply).result()
+
+    def ddo_set_param_async(self, addr_extended, id, value, timeout=1, order=False, apply=True, callback=None):
+        """Start setting a Digi Device Objects parameter value, returns a
+        DDO_Future whose result is True once the XBee accepted the value.
+        callback, if given, is called with the DDO_Future once the response
+        arrives or times out.  When apply is False the value is queued until
+        an AC command (see ddo_set_params)."""
+        if not com_port_opened: #a global
+            raise Exception("ddo_set_param: serial port not opened")
+        # check format of id
+        if not isinstance(id, STRING_TYPES):
+            # TTDO: this should be a type error
+            raise Exception("ddo_set_param() argument 2 must be string or read-only buffer, not " + type(id).__name__)
+        elif len(id) != 2:
+            raise Exception("ddo_set_param: id string must be two characters!")
+        value = _ddo_value(value)
+                    
+        # create message to send.
+        message = API_Message()
+        if addr_extended is None:
+            if apply:
+                message.api_data = Local_AT_Data(_to_bytes(id), value)
             else:
+                message.api_data = Local_AT_Queue_Data(_to_bytes(id), value)
+        else:
+            if not isinstance(addr_extended, str):
+                # TTDO: this should be type error
+                raise Exception("ddo_set_param: addr_extended must be a string or None.")
+            if len(addr_extended) != 24 and len(addr_extended) != 26: # depends on "[" and "]"
+                #TTDO: should do better test of format...
+                raise Exception("ddo_set_param: addr_extended format is invalid!")
+            message.api_data = Remote_AT_Data(addr_extended, _to_bytes(id), value, apply)
+
+        # whatever the outcome, the cached value may be stale
+        self.ddo_cache.invalidate(addr_extended, id)
+
+        def handle_response(at_response):
+            if at_response is None:
                 raise Exception("ddo_set_param: timeout setting DDO parameter (%s@%s)." % (str(id), str(addr_extended))) # on timeout or error
-            
             if at_response.api_data.status == 0:
                 # success
                 return True
-            else:
-                raise Exception("ddo_set_param: error setting DDO parameter (%s@%s)." % (str(id), str(addr_extended)))
-            return False
-        finally:
-            _global_lock.release()
+            raise Exception("ddo_set_param: error setting DDO parameter (%s@%s)." % (str(id), str(addr_extended)))
+        return self._send_ddo_request(message, timeout, handle_response, callback)
+
+    def ddo_batch(self, jobs = (), **keywords):
+        """Returns a DDO_Batch, taking the DDO_Batch keyword arguments, with
+        jobs added from (addr_extended, id[, param]) tuples.  Iterate over it
+        to run the jobs:
+        
+            for job in xbee.ddo_batch([(addr, "VR") for addr in addresses]):
+                print(job.addr_extended, job.status, repr(job.result))"""
+        batch = DDO_Batch(self, **keywords)
+        for job in jobs:
+            batch.add(*job)
+        return batch
+
+    def ddo_get_params(self, addr_extended, ids, timeout=1, use_cache=True):
+        """Get several Digi Device Objects parameter values at once, returns a
+        dictionary of the values by id.  The requests are all sent before
+        waiting for the responses, so they take about one round trip."""
+        futures = [(id, self.ddo_get_param_async(addr_extended, id, timeout, use_cache=use_cache))
+                   for id in ids]
+        return dict((id, future.result()) for id, future in futures)
+
+    def ddo_set_params(self, addr_extended, params, timeout=1, apply=True):
+        """Set several Digi Device Objects parameter values at once, params
+        is a dictionary, or a sequence of (id, value) pairs to set them in
+        order.  The values are queued and, when apply is True, applied
+        together by an AC sent right after them, without waiting for the
+        responses in between."""
+        if hasattr(params, "items"):
+            params = params.items()
+        futures = [self.ddo_set_param_async(addr_extended, id, value, timeout, apply=False)
+                   for id, value in params]
+        if apply:
+            futures.append(self.ddo_command_async(addr_extended, "AC", timeout=timeout))
+        error = None
+        for future in futures:
+            # wait for all of the responses before reporting an error
+            if future.exception() is not None and error is None:
+                error = future.exception()
+        if error is not None:
+            raise error
+        return True
             
     def ddo_command(self, addr_extended, id, param=None, timeout=1, order=False, apply=True):
         "Execute a Digi Device Objects AT command (only local address currently supported)"
-        _global_lock.acquire(True)
-        try:
-            if not com_port_opened: #a global
-                raise Exception("ddo_command: serial port not opened")
-            # check format of id
-            if not isinstance(id, str):
-                # TTDO: this should be a type error
-                raise Exception("ddo_command() argument 2 must be string or read-only buffer, not " + str(id.type()))
-            elif len(id) != 2:
-                raise Exception("ddo_command: id string must be two characters!")
-            # convert integer values to a string
-            if isinstance(param, int) or isinstance(param, long):
-                param_str = ""
-                # convert to big endian string representation
-                while param > 0:
-                    param_str = chr(param & 0xFF) + param_str
-                    param /= 0x100
-                if param_str == "":
-                    # default to zero 
-                    param_str = chr(0)
-                param = param_str
-            elif param is None:
-                param = ""
-                        
-            # create message to send.
-            message = API_Message()
-            if addr_extended is None:
-                message.api_data = Local_AT_Data(id, param)
-                self.send(message)
-            else:
-                if not isinstance(addr_extended, str):
-                    # TTDO: this should be type error
-                    raise Exception("ddo_command: addr_extended must be a string or None.")
-                if len(addr_extended) != 24 and len(addr_extended) != 26: # depends on "[" and "]"
-                    #TTDO: should do better test of format...
-                    raise Exception("ddo_command: addr_extended format is invalid!")
-                message.api_data = Remote_AT_Data(addr_extended, id, param)
-                self.send(message)
-
-            # wait to receive response
-            AT_frame_id = message.api_data.frame_id
-            at_response = None
-            start_time = time.time()
-            while start_time + timeout > time.time():
-                at_response = self.read_messages(AT_frame_id)
-                if at_response is not None:
-                    break
-            else:
+        return self.ddo_command_async(addr_extended, id, param, timeout, order, apply).result()
+
+    def ddo_command_async(self, addr_extended, id, param=None, timeout=1, order=False, apply=True, callback=None):
+        """Start executing a Digi Device Objects AT command, returns a DDO_Future
+        whose result is the value returned by the command, or None.  callback,
+        if given, is called with the DDO_Future once the response arrives or
+        times out."""
+        if not com_port_opened: #a global
+            raise Exception("ddo_command: serial port not opened")
+        # check format of id
+        if not isinstance(id, STRING_TYPES):
+            # TTDO: this should be a type error
+            raise Exception("ddo_command() argument 2 must be string or read-only buffer, not " + type(id).__name__)
+        elif len(id) != 2:
+            raise Exception("ddo_command: id string must be two characters!")
+        param = _ddo_value(param)
+                    
+        # create message to send.
+        message = API_Message()
+        if addr_extended is None:
+            message.api_data = Local_AT_Data(_to_bytes(id), param)
+        else:
+            if not isinstance(addr_extended, str):
+                # TTDO: this should be type error
+                raise Exception("ddo_command: addr_extended must be a string or None.")
+            if len(addr_extended) != 24 and len(addr_extended) != 26: # depends on "[" and "]"
+                #TTDO: should do better test of format...
+                raise Exception("ddo_command: addr_extended format is invalid!")
+            message.api_data = Remote_AT_Data(addr_extended, _to_bytes(id), param)
+
+        if _to_bytes(id).upper() in (b"RE", b"FR", b"NR"):
+            # resets and restores defaults change the parameters
+            self.ddo_cache.invalidate(addr_extended)
+        else:
+            self.ddo_cache.invalidate(addr_extended, id)
+
+        def handle_response(at_response):
+            if at_response is None:
                 raise Exception("ddo_command: timeout performing DDO command (%s@%s)." % (str(id), str(addr_extended)))
             if at_response.api_data.status == 0:
                 if len(at_response.api_data.value) == 0:
                     return None
                 else:
                     return at_response.api_data.value
-            else:
-                raise Exception("ddo_command: error performing DDO command (%s@%s)." % (str(id), str(addr_extended)))
+            raise Exception("ddo_command: error performing DDO command (%s@%s)." % (str(id), str(addr_extended)))
+        return self._send_ddo_request(message, timeout, handle_response, callback)
+
+    def _send_ddo_request(self, message, timeout, handle_response, callback = None, force_com = False):
+        """Send an AT command message, returns the DDO_Future that handle_response
+        completes with the response (or None on a timeout)"""
+        _global_lock.acquire(True)
+        try:
+            pending = self.frame_ids.allocate(timeout)
+            message.api_data.frame_id = pending.frame_id
+            future = DDO_Future(self, pending.deadline, handle_response, force_com)
+            future.frame_id = pending.frame_id
+            if callback is not None:
+                future.add_done_callback(callback)
+            self.ddo_requests[pending.frame_id] = future
+            future.timer = self.timers.schedule(pending.deadline, self._ddo_timeout_callback(pending.frame_id))
+            self.send(message, timeout)
+            return future
         finally:
             _global_lock.release()
+
+    def _complete_ddo_request(self, at_response):
+        "Hand an AT response to the DDO_Future waiting for it, must hold _global_lock"
+        frame_id = at_response.api_data.frame_id
+        future = self.ddo_requests.pop(frame_id, None)
+        if future is not None:
+            future.timer.cancel()
+            self.frame_ids.release(frame_id)
+            future._complete(at_response)
+
+    def _ddo_timeout_callback(self, frame_id):
+        return lambda: self._expire_ddo_request(frame_id)
+
+    def _expire_ddo_request(self, frame_id):
+        "Complete a DDO request whose response is overdue, must hold _global_lock"
+        future = self.ddo_requests.pop(frame_id, None)
+        if future is not None:
+            future.timer.cancel()
+            self.frame_ids.release(frame_id)
+            future._complete(None)
+            self.rx_condition.notify_all()
     
     def get_node_list(self, refresh=True, blocking=True):
-        "Perform a node discovery (blocking when refresh == True)"
+        """Returns the node list, after performing a node discovery when
+        refresh == True (blocking until it ends when blocking == True).  See
+        discover_nodes() to get the nodes as they are found."""
+        if refresh:
+            discovery = self.discover_nodes()
+            if blocking:
+                discovery.wait()
         _global_lock.acquire(True)
         try:
             # Add local node to table if not already there
-            if len(self.node_list) == 0:
-                self.node_list.append(self._create_local_node())
-            
-            if refresh:
+            if len(self.node_table) == 0:
+                self.node_table.add(self._create_local_node())
+            return self.node_table.list()
+        finally:
+            _global_lock.release()
+
+    def discover_nodes(self, callback=None):
+        """Start a node discovery in the background, or join the one in
+        progress, and returns its Node_Discovery.  callback, if given, is
+        called with each node as it is found, starting with the local node.
+        The nodes are added to the node list as they are found, and for
+        802.15.4 the nodes that weren't found are removed from it when the
+        discovery ends.  A ZigBee discovery only reads the neighbor tables
+        that are out of date, see refresh_topology()."""
+        _global_lock.acquire(True)
+        try:
+            discovery = self.discovery
+            if discovery is None:
+                local_node = self._create_local_node()
                 if self.is_802_15_4():
                     # Node discover using the ND command on the XBee
-                    nt_str = ddo_get_param(None, "NT")
+                    nt_str = self.ddo_get_param(None, "NT")
                     # support 1 or 2 byte return
                     if len(nt_str) == 1:
                         nt, = struct.unpack(">B", nt_str)
@@ -1470,66 +3892,125 @@ class XBee:
                     else:
                         nt = 0xFF
                     node_discovery_timeout = nt / 10.0 # in seconds
-                    response_list = []
                     # start Node discovery
                     message = API_Message()
-                    message.api_data = Local_AT_Data("ND")    
-                    self.send(message)            
-                    # wait to receive responses
-                    AT_frame_id = message.api_data.frame_id
-                    at_response = None
-                    start_time = time.time()
-                    while start_time + node_discovery_timeout > time.time():
-                        at_response = self.read_messages(AT_frame_id)
-                        if at_response is not None:
-                            # store responses for parsing later.
-                            response_list.append(at_response)
-                    # parse responses
-                    self.node_list = self.node_list[1:] #remove all but the first item (local node)
-                    device_types = ["coordinator", "router", "end"]
-                    for at_response in response_list:
-                        msg = at_response.api_data.value
-                        if self.is_802_15_4():
-                            addr_short, addr_extended, rssi = struct.unpack(">HQB", msg[:11])
-                            index = 11
-                        else:
-                            addr_short, addr_extended = struct.unpack(">HQ", msg[:10])
-                            index = 10
-                        # convert 16-bit address into a formatted string
-                        addr_short = short_to_address_string(addr_short)
-                        # convert 64-bit address into a formatted string
-                        addr_extended = MAC_to_address_string(addr_extended)
-                        label = ""
-                        for character in msg[index:]:
-                            if character != chr(0):
-                                label += character
-                            else:
-                                break
-                        if self.is_802_15_4():
-                            self.node_list.append(Node(device_types[1], addr_extended, addr_short, 0xFFFE, 0xC105, 0x101E, label))
-                        else:
-                            index += len(label) + 1
-                            addr_parent, radio_type, status, profile_id, manufacturer_id = struct.unpack(">HBBHH", msg[index:index + 8])
-                            # turn type into a string
-                            radio_type = device_types[radio_type]
-                            self.node_list.append(Node(radio_type, addr_extended, addr_short, addr_parent, profile_id, manufacturer_id, label))
+                    message.api_data = Local_AT_Data(b"ND")
+                    message.api_data.frame_id = self.frame_ids.allocate(node_discovery_timeout).frame_id
+                    discovery = Node_Discovery(self, time.time() + node_discovery_timeout, message.api_data.frame_id)
                 else:
-                    # send request to own neighbor table to start discovery
-                    for node in self.node_list:
-                        LQI_aggregator(self.lqi_cluster, node.addr_extended, 0, self._LQI_callback)
-                    self.node_list = self.node_list[:1] #remove all but the first item (local node)
-                    
-                    start_time = time.time()
-                    while time.time() < start_time + 3: #NOTE: used to be 6.625 (as measured on CPX2)
-                        self.read_messages()
-                        if not blocking:
-                            break
-                        time.sleep(.1)
-                                  
-            return self.node_list[:]
+                    discovery = Node_Discovery(self, time.time() + LQI_DISCOVERY_TIME)
+                    # the neighbor tables that are read by the time the
+                    # discovery ends don't tell which nodes are gone
+                    discovery.prune_before = None
+                self.discovery = discovery
+                discovery.timer = self.timers.schedule(discovery.deadline, self._expire_node_discovery)
+                self._node_found(local_node)
+                if self.is_802_15_4():
+                    self.send(message, node_discovery_timeout)
+                else:
+                    for router in list(self.topology.links.keys()):
+                        if not self.topology.stale(router):
+                            for addr_extended in [router] + list(self.topology.links[router].keys()):
+                                node = self.node_table.get(addr_extended)
+                                if node is not None:
+                                    discovery._found(node)
+                    # read the neighbor tables that are out of date, starting with our own
+                    self._queue_lqi_query(local_node.addr_extended)
+                    self.refresh_topology()
+                    if self.topology_timer is None:
+                        self._schedule_topology_refresh()
+            if callback is not None:
+                discovery.add_callback(callback)
+            return discovery
         finally:
             _global_lock.release()
-        
+
+    def _node_found(self, node):
+        "Add a node to the node table, and to the node discovery in progress, must hold _global_lock"
+        self._node_seen(self.node_table.add(node))
+
+    def _node_seen(self, node, addr_short = None):
+        "Note that a node in the node table was heard from, must hold _global_lock"
+        self.node_table.seen(node, addr_short)
+        if self.discovery is not None:
+            self.discovery._found(node)
+
+    def _expire_node_discovery(self):
+        "End the node discovery in progress if its time is up, must hold _global_lock"
+        if self.discovery is not None and self.discovery.deadline <= time.time():
+            discovery = self.discovery
+            discovery._finish()
+            self.discovery = None
+            if discovery.prune_before is not None:
+                for node in self.node_table.prune(discovery.prune_before):
+                    logger.debug("node %s not found by discovery, removed" % node.addr_extended)
+            for node in self.node_table.prune(time.time() - NODE_MAX_AGE):
+                logger.debug("node %s not heard from for %d seconds, removed" % (node.addr_extended, NODE_MAX_AGE))
+            self._save_node_table_when_refreshed()
+            self.rx_condition.notify_all()
+
+    def _save_node_table_when_refreshed(self):
+        "Save the node table, unless neighbor tables are still being read into it, must hold _global_lock"
+        if not self.lqi_queries and not self.lqi_queue and self.discovery is None:
+            self.save_node_table()
+
+    def load_node_table(self):
+        "Add the nodes saved to node_table_file to the node table, returns the number added"
+        if self.node_table_file is None or not os.path.isfile(self.node_table_file):
+            return 0
+        _global_lock.acquire(True)
+        try:
+            return self.node_table.load(self.node_table_file)
+        except Exception as e:
+            logger.warning("unable to load the node table from %s: %s" % (self.node_table_file, e))
+            return 0
+        finally:
+            _global_lock.release()
+
+    def save_node_table(self):
+        "Save the node table to node_table_file, if there is one"
+        if self.node_table_file is None or not len(self.node_table):
+            return
+        _global_lock.acquire(True)
+        try:
+            self.node_table.save(self.node_table_file)
+        except Exception as e:
+            logger.warning("unable to save the node table to %s: %s" % (self.node_table_file, e))
+        finally:
+            _global_lock.release()
+
+    def _node_discovery_response(self, at_data):
+        "Add the node from an ND response, must hold _global_lock"
+        msg = at_data.value
+        if not msg:
+            # an empty response ends the discovery
+            self.discovery.deadline = 0
+            self._expire_node_discovery()
+            return
+        if len(msg) < 10:
+            return
+        device_types = ["coordinator", "router", "end"]
+        if self.is_802_15_4():
+            addr_short, addr_extended, rssi = struct.unpack(">HQB", msg[:11])
+            index = 11
+        else:
+            addr_short, addr_extended = struct.unpack(">HQ", msg[:10])
+            index = 10
+        # convert 16-bit address into a formatted string
+        addr_short = short_to_address_string(addr_short)
+        # convert 64-bit address into a formatted string
+        addr_extended = MAC_to_address_string(addr_extended)
+        self.network_addresses.learn(addr_extended, addr_short)
+        label = msg[index:].split(b"\x00", 1)[0]
+        if self.is_802_15_4():
+            self._node_found(Node(device_types[1], addr_extended, addr_short, 0xFFFE, 0xC105, 0x101E, label))
+        else:
+            index += len(label) + 1
+            addr_parent, radio_type, status, profile_id, manufacturer_id = struct.unpack(">HBBHH", msg[index:index + 8])
+            # turn type into a string
+            radio_type = device_types[radio_type]
+            self._node_found(Node(radio_type, addr_extended, addr_short, addr_parent, profile_id, manufacturer_id, label))
+
     def _create_local_node(self):
         """Create Node object based on local device"""
         # first time calling get_node_list, lets get the local data as well.
@@ -1544,7 +4025,7 @@ class XBee:
 
         if VR & 0xF000 == 0x3000:
             # this is a smart energy device, no NI string
-            label = ""
+            label = b""
         else:
             label = self.ddo_get_param(None, "ni")
         
@@ -1574,31 +4055,134 @@ class XBee:
         new_node = Node(type = node_type,\
                         addr_extended  = addr_extended,\
                         addr_short = addr_short)
-        self.node_list.append(new_node)
-        LQI_aggregator(self.lqi_cluster, addr_extended, 0, self._LQI_callback)
+        self._node_found(new_node)
+        if node_type != self.device_types[2]:
+            # end devices have no neighbor table
+            self._queue_lqi_query(addr_extended)
+
+    def refresh_topology(self, max_age = TOPOLOGY_MAX_AGE):
+        """Read the neighbor tables of the routers in the node list that
+        haven't been read for max_age seconds, LQI_QUERY_LIMIT at a time.
+        Returns the number of routers queued, see topology for the links."""
+        _global_lock.acquire(True)
+        try:
+            queued = 0
+            for node in self.node_table:
+                if node.type != self.device_types[2] and self.topology.stale(node.addr_extended, max_age):
+                    if self._queue_lqi_query(node.addr_extended):
+                        queued += 1
+            return queued
+        finally:
+            _global_lock.release()
+
+    def _schedule_topology_refresh(self):
+        "Read the neighbor tables that are out of date again in TOPOLOGY_MAX_AGE seconds, must hold _global_lock"
+        self.topology_timer = self.timers.schedule(time.time() + TOPOLOGY_MAX_AGE, self._refresh_topology_timer)
+
+    def _refresh_topology_timer(self):
+        self.topology_timer = None
+        if self.serial is not None:
+            self.refresh_topology(TOPOLOGY_MAX_AGE)
+            self._schedule_topology_refresh()
+
+    def _queue_lqi_query(self, router):
+        "Queue reading the neighbor table of a router, returns False if it already is, must hold _global_lock"
+        if router in self.lqi_queries or router in self._lqi_queued:
+            return False
+        self.lqi_queue.append(router)
+        self._lqi_queued.add(router)
+        self._start_lqi_queries()
+        return True
+
+    def _start_lqi_queries(self):
+        "Start reading the queued neighbor tables, up to LQI_QUERY_LIMIT at a time, must hold _global_lock"
+        while self.lqi_queue and len(self.lqi_queries) < LQI_QUERY_LIMIT:
+            router = self.lqi_queue.popleft()
+            self._lqi_queued.discard(router)
+            self.lqi_queries[router] = LQI_aggregator(self.lqi_cluster, router, 0, self._lqi_query_callback(router),
+                                                      timeout_callback = self._lqi_query_timed_out)
+        self._save_node_table_when_refreshed()
+
+    def _lqi_query_callback(self, router):
+        return lambda record_list: self._lqi_query_done(router, record_list)
+
+    def _lqi_query_timed_out(self, aggregator):
+        "Give up on a neighbor table whose response is overdue, must hold _global_lock"
+        if self.lqi_queries.get(aggregator.dest_address) is aggregator:
+            del self.lqi_queries[aggregator.dest_address]
+            self.topology.failed(aggregator.dest_address)
+            self._start_lqi_queries()
+
+    def _lqi_query_done(self, router, record_list):
+        "Handle the neighbor table read from a router, must hold _global_lock"
+        aggregator = self.lqi_queries.pop(router, None)
+        if aggregator is None:
+            # the query was cancelled
+            return
+        children = self.topology.children(router)
+        self.topology.update(router, record_list)
+        self._LQI_callback(record_list, router)
+        self._remove_lost_children(router, children, aggregator.started)
+        self._start_lqi_queries()
+
+    def _remove_lost_children(self, router, children, since):
+        """Remove the nodes that were children of a router, by its last
+        neighbor table or by their parent address, but aren't in the neighbor
+        table just read from it, nor children of another router, and haven't
+        been heard from since the table started to be read.  Must hold
+        _global_lock."""
+        parent = self.node_table.get(router)
+        lost = set(children)
+        if parent is not None and parent.addr_short not in (None, Node_Table.UNKNOWN_SHORT):
+            for node in self.node_table.children(parent.addr_short):
+                if node is not parent:
+                    lost.add(node.addr_extended)
+        neighbors = self.topology.links.get(router, {})
+        for addr_extended in lost:
+            node = self.node_table.get(addr_extended)
+            if node is None or addr_extended in neighbors:
+                continue
+            if node.last_seen is not None and node.last_seen >= since:
+                continue
+            if self.topology.parent(addr_extended) is not None:
+                # it moved to another parent
+                continue
+            self.node_table.remove(node)
+            self.topology.remove(addr_extended)
+            logger.debug("node %s no longer a child of %s, removed" % (addr_extended, router))
+
     
-    def _LQI_callback(self, record_list):
+    def _LQI_callback(self, record_list, router = None):
         """callback for LQI aggregator on a Device"""
         #print "LQI final callback called"
+        parent = None
+        if router is not None:
+            parent = self.node_table.get(router)
         for record in record_list:
-            for node in self.node_list:
-                if record.addr_extended == node.addr_extended:
-                    # already have a reference to this node...
-                    node.addr_short = record.addr_short
-                    break
+            self.network_addresses.learn(record.addr_extended, record.addr_short)
+            node = self.node_table.get(record.addr_extended)
+            if node is not None:
+                # already have a reference to this node...
+                self._node_seen(node, record.addr_short)
             else:
                 #construct a new lqi_aggregator and add it as a node
-                self._new_node(record.addr_extended, record.addr_short, self.device_types[record.device_type])
+                node_type = "unknown"
+                if record.device_type < len(self.device_types):
+                    node_type = self.device_types[record.device_type]
+                self._new_node(record.addr_extended, record.addr_short, node_type)
+                node = self.node_table.get(record.addr_extended)
+            if parent is not None and record.relationship == Neighbor_Link.CHILD:
+                self.node_table.set_parent(node, parent.addr_short)
     
     def device_announce_handler(self, record):
         """callback for device announce"""
         addr_short = short_to_address_string(record.nwk_addr)
         addr_extended = MAC_to_address_string(record.IEEE_addr)
-        for node in self.node_list:
-            if addr_extended == node.addr_extended:
-                # already have a reference to this node...
-                node.addr_short = addr_short
-                break
+        self.network_addresses.learn(addr_extended, addr_short)
+        node = self.node_table.get(addr_extended)
+        if node is not None:
+            # already have a reference to this node...
+            self._node_seen(node, addr_short)
         else:
             #construct a new lqi_aggregator and add it as a node
             self._new_node(addr_extended, addr_short)
@@ -1617,27 +4201,39 @@ def unregister_joining_device(addr_extended, timeout = 0):
 
 def ddo_get_param(*params, **keywords):
     "Get a Digi Device Objects parameter value (only local address currently supported)"
-    _global_lock.acquire(True)
-    try:
-        return default_xbee.ddo_get_param(*params, **keywords)
-    finally:
-        _global_lock.release()
+    return default_xbee.ddo_get_param(*params, **keywords)
 
 def ddo_set_param(*params, **keywords):
     "Set a Digi Device Objects parameter value (only local address currently supported)"
-    _global_lock.acquire(True)
-    try:
-        return default_xbee.ddo_set_param(*params, **keywords)
-    finally:
-        _global_lock.release()
+    return default_xbee.ddo_set_param(*params, **keywords)
         
 def ddo_command(*params, **keywords):
     "Execute a Digi Device Objects AT command (only local address currently supported)"
-    _global_lock.acquire(True)
-    try:
-        return default_xbee.ddo_command(*params, **keywords)
-    finally:
-        _global_lock.release()
+    return default_xbee.ddo_command(*params, **keywords)
+
+def ddo_get_params(*params, **keywords):
+    "Get several Digi Device Objects parameter values at once, returns a dictionary by id"
+    return default_xbee.ddo_get_params(*params, **keywords)
+
+def ddo_set_params(*params, **keywords):
+    "Set several Digi Device Objects parameter values at once and apply them together"
+    return default_xbee.ddo_set_params(*params, **keywords)
+
+def ddo_batch(*params, **keywords):
+    "Returns a DDO_Batch to run many AT requests at once, iterate over it for the completed DDO_Jobs"
+    return default_xbee.ddo_batch(*params, **keywords)
+
+def ddo_get_param_async(*params, **keywords):
+    "Start getting a Digi Device Objects parameter value, returns a DDO_Future"
+    return default_xbee.ddo_get_param_async(*params, **keywords)
+
+def ddo_set_param_async(*params, **keywords):
+    "Start setting a Digi Device Objects parameter value, returns a DDO_Future"
+    return default_xbee.ddo_set_param_async(*params, **keywords)
+
+def ddo_command_async(*params, **keywords):
+    "Start executing a Digi Device Objects AT command, returns a DDO_Future"
+    return default_xbee.ddo_command_async(*params, **keywords)
 
 
 def getnodelist(refresh = True):
@@ -1649,11 +4245,11 @@ def getnodelist(refresh = True):
     return a cached copy of the discovery list.  This cached
     version may include devices which were unable to respond
     within the discovery timeout imposed during a blocking call."""
-    _global_lock.acquire(True)
-    try:
-        return default_xbee.get_node_list(refresh)
-    finally:
-        _global_lock.release()
+    return default_xbee.get_node_list(refresh)
+
+def discover_nodes(*params, **keywords):
+    "Start a node discovery in the background, returns a Node_Discovery that can be iterated over for the nodes"
+    return default_xbee.discover_nodes(*params, **keywords)
 
 # second name for getting a node list
 get_node_list = getnodelist        
@@ -1711,13 +4307,54 @@ __register_with_socket_module("XBS_SOL_APS")
 # SOL_SOCKET parameters
 socket.SO_NONBLOCK = 0
 __register_with_socket_module("SO_NONBLOCK")
+if not hasattr(socket, "SO_RCVTIMEO"):
+    socket.SO_RCVTIMEO = 20
+    __register_with_socket_module("SO_RCVTIMEO")
+"Receive timeout in seconds for blocking XBee sockets, 0 to wait forever"
+if not hasattr(socket, "SO_SNDTIMEO"):
+    socket.SO_SNDTIMEO = 21
+    __register_with_socket_module("SO_SNDTIMEO")
+"Seconds a blocking XBee socket waits for room in the Tx window when sending, 0 to wait forever"
 # XBS_SOL_ENDPOINT / XBS_SOL_EP parameters
 socket.XBS_SO_EP_FRAMES_TX = 16385
+"Number of frames sent from the endpoint (read only)"
 __register_with_socket_module("XBS_SO_EP_FRAMES_TX")
 socket.XBS_SO_EP_FRAMES_RX = 16386
+"Number of messages received for the endpoint, including dropped ones (read only)"
 __register_with_socket_module("XBS_SO_EP_FRAMES_RX")
 socket.XBS_SO_EP_TX_STATUS = 20482
 __register_with_socket_module("XBS_SO_EP_TX_STATUS")    
+# receive queue options, the queue length limit is set with SOL_SOCKET/SO_RCVBUF (in messages)
+socket.XBS_SO_EP_RCV_POLICY = 32513
+"What to drop when the receive queue is full, XBS_RCV_DROP_OLDEST or XBS_RCV_DROP_NEWEST"
+__register_with_socket_module("XBS_SO_EP_RCV_POLICY")
+socket.XBS_SO_EP_RCV_DEPTH = 32514
+"Number of messages in the receive queue (read only)"
+__register_with_socket_module("XBS_SO_EP_RCV_DEPTH")
+socket.XBS_SO_EP_RCV_HIGH_WATER = 32515
+"Most messages the receive queue has held (read only)"
+__register_with_socket_module("XBS_SO_EP_RCV_HIGH_WATER")
+socket.XBS_SO_EP_RCV_DROPS = 32516
+"Number of messages dropped because the receive queue was full (read only)"
+__register_with_socket_module("XBS_SO_EP_RCV_DROPS")
+# endpoint statistics, see also XBS_SO_EP_FRAMES_TX and XBS_SO_EP_FRAMES_RX
+socket.XBS_SO_EP_BYTES_TX = 32517
+"Number of payload bytes sent from the endpoint (read only)"
+__register_with_socket_module("XBS_SO_EP_BYTES_TX")
+socket.XBS_SO_EP_BYTES_RX = 32518
+"Number of payload bytes received for the endpoint (read only)"
+__register_with_socket_module("XBS_SO_EP_BYTES_RX")
+socket.XBS_SO_EP_TX_FAILURES = 32519
+"Number of Tx Status with a failed delivery for frames sent from the endpoint (read only)"
+__register_with_socket_module("XBS_SO_EP_TX_FAILURES")
+socket.XBS_SO_EP_FRAGMENTATION = 32520
+"""Non-zero to split messages that don't fit in a frame into fragments and
+put received fragments back together, the other end must use it as well"""
+__register_with_socket_module("XBS_SO_EP_FRAGMENTATION")
+socket.XBS_RCV_DROP_OLDEST = Endpoint_Queue.DROP_OLDEST
+__register_with_socket_module("XBS_RCV_DROP_OLDEST")
+socket.XBS_RCV_DROP_NEWEST = Endpoint_Queue.DROP_NEWEST
+__register_with_socket_module("XBS_RCV_DROP_NEWEST")
 # XBS_SOL_APS parameters
 
 class Node:
@@ -1740,13 +4377,15 @@ class Node:
         "node manufacturer ID"
         self.label = label
         "the nodes string label"
+        self.last_seen = time.time()
+        "Time the node was last heard from, for a node loaded from a file the time saved with it"
 
     def to_socket_addr(self, endpoint, profile_id, cluster_id, use_short):
         "Transform a node into a socket address tuple"
         if use_short:
-            return [MAC_to_address_string(self.addr_short, 2), endpoint, profile_id, cluster_id]
+            return [self.addr_short, endpoint, profile_id, cluster_id]
         else:
-            return [MAC_to_address_string(self.addr_extended), endpoint, profile_id, cluster_id]
+            return [self.addr_extended, endpoint, profile_id, cluster_id]
 
     def __str__(self):
         "Print only the type and address of the node"
@@ -1762,7 +4401,7 @@ class Node:
 original_select = select.select
 "Storage for the non-XBee type of Python select"
 SELECT_SLEEP_TIME = 0.05
-"Time to sleep in seconds between polls of the sockets"
+"Time to sleep in seconds between polls of the sockets, when an XBee has no reader thread"
 
 def xbee_select(rlist, wlist, xlist, timeout = None):
     "Select which sockets are ready to read, write, and have exceptions"
@@ -1809,6 +4448,72 @@ def xbee_select(rlist, wlist, xlist, timeout = None):
     # use the original select if no xbee sockets
     if not len(rlist_xbee) and not len(wlist_xbee): 
         return original_select(rlist_nonxbee, wlist_nonxbee, xlist_nonxbee, timeout)
+
+    for sock in rlist_xbee + wlist_xbee:
+        if sock.xbee.serial is not None and not sock.xbee.reader_running():
+            # nothing is reading this XBee in the background, poll it instead
+            return _xbee_select_polling(rlist_nonxbee, wlist_nonxbee, xlist_nonxbee,
+                                        rlist_xbee, wlist_xbee, timeout)
+
+    # XBee sockets are readable (through their fileno()) while they have
+    # messages queued, and writable while their XBee has room in its Tx window,
+    # which is also signaled through a wakeup.  So a single select covers all
+    # of the sockets.
+    while 1:
+        wlist_out_xbee = _xbee_writable(wlist_xbee)
+        tx_wakeups = []
+        wait = timeout
+        if len(wlist_out_xbee):
+            # just check the other sockets
+            wait = 0
+        else:
+            for sock in wlist_xbee:
+                tx_wakeup = sock.xbee.get_tx_wakeup()
+                if tx_wakeup not in tx_wakeups:
+                    tx_wakeups.append(tx_wakeup)
+                    # overdue transmissions are released when checked again
+                    expiry = sock.xbee.tx_window_wait_time()
+                    if expiry is not None and (wait is None or expiry < wait):
+                        wait = expiry
+        rlist_out, wlist_out, xlist_out = original_select(rlist_nonxbee + rlist_xbee + tx_wakeups, wlist_nonxbee, xlist_nonxbee, wait)
+        for tx_wakeup in tx_wakeups:
+            if tx_wakeup in rlist_out:
+                rlist_out.remove(tx_wakeup)
+        if len(tx_wakeups):
+            wlist_out_xbee = _xbee_writable(wlist_xbee)
+        for sock in rlist_xbee:
+            if sock in rlist_out:
+                _global_lock.acquire(True)
+                try:
+                    if not sock._pending_message():
+                        # message was taken by another thread
+                        rlist_out.remove(sock)
+                finally:
+                    _global_lock.release()
+        wlist_out.extend(wlist_out_xbee)
+        if len(rlist_out) or len(wlist_out) or len(xlist_out):
+            break
+        if timeout is not None:
+            timeout = start_time + timeout - time.time()
+            if timeout <= 0:
+                break
+            start_time = time.time()
+    return rlist_out, wlist_out, xlist_out
+
+def _xbee_writable(wlist_xbee):
+    "Returns the XBee sockets whose XBee has room in its Tx window"
+    return [sock for sock in wlist_xbee if sock.xbee.tx_window_open()]
+
+def _xbee_select_polling(rlist_nonxbee, wlist_nonxbee, xlist_nonxbee, rlist_xbee, wlist_xbee, timeout = None):
+    "Select that polls the XBee sockets, for XBees without a reader thread"
+
+    start_time = None
+    if timeout is not None:
+        start_time = time.time()
+
+    rlist_out = []
+    wlist_out = []
+    xlist_out = []
     
     # flag if there are any non_xbee sockets
     nonxbee_socket = len(rlist_nonxbee) or len(wlist_nonxbee) or len(xlist_nonxbee)
@@ -1839,9 +4544,10 @@ def xbee_select(rlist, wlist, xlist, timeout = None):
                     rlist_out.append(sock)
             finally:
                 _global_lock.release()  
-        # xbee sockets are always ready for write
-        #TODO: check to make sure serial port is open and ready to go.
-        wlist_out.extend(wlist_xbee)
+        # check for room in the Tx windows
+        for sock in wlist_xbee:
+            sock.xbee.read_messages()
+        wlist_out.extend(_xbee_writable(wlist_xbee))
     
         # check for any matches
         if len(rlist_out) or len(wlist_out) or len(xlist_out):
@@ -1852,15 +4558,260 @@ def xbee_select(rlist, wlist, xlist, timeout = None):
 # replace the original select with the xbee select
 select.select = xbee_select
 
+POLL_READ = getattr(select, "POLLIN", 0x001) | getattr(select, "POLLPRI", 0x002)
+"Poll events that report data ready to read"
+POLL_WRITE = getattr(select, "POLLOUT", 0x004)
+"Poll event that reports a socket ready to write"
+
+class XBeePoll(object):
+    """Replacement for select.poll() objects that also accepts XBee sockets.
+    Regular descriptors are handed to the system poll object, XBee sockets are
+    polled through the descriptor returned by their fileno(), which is readable
+    while they have messages.  XBee sockets are ready for write while their
+    XBee has room in its Tx window, the Tx wakeup of the XBee is polled for
+    as long as one of its sockets is registered for POLLOUT."""
+
+    DEFAULT_MASK = POLL_READ | POLL_WRITE
+    "Events to poll for when register() is not given an event mask"
+
+    def __init__(self, *args):
+        self.poller = self._new_poller(*args)
+        "System poll object"
+        self.xbee_sockets = {}
+        "[socket, event mask] of the registered XBee sockets, by file descriptor"
+        self.tx_wakeups = {}
+        "[XBee, number of its sockets registered for POLLOUT], by file descriptor of the XBee's Tx wakeup"
+
+    def _new_poller(self, *args):
+        return original_poll(*args)
+
+    def _poll_once(self, timeout):
+        "Poll the system poll object, timeout in seconds or None to wait forever"
+        if timeout is None:
+            return self.poller.poll()
+        return self.poller.poll(timeout * 1000)
+
+    def _timeout_seconds(self, timeout):
+        "Convert the timeout given to poll() to seconds, None for no timeout"
+        if timeout is None or timeout < 0:
+            return None
+        return timeout / 1000.0
+
+    def register(self, fd, eventmask = None):
+        "Register a socket or file descriptor"
+        if eventmask is None:
+            eventmask = self.DEFAULT_MASK
+        if getattr(fd, "_family", None) == socket.AF_XBEE:
+            fileno = fd.fileno()
+            if fileno in self.xbee_sockets:
+                self.modify(fd, eventmask)
+                return
+            self.poller.register(fileno, eventmask & ~POLL_WRITE)
+            self.xbee_sockets[fileno] = [fd, eventmask]
+            if eventmask & POLL_WRITE:
+                self._add_tx_wakeup(fd.xbee)
+        else:
+            self.poller.register(fd, eventmask)
+
+    def modify(self, fd, eventmask):
+        "Change the events polled for on a registered socket or file descriptor"
+        fileno = self._xbee_fileno(fd)
+        if fileno is None:
+            self.poller.modify(fd, eventmask)
+        else:
+            self.poller.modify(fileno, eventmask & ~POLL_WRITE)
+            entry = self.xbee_sockets[fileno]
+            if eventmask & POLL_WRITE and not entry[1] & POLL_WRITE:
+                self._add_tx_wakeup(entry[0].xbee)
+            elif entry[1] & POLL_WRITE and not eventmask & POLL_WRITE:
+                self._remove_tx_wakeup(entry[0].xbee)
+            entry[1] = eventmask
+
+    def unregister(self, fd):
+        "Stop polling a socket or file descriptor"
+        fileno = self._xbee_fileno(fd)
+        if fileno is None:
+            self.poller.unregister(fd)
+        else:
+            sock, eventmask = self.xbee_sockets.pop(fileno)
+            self.poller.unregister(fileno)
+            if eventmask & POLL_WRITE:
+                self._remove_tx_wakeup(sock.xbee)
+
+    def _add_tx_wakeup(self, xbee):
+        "Poll the Tx wakeup of an XBee for one more of its sockets"
+        fileno = xbee.get_tx_wakeup().fileno()
+        entry = self.tx_wakeups.get(fileno)
+        if entry is None:
+            self.poller.register(fileno, POLL_READ)
+            self.tx_wakeups[fileno] = [xbee, 1]
+        else:
+            entry[1] += 1
+
+    def _remove_tx_wakeup(self, xbee):
+        "Stop polling the Tx wakeup of an XBee once none of its sockets need it"
+        fileno = xbee.get_tx_wakeup().fileno()
+        entry = self.tx_wakeups.get(fileno)
+        if entry is not None:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.tx_wakeups[fileno]
+                self.poller.unregister(fileno)
+
+    def _xbee_fileno(self, fd):
+        "Find the file descriptor of a registered XBee socket, None if fd isn't one"
+        if fd in self.xbee_sockets:
+            return fd
+        for fileno, (sock, eventmask) in self.xbee_sockets.items():
+            if sock is fd:
+                return fileno
+        return None
+
+    def _refresh(self):
+        """Re-register XBee sockets whose descriptor changed (the endpoint was
+        registered with the XBee again).  Returns True if any of the XBees needs
+        to be polled because it has no reader thread."""
+        polling = False
+        for fileno, entry in list(self.xbee_sockets.items()):
+            sock, eventmask = entry
+            if sock.closed:
+                continue
+            if sock.xbee.serial is not None and not sock.xbee.reader_running():
+                polling = True
+            new_fileno = sock.fileno()
+            if new_fileno != fileno:
+                try:
+                    self.poller.unregister(fileno)
+                except (KeyError, IOError, OSError):
+                    pass
+                del self.xbee_sockets[fileno]
+                self.poller.register(new_fileno, eventmask & ~POLL_WRITE)
+                self.xbee_sockets[new_fileno] = entry
+        return polling
+
+    def poll(self, timeout = None):
+        "Poll the registered sockets, returns a list of (file descriptor, events)"
+        if not self.xbee_sockets:
+            # nothing to add, use the system poll object
+            return self.poller.poll(timeout)
+        timeout = self._timeout_seconds(timeout)
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+        polling = self._refresh()
+        while 1:
+            wait = timeout
+            # XBee sockets are writable while their XBee has room in its Tx
+            # window, otherwise the XBee's Tx wakeup tells when there is
+            writable = {}
+            for sock, eventmask in self.xbee_sockets.values():
+                xbee = sock.xbee
+                if eventmask & POLL_WRITE and xbee not in writable:
+                    writable[xbee] = xbee.tx_window_open()
+                    if writable[xbee]:
+                        wait = 0
+                    else:
+                        # overdue transmissions are released when checked again
+                        expiry = xbee.tx_window_wait_time()
+                        if expiry is not None and (wait is None or expiry < wait):
+                            wait = expiry
+            if polling:
+                # read the serial ports of the XBees nobody else is reading
+                for sock, eventmask in self.xbee_sockets.values():
+                    if not sock.closed:
+                        _global_lock.acquire(True)
+                        try:
+                            sock._pending_message()
+                        finally:
+                            _global_lock.release()
+                if wait is None or wait > SELECT_SLEEP_TIME:
+                    wait = SELECT_SLEEP_TIME
+            events = dict(self._poll_once(wait))
+            for fileno, (xbee, count) in self.tx_wakeups.items():
+                if events.pop(fileno, None) is not None and not writable.get(xbee):
+                    writable[xbee] = xbee.tx_window_open()
+            for fileno, (sock, eventmask) in self.xbee_sockets.items():
+                event = events.get(fileno, 0)
+                if event & POLL_READ and not sock.closed:
+                    _global_lock.acquire(True)
+                    try:
+                        if not sock._pending_message():
+                            # message was taken by another thread
+                            event &= ~POLL_READ
+                    finally:
+                        _global_lock.release()
+                if eventmask & POLL_WRITE and writable.get(sock.xbee):
+                    event |= POLL_WRITE
+                if event:
+                    events[fileno] = event
+                elif fileno in events:
+                    del events[fileno]
+            if events:
+                return list(events.items())
+            if end_time is not None:
+                timeout = end_time - time.time()
+                if timeout <= 0:
+                    return []
+
+class XBeeEPoll(XBeePoll):
+    """Replacement for select.epoll() objects that also accepts XBee sockets,
+    see XBeePoll."""
+
+    def _new_poller(self, *args):
+        return original_epoll(*args)
+
+    def _poll_once(self, timeout):
+        if timeout is None:
+            return self.poller.poll()
+        return self.poller.poll(timeout)
+
+    def _timeout_seconds(self, timeout):
+        if timeout is None or timeout < 0:
+            return None
+        return timeout
+
+    def poll(self, timeout = -1, maxevents = -1):
+        "Wait for events, returns a list of (file descriptor, events)"
+        if not self.xbee_sockets:
+            return self.poller.poll(timeout, maxevents)
+        events = XBeePoll.poll(self, timeout)
+        if maxevents > 0:
+            return events[:maxevents]
+        return events
+
+    def fileno(self):
+        "File descriptor of the system epoll object"
+        return self.poller.fileno()
+
+    def close(self):
+        "Close the system epoll object"
+        self.xbee_sockets = {}
+        self.poller.close()
+
+    @property
+    def closed(self):
+        return self.poller.closed
+
+# replace the original poll and epoll with the xbee versions
+if hasattr(select, "poll"):
+    original_poll = select.poll
+    select.poll = XBeePoll
+if hasattr(select, "epoll"):
+    original_epoll = select.epoll
+    select.epoll = XBeeEPoll
+
 # Save the original socket.socket definition:
 original_socket = socket.socket
 
 class XBeeSocket(original_socket):
     """Extend socket.socket with XBee emulation hooks."""
     def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM,
-                 proto=0, _sock=None, xbee=default_xbee):
+                 proto=0, _sock=None, xbee=default_xbee, fileno=None):
         if family == socket.AF_XBEE:
             self.__xb_init(family, type, proto, xbee)
+        elif fileno is not None:
+            # Python 3 wraps existing sockets (accept, socketpair) this way
+            original_socket.__init__(self, family, type, proto, fileno)
         else:
             original_socket.__init__(self, family, type, proto, _sock)            
 
@@ -1872,15 +4823,23 @@ class XBeeSocket(original_socket):
         self._proto = proto
         self.xbee = xbee
         self.endpoint_id = None
+        self.fragment_message_id = random.randint(0, 0xFFFF)
+        """Message ID of the last message sent in fragments, starting anywhere
+        so a socket opened again doesn't repeat IDs the receiver just completed"""
         # initialize the socket options
         self.options = {}
         # SOL_SOCKET
         self.options[socket.SOL_SOCKET] = {  
-                                            socket.SO_NONBLOCK: 0 # SO_NONBLOCK
+                                            socket.SO_NONBLOCK: 0, # SO_NONBLOCK
+                                            socket.SO_RCVTIMEO: 0, # in seconds, 0 for no timeout
+                                            socket.SO_SNDTIMEO: 0, # in seconds, 0 for no timeout
+                                            socket.SO_RCVBUF: Endpoint_Queue.DEFAULT_LIMIT # in messages
                                             }
         # XBS_SOL_ENDPOINT
         self.options[socket.XBS_SOL_ENDPOINT] = {
-                                                 socket.XBS_SO_EP_TX_STATUS: 0
+                                                 socket.XBS_SO_EP_TX_STATUS: 0,
+                                                 socket.XBS_SO_EP_RCV_POLICY: socket.XBS_RCV_DROP_OLDEST,
+                                                 socket.XBS_SO_EP_FRAGMENTATION: 0
                                                  }
         # XBS_SOL_APS
         self.options[socket.XBS_SOL_APS] = {}
@@ -1890,13 +4849,20 @@ class XBeeSocket(original_socket):
         self.__del__ = self._xb___del__
         self.close = self._xb_close
         self.getsockopt = self._xb_getsockopt
+        self.fileno = self._xb_fileno
         self._pending_message = self._xb__pending_message
         self.recvfrom = self._xb_recvfrom
+        self.recvfrom_into = self._xb_recvfrom_into
+        self.recv_many = self._xb_recv_many
         self.sendto = self._xb_sendto
+        self.sendto_many = self._xb_sendto_many
         self.setsockopt = self._xb_setsockopt
         self.bind = self._xb_bind
         self.setblocking = self._xb_setblocking
+        self.settimeout = self._xb_settimeout
+        self.gettimeout = self._xb_gettimeout
         self.debug_add_message = self._xb_debug_add_message
+        self.export_statistics = self._xb_export_statistics
 
         
     def _xb___del__(self):
@@ -1912,10 +4878,58 @@ class XBeeSocket(original_socket):
         
     def _xb_getsockopt(self, level, optname):
         "Get socket options"
+        if level == socket.XBS_SOL_ENDPOINT and optname in (socket.XBS_SO_EP_RCV_DEPTH,
+                                                            socket.XBS_SO_EP_RCV_HIGH_WATER,
+                                                            socket.XBS_SO_EP_RCV_DROPS,
+                                                            socket.XBS_SO_EP_FRAMES_TX,
+                                                            socket.XBS_SO_EP_FRAMES_RX,
+                                                            socket.XBS_SO_EP_BYTES_TX,
+                                                            socket.XBS_SO_EP_BYTES_RX,
+                                                            socket.XBS_SO_EP_TX_FAILURES):
+            # receive queue and endpoint statistics
+            rx_queue = self.xbee.rx_messages.get(self.endpoint_id)
+            if rx_queue is None:
+                return 0
+            statistics = rx_queue.statistics
+            if optname == socket.XBS_SO_EP_RCV_DEPTH:
+                return len(rx_queue)
+            elif optname == socket.XBS_SO_EP_RCV_HIGH_WATER:
+                return rx_queue.high_water
+            elif optname == socket.XBS_SO_EP_RCV_DROPS:
+                return rx_queue.drops
+            elif optname == socket.XBS_SO_EP_FRAMES_TX:
+                return statistics.frames_tx
+            elif optname == socket.XBS_SO_EP_FRAMES_RX:
+                return statistics.frames_rx
+            elif optname == socket.XBS_SO_EP_BYTES_TX:
+                return statistics.bytes_tx
+            elif optname == socket.XBS_SO_EP_BYTES_RX:
+                return statistics.bytes_rx
+            return sum(statistics.tx_status_failures.values())
         if level in self.options and optname in self.options[level]:
                 return self.options[level][optname]
         return None
 
+    def _xb_export_statistics(self):
+        "Returns the statistics of the endpoint as a dictionary, see XBee.export_statistics()"
+        if self.endpoint_id is None:
+            raise Exception("Socket is not yet bound to endpoint")
+        return self.xbee.export_statistics(self.endpoint_id)
+
+    def _xb_fileno(self):
+        """File descriptor that is readable while there are messages to receive,
+        allows XBee sockets to be used with the original select()"""
+        if self.endpoint_id is None:
+            raise Exception("Socket is not yet bound to endpoint")
+        _global_lock.acquire(True)
+        try:
+            if self.endpoint_id not in self.xbee.rx_messages:
+                # try to re-register endpoint with XBee
+                self.xbee.register_endpoint(self.endpoint_id)
+            return self.xbee.rx_messages[self.endpoint_id].fileno()
+        finally:
+            _global_lock.release()
+
     def _xb__pending_message(self):
         "Check to see if there is a message ready"
         self.xbee.read_messages()
@@ -1933,33 +4947,165 @@ class XBeeSocket(original_socket):
             
     def _xb_recvfrom(self, buflen, flags = 0):
         "Receive a message from the socket."
+        messages = self._xb__recv(1, flags)
+        if messages:
+            payload, address = messages[0]
+            return payload[:buflen], address
+        return None, None
+
+    def _xb_recvfrom_into(self, buffer, nbytes = 0, flags = 0):
+        """Receive a message from the socket into a writable buffer, such as a
+        bytearray or memoryview, of which up to nbytes bytes are used (all of
+        it when nbytes is 0).  Returns the number of bytes received and the
+        address, 0, None if a non-blocking socket has no message."""
+        messages = self._xb__recv(1, flags)
+        if not messages:
+            return 0, None
+        payload, address = messages[0]
+        if not nbytes or nbytes > len(buffer):
+            nbytes = len(buffer)
+        nbytes = min(nbytes, len(payload))
+        buffer[:nbytes] = payload[:nbytes]
+        return nbytes, address
+
+    def _xb_recv_many(self, max_frames, buflen = None, flags = 0):
+        """Receive up to max_frames messages from the socket at once, the
+        payloads are cut to buflen bytes if given.  Returns a list of
+        (payload, address) tuples, which is empty if a non-blocking socket
+        has no messages.  Like recvfrom(), a blocking socket waits for the
+        first message."""
+        messages = self._xb__recv(max_frames, flags)
+        if buflen is not None:
+            messages = [(payload[:buflen], address) for payload, address in messages]
+        return messages
+
+    def _xb__recv(self, max_frames, flags):
+        "Take up to max_frames messages from the receive queue, honoring the blocking options"
         nonblocking = False
-        if flags == socket.MSG_DONTWAIT or self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK):
+        if flags & socket.MSG_DONTWAIT or self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK):
             nonblocking = True
         if self.endpoint_id is None:
             raise Exception("error: socket not bound yet") #Note: this is a different error
-        while (1):
-            payload, address = self.xbee.recv(self.endpoint_id)
-            if payload is not None:
-                return payload[:buflen], address
-            elif nonblocking:
-                return None, None
+        if nonblocking:
+            timeout = 0
+        else:
+            timeout = self.getsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO) or None
+        if self.endpoint_id not in self.xbee.rx_messages:
+            # try to re-register endpoint with XBee
+            self.xbee.register_endpoint(self.endpoint_id)
+        messages = self.xbee.recv_many(self.endpoint_id, max_frames, timeout)
+        if not messages and timeout is not None and not nonblocking:
+            raise socket.timeout("timed out")
+        return messages
         
     def _xb_sendto(self, data, flags, addr = None):
-        "Send a message from a socket"
+        """Send a message from a socket, data may be a byte string, bytearray or
+        memoryview.  Waits for room in the Tx windows of the XBee, raises
+        EAGAIN if there is none on a non-blocking socket."""
         if addr is None:
             addr = flags
             flags = 0
-        #TTDO: Should support the MSG_DONTWAIT flag and do a blocking call.
-        if self.endpoint_id is not None and self.endpoint_id >= 0:
-            self.xbee.send_zb(self.endpoint_id, addr, data)
+        data = _payload_bytes(data)
+        if self.endpoint_id is not None and self.endpoint_id >= 0 and \
+           self.options[socket.XBS_SOL_ENDPOINT][socket.XBS_SO_EP_FRAGMENTATION]:
+            self._xb__send_fragments(data, addr, flags)
+        elif self.endpoint_id is not None and self.endpoint_id >= 0:
+            _global_lock.acquire(True)
+            try:
+                if addr[0] != "" and not self.xbee.wait_tx_window(addr[0], self._xb_send_timeout(flags)):
+                    self._xb_tx_window_full(flags)
+                self.xbee.send_zb(self.endpoint_id, addr, data)
+            finally:
+                _global_lock.release()
         return len(data)
+
+    def _xb_sendto_many(self, data, addresses, flags = 0):
+        """Send the same message to a list of addresses from a socket, the
+        frames that fit in the Tx windows are written to the XBee in one go.
+        Returns the number of addresses the message was sent to, which is
+        less than len(addresses) when a non-blocking socket runs out of room."""
+        data = _payload_bytes(data)
+        sent = 0
+        if self.endpoint_id is not None and self.endpoint_id >= 0 and \
+           self.options[socket.XBS_SOL_ENDPOINT][socket.XBS_SO_EP_FRAGMENTATION]:
+            for address in addresses:
+                self._xb__send_fragments(data, address, flags)
+                sent += 1
+        elif self.endpoint_id is not None and self.endpoint_id >= 0:
+            timeout = self._xb_send_timeout(flags)
+            _global_lock.acquire(True)
+            try:
+                batch = []
+                for address in addresses:
+                    if address[0] != "" and not self.xbee.tx_window_open(address[0], len(batch),
+                                                                         len([queued for queued in batch if queued[0] == address[0]])):
+                        # send what fits, then wait for Tx Status to make room
+                        self.xbee.send_zb_many(self.endpoint_id, batch, data)
+                        sent += len(batch)
+                        batch = []
+                        if not self.xbee.wait_tx_window(address[0], timeout):
+                            if sent:
+                                return sent
+                            self._xb_tx_window_full(flags)
+                    batch.append(address)
+                self.xbee.send_zb_many(self.endpoint_id, batch, data)
+                sent += len(batch)
+            finally:
+                _global_lock.release()
+        return sent
+
+    def _xb__send_fragments(self, data, addr, flags):
+        """Send a message in fragments.  A blocking socket waits until every
+        fragment was delivered, raising EIO if one could not be, while a
+        non-blocking socket leaves the fragments to be sent in the background."""
+        self.fragment_message_id = (self.fragment_message_id + 1) & 0xFFFF
+        sender = self.xbee.send_fragments(self.endpoint_id, addr, data, self.fragment_message_id)
+        if sender is None:
+            return
+        timeout = self._xb_send_timeout(flags)
+        if timeout == 0:
+            return
+        _global_lock.acquire(True)
+        try:
+            if not sender.wait(timeout):
+                sender.cancel()
+                raise socket.timeout("timed out")
+        finally:
+            _global_lock.release()
+        if sender.delivery_status == Fragment_Sender.NO_TX_STATUS:
+            raise socket.error(errno.EIO, "message not delivered, no Tx Status")
+        elif sender.delivery_status:
+            raise socket.error(errno.EIO, "message not delivered, Tx Status 0x%02X" % sender.delivery_status)
+
+    def _xb_send_timeout(self, flags):
+        "Seconds a send may wait for room in the Tx windows, 0 to not wait and None to wait forever"
+        if flags & socket.MSG_DONTWAIT or self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK):
+            return 0
+        return self.getsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO) or None
+
+    def _xb_tx_window_full(self, flags):
+        "Raise the error for a send that found no room in the Tx windows"
+        if self._xb_send_timeout(flags) == 0:
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        raise socket.timeout("timed out")
     
     def _xb_setsockopt(self, level, optname, value):
         "Set socket options"
         if level in self.options and optname in self.options[level]:
                 self.options[level][optname] = value 
+                self._xb_configure_rx_queue()
         #TTDO: figure out the return value
+
+    def _xb_configure_rx_queue(self):
+        "Apply the receive queue socket options to the endpoint's queue"
+        rx_queue = self.xbee.rx_messages.get(self.endpoint_id)
+        if rx_queue is not None:
+            rx_queue.limit = self.options[socket.SOL_SOCKET][socket.SO_RCVBUF]
+            rx_queue.policy = self.options[socket.XBS_SOL_ENDPOINT][socket.XBS_SO_EP_RCV_POLICY]
+            if not self.options[socket.XBS_SOL_ENDPOINT][socket.XBS_SO_EP_FRAGMENTATION]:
+                rx_queue.reassembler = None
+            elif rx_queue.reassembler is None:
+                rx_queue.reassembler = Fragment_Reassembler()
     
     def _xb_bind(self, address):
         "Bind a socket to an address"
@@ -1979,19 +5125,47 @@ class XBeeSocket(original_socket):
             self.xbee.register_endpoint(endpoint_id)
         # set the endpoint locally
         self.endpoint_id = endpoint_id
+        self._xb_configure_rx_queue()
         self.closed = False            
         return 0
         
     def _xb_setblocking(self, value):
         "Set the socket to be blocking or non-blocking"
-        return self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, not value)
+        if value:
+            self.settimeout(None)
+        else:
+            self.settimeout(0)
+
+    def _xb_settimeout(self, value):
+        """Set the timeout for blocking receives and sends, None to block
+        forever and 0 for non-blocking"""
+        if value is None:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, 0)
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, 0)
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, 0)
+        elif value == 0:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, 1)
+        else:
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK, 0)
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+            self.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+    def _xb_gettimeout(self):
+        "Get the timeout for blocking receives"
+        if self.getsockopt(socket.SOL_SOCKET, socket.SO_NONBLOCK):
+            return 0.0
+        return self.getsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO) or None
 
     def _xb_debug_add_message(self, payload, source_address):
         "Debugging function to artificially add an incoming message to a socket"
         # create the tuple to store the message
         recv_tuple = (payload, source_address)
         # add data to the message queue
-        self.xbee.rx_messages[self.endpoint_id].append(recv_tuple)
+        _global_lock.acquire(True)
+        try:
+            self.xbee.rx_messages[self.endpoint_id].append(recv_tuple)
+        finally:
+            _global_lock.release()
         
 # replace the original socket with the xbee_socket
 socket.socket = XBeeSocket
@@ -2046,7 +5220,10 @@ socket.getaddrinfo = getaddrinfo
 # initialize serial port
 #this is done in a separate thread so that the rest of the program can continue to initialize however it can while the XBee is unavailable
 
-import thread
+try:
+    import thread
+except ImportError:
+    import _thread as thread # Python 3
 import serial
 import simulator_settings
 
@@ -2069,10 +5246,12 @@ def open_com_thread():
                     ran_first_time = True             
                 continue # will hit "finally" below
             try:
-                xbee_serial_port = serial.Serial(simulator_settings.settings["com_port"], simulator_settings.settings["baud"], rtscts = 1)
+                xbee_serial_port = serial.Serial(simulator_settings.settings["com_port"], simulator_settings.settings["baud"], rtscts = 1,
+                                                 timeout = SERIAL_READ_TIMEOUT)
                 xbee_serial_port.writeTimeout = 1 # 1 second timeout for writes
                 xbee_serial_port.flushInput() #get rid of anything the XBee had stored up
                 default_xbee.serial = xbee_serial_port
+                default_xbee.start_reader() # drain the serial port in the background
                 #make sure the serial port connects to an XBee (ddo will throw exception on error)
                 default_xbee.set_version()
                 # COM port successfully opened, finish initialization
@@ -2082,23 +5261,23 @@ def open_com_thread():
                     try:
                         default_xbee.ddo_set_param(None, "D6", 1)
                         default_xbee.ddo_set_param(None, "D7", 1)
-                    except Exception, e:
+                    except Exception as e:
                         # Continue with opening XBee, this is NOT a fatal error.
                         logger.warning("unable to initialize XBee DDO params: %s" % repr(e))
                     try:
                         if not default_xbee.is_series_1():
                             # ATAO not supported on XBee series 1
                             default_xbee.ddo_set_param(None, "AO", 3)
-                    except Exception, e:
+                    except Exception as e:
                         logger.warning("unable to initialize XBee DDO params: %s" % repr(e))
                 try:
                     default_xbee.get_node_list(refresh=True, blocking=False) #kick off discovery of nodes on network
-                except Exception, e:
+                except Exception as e:
                     logger.warning("exception during XBee node discovery: %s" % e)
                 logger.info("Serial port for XBee opened successfully (%s, %s)" % (simulator_settings.settings.get('com_port', 'No COM'), simulator_settings.settings.get('baud', 'no baud')))
                 ran_first_time = True
                 return
-            except Exception, e:
+            except Exception as e:
                 if not ran_first_time:
                     logger.error("Exception while creating serial port (%s, %s): %s" % (simulator_settings.settings.get('com_port', 'No COM'), simulator_settings.settings.get('baud', 'no baud'), e))
                     ran_first_time = True
@@ -2122,11 +5301,17 @@ def com_port_changes(new_value, old_value):
             com_port_opened = False
             # close the com port
             default_xbee.close_serial()
+            default_xbee.load_node_table()
             ran_first_time = False # we should reprint an error if the serial port settings don't work
             thread.start_new_thread(open_com_thread, ())
     finally:
         _com_mgmt_lock.release()
 
+# know the nodes right away, the discovery run once the serial port opens brings them up to date
+default_xbee.node_table_file = simulator_settings.settings.get("node_table_file") or \
+    os.path.join(os.path.dirname(os.path.abspath(simulator_settings.settings.filename)), NODE_TABLE_FILE)
+default_xbee.load_node_table()
+
 thread.start_new_thread(open_com_thread, ())
 
 simulator_settings.settings.add_callback('com_port', com_port_changes)
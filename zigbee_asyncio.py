@@ -0,0 +1,259 @@
+#
+# Copyright (c) 2009-2012 Digi International Inc.
+# All rights not expressly granted are reserved.
+#
+# This Source Code Form is subject to the terms of the Mozilla Public License,
+# v. 2.0. If a copy of the MPL was not distributed with this file, You can
+# obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Digi International Inc. 11001 Bren Road East, Minnetonka, MN 55343
+#
+
+# This file implements an asyncio datagram transport for XBee endpoints
+# (Python 3 only).  Example:
+#
+#    class Echo(asyncio.DatagramProtocol):
+#        def connection_made(self, transport):
+#            self.transport = transport
+#        def datagram_received(self, data, addr):
+#            self.transport.sendto(data, addr)
+#
+#    transport, protocol = await create_xbee_datagram_endpoint(
+#        Echo, local_addr=("", 0xe8, 0, 0))
+
+import asyncio
+import collections
+import socket
+
+import zigbee
+
+class XBeeDatagramTransport(asyncio.DatagramTransport):
+    """Datagram transport for an endpoint of an XBee.
+
+    The receive queue of the endpoint makes the socket's fileno() readable
+    while messages are waiting, so frames are handed to the protocol straight
+    from the event loop without any threads beyond the XBee's serial reader.
+    Addresses are the tuples returned by recvfrom() on XBee sockets and
+    datagrams are sent with XBee.send_zb().  While the Tx windows of the XBee
+    are full, datagrams are buffered and the protocol's pause_writing() and
+    resume_writing() are called at the high and low water marks."""
+
+    MAX_READS = 64
+    "Most datagrams delivered per event loop callback"
+    HIGH_WATER = 64
+    "Buffered datagrams at which the protocol is asked to pause writing"
+    LOW_WATER = 16
+    "Buffered datagrams at which the protocol may resume writing"
+
+    def __init__(self, loop, sock, protocol, address = None, waiter = None, extra = None):
+        asyncio.DatagramTransport.__init__(self, extra)
+        self._extra["socket"] = sock
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._address = address
+        "Default destination for sendto()"
+        self._fileno = None
+        self._poll_handle = None
+        self._closing = False
+        self._paused = False
+        self._buffer = collections.deque()
+        "Datagrams waiting for room in the Tx windows, as (data, addr)"
+        self._tx_wakeup = None
+        self._tx_fileno = None
+        self._tx_handle = None
+        self._writing_paused = False
+        self._loop.call_soon(self._protocol.connection_made, self)
+        self._loop.call_soon(self._add_reader)
+        if waiter is not None:
+            self._loop.call_soon(waiter.set_result, None)
+
+    def _add_reader(self):
+        if self._closing or self._paused:
+            return
+        self._fileno = self._sock.fileno()
+        self._loop.add_reader(self._fileno, self._read_ready)
+        self._schedule_poll()
+
+    def _remove_reader(self):
+        if self._fileno is not None:
+            self._loop.remove_reader(self._fileno)
+            self._fileno = None
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
+
+    def _schedule_poll(self):
+        "Poll the serial port from the loop if nothing reads the XBee in the background"
+        xbee = self._sock.xbee
+        if xbee.serial is not None and not xbee.reader_running():
+            self._poll_handle = self._loop.call_later(zigbee.SELECT_SLEEP_TIME, self._poll)
+
+    def _poll(self):
+        self._poll_handle = None
+        if self._closing or self._paused:
+            return
+        self._sock.xbee.read_messages()
+        self._schedule_poll()
+
+    def _read_ready(self):
+        xbee = self._sock.xbee
+        for i in range(self.MAX_READS):
+            if self._closing or self._paused:
+                break
+            try:
+                payload, address = xbee.recv(self._sock.endpoint_id)
+            except Exception as e:
+                self._protocol.error_received(e)
+                break
+            if payload is None:
+                break
+            self._protocol.datagram_received(payload, address)
+
+    def sendto(self, data, addr = None):
+        "Send a datagram to addr, or to the remote address given when creating the endpoint"
+        if addr is None:
+            addr = self._address
+        if addr is None:
+            raise ValueError("no destination address for XBee datagram")
+        if self._closing:
+            return
+        self._buffer.append((bytes(data), addr))
+        self._flush()
+        if len(self._buffer) >= self.HIGH_WATER and not self._writing_paused:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def _flush(self):
+        "Send buffered datagrams, in order, while the Tx windows have room"
+        xbee = self._sock.xbee
+        self._unwatch_tx_window()
+        while self._buffer:
+            data, addr = self._buffer[0]
+            if addr[0] != "" and not xbee.tx_window_open(addr[0]):
+                break
+            self._buffer.popleft()
+            try:
+                xbee.send_zb(self._sock.endpoint_id, addr, data)
+            except Exception as e:
+                self._protocol.error_received(e)
+        if self._buffer:
+            self._watch_tx_window()
+        elif self._closing:
+            self._loop.call_soon(self._call_connection_lost, None)
+        if self._writing_paused and len(self._buffer) <= self.LOW_WATER:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+
+    def _watch_tx_window(self):
+        xbee = self._sock.xbee
+        if xbee.tx_window_open():
+            # only the destination's window is full, there is no event for
+            # that so check back shortly
+            wait = zigbee.SELECT_SLEEP_TIME
+        else:
+            if self._tx_wakeup is None:
+                self._tx_wakeup = xbee.add_tx_wakeup()
+            self._tx_fileno = self._tx_wakeup.fileno()
+            self._loop.add_reader(self._tx_fileno, self._flush)
+            # make sure overdue Tx Status are noticed
+            wait = xbee.tx_window_wait_time()
+            if wait is None or (xbee.serial is not None and not xbee.reader_running()):
+                wait = min(wait or zigbee.SELECT_SLEEP_TIME, zigbee.SELECT_SLEEP_TIME)
+        self._tx_handle = self._loop.call_later(wait, self._tx_poll)
+
+    def _unwatch_tx_window(self):
+        if self._tx_fileno is not None:
+            self._loop.remove_reader(self._tx_fileno)
+            self._tx_fileno = None
+        if self._tx_handle is not None:
+            self._tx_handle.cancel()
+            self._tx_handle = None
+
+    def _tx_poll(self):
+        self._tx_handle = None
+        xbee = self._sock.xbee
+        if xbee.serial is not None and not xbee.reader_running():
+            xbee.read_messages()
+        self._flush()
+
+    def get_write_buffer_size(self):
+        "Number of datagrams waiting for room in the Tx windows"
+        return len(self._buffer)
+
+    def pause_reading(self):
+        if not self._paused:
+            self._paused = True
+            self._remove_reader()
+
+    def resume_reading(self):
+        if self._paused:
+            self._paused = False
+            self._add_reader()
+
+    def is_reading(self):
+        return not self._paused and not self._closing
+
+    def set_protocol(self, protocol):
+        self._protocol = protocol
+
+    def get_protocol(self):
+        return self._protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        """Stop receiving, send the buffered datagrams, then close the socket
+        and call connection_lost() on the protocol"""
+        if self._closing:
+            return
+        self._closing = True
+        self._remove_reader()
+        if not self._buffer:
+            self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        "Close the transport, dropping the buffered datagrams"
+        self._buffer.clear()
+        self._unwatch_tx_window()
+        if not self._closing:
+            self.close()
+        else:
+            self._loop.call_soon(self._call_connection_lost, None)
+
+    def _call_connection_lost(self, exc):
+        if self._sock is None:
+            return
+        self._unwatch_tx_window()
+        if self._tx_wakeup is not None:
+            self._sock.xbee.remove_tx_wakeup(self._tx_wakeup)
+            self._tx_wakeup = None
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+            self._sock = None
+
+
+async def create_xbee_datagram_endpoint(protocol_factory, local_addr, remote_addr = None,
+                                        xbee = None, proto = socket.XBS_PROT_TRANSPORT):
+    """The XBee counterpart of loop.create_datagram_endpoint(): binds local_addr,
+    e.g. ("", 0xe8, 0, 0), on xbee (zigbee.default_xbee by default) and returns
+    (transport, protocol).  remote_addr is the default destination for sendto()."""
+    loop = asyncio.get_running_loop()
+    if xbee is None:
+        xbee = zigbee.default_xbee
+    sock = zigbee.XBeeSocket(socket.AF_XBEE, socket.SOCK_DGRAM, proto, xbee = xbee)
+    try:
+        sock.bind(local_addr)
+        sock.setblocking(False)
+        protocol = protocol_factory()
+        waiter = loop.create_future()
+        transport = XBeeDatagramTransport(loop, sock, protocol, remote_addr, waiter,
+                                          {"sockname": local_addr, "peername": remote_addr})
+        await waiter
+    except:
+        sock.close()
+        raise
+    return transport, protocol